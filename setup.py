@@ -14,6 +14,8 @@ So, after running `python setup.py`, open `distdir` and find `library.zip`.
 4. Now, you've fixed the only problem with bbFreeze for our purposes. Zip up `/Desktop/library` on the command line with `cd Desktop/library/ && sudo zip -r library.zip .`.
 5. Copy this **new** `library.zip` (it will be inside `Desktop/library/library.zip`) and paste over the old one in `\distdir`.
 6. You're ready to go! Now when you run the executable, it will be able to find the tile templates and JS plugins it needs to create and display the map! 
+
+`setup.py` also freezes `harvest.py` into `metarvis-harvest-1.0`, leaving out Folium, NumPy and the GUI toolkits, for harvesting from cron; it needs none of the steps above.
 '''
 
 from bbfreeze import Freezer
@@ -21,3 +23,8 @@ f = Freezer(distdir="metarvis-1.0")
 f.addScript("./source/main.py")
 f.addScript("./source/metarvis-gui.py")
 f()
+
+# The harvest alone, for cron: none of the map or GUI libraries
+h = Freezer(distdir="metarvis-harvest-1.0", excludes=("folium", "numpy", "pandas", "jinja2", "easygui", "wx", "PyQt4", "PySide", "gtk", "gobject", "glib", "scipy", "PIL", "Tkinter", "webbrowser"))
+h.addScript("./source/harvest.py")
+h()
@@ -0,0 +1,67 @@
+# /usr/bin/env python
+'''
+METAR-vis archive
+-------
+
+Keeps the archive of observations in ./data/metar.db small: observations
+from before the current month (or year) are rolled out of the main database
+into a partition database per month (e.g. ./data/metar.201410.db), which
+queries of the history attach when they need them. Partitions older than the
+retention period are deleted, and the rest compacted (VACUUM) once they stop
+changing.
+
+Run it from cron, e.g. daily, alongside the harvest.
+
+Usage: `python source/archive.py [--database ./data/metar.db] [--partition month] [--keep-days 730]`
+
+'''
+
+import time
+import argparse
+
+import main as m
+
+def archive(database='./data/metar.db', partition='month', keepDays=None, compact=True, verbose=True):
+    '''
+    Rolls the observations from before the current period into their
+    partitions, deletes the partitions older than keepDays, and compacts the
+    partitions that have changed (and the main database, if observations
+    were rolled out of it). Returns a dictionary of what was done: moved (the
+    number of observations), dropped and compacted (lists of partition keys).
+
+    Input:
+    database -- default './data/metar.db', the path of the main database
+    partition -- default 'month', the period of the partitions (see
+                 main.PARTITIONS). It cannot be changed once the database is
+                 partitioned.
+    keepDays -- default None, the days of observations to keep: partitions
+                that end before then are deleted. None keeps every partition.
+    compact -- Boolean (default True), VACUUM the changed databases
+    verbose -- Boolean (default True), prints what was done
+    '''
+    metardb = m.metarsqlite3db(database, partition=partition)
+    report = {'moved': metardb.rollPartitions(), 'dropped': [], 'compacted': []}
+    if keepDays is not None:
+        report['dropped'] = metardb.dropPartitions(time.time() - keepDays*86400)
+    if compact:
+        report['compacted'] = metardb.compactPartitions()
+        if report['moved']:
+            metardb.conn.execute('VACUUM;')
+    metardb.conn.close()
+    if verbose:
+        print '{moved} observations rolled into partitions'.format(moved=report['moved'])
+        print 'Partitions deleted: {keys}'.format(keys=', '.join(report['dropped']) or 'none')
+        print 'Partitions compacted: {keys}'.format(keys=', '.join(report['compacted']) or 'none')
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description='Roll old METAR observations into partitions, and delete and compact old partitions.')
+    parser.add_argument('--database', default='./data/metar.db', help='the main database (default ./data/metar.db)')
+    parser.add_argument('--partition', default='month', choices=sorted(m.PARTITIONS), help='the period of each partition (default month)')
+    parser.add_argument('--keep-days', type=int, default=None, help='delete partitions older than this many days (default: keep them all)')
+    parser.add_argument('--no-compact', action='store_true', help='do not VACUUM the changed databases')
+    args = parser.parse_args()
+    archive(args.database, args.partition, args.keep_days, not args.no_compact)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,806 @@
+# /usr/bin/env python
+'''
+METAR-vis benchmarks
+-------
+
+Times the parts of METAR-vis that matter on a full-network run, using
+synthetic data so that no network access is needed.
+
+The suite (benchmarkSuite) times a whole harvest and each of its layers on
+synthetic networks of 10, 1,000 and 10,000 stations served by a local
+stand-in for NOAA (see standin.py), and can save its results with the commit
+they were measured at, and compare them with the results of another commit.
+
+Usage: `python source/benchmark.py [--suite] [--counts 10 1000 10000] [--output results.json] [--compare baseline.json]`
+
+'''
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import resource
+import tarfile
+import json
+import platform
+import argparse
+import subprocess
+import datetime as dt
+import calendar
+
+import numpy as np
+
+import main as m
+import metarparse
+import metarcode
+import fetch
+import cluster
+import overlay
+import symbology
+import ingest
+import pipeline
+import standin
+
+# Run in a new interpreter by benchmarkStartup: imports a module (%s), timing
+# each module imported for the first time along the way, as Python 3's
+# -X importtime does. Prints a line of depth, name, cumulative and own
+# seconds per module, in the order they finished, then the modules loaded.
+IMPORT_TIMER = '''
+import sys, time, __builtin__
+original = __builtin__.__import__
+stack = [0.]
+def timedImport(name, globals=None, locals=None, fromlist=None, level=-1):
+    if not name or name in sys.modules:
+        return original(name, globals, locals, fromlist, level)
+    depth = len(stack)
+    stack.append(0.)
+    start = time.time()
+    try:
+        return original(name, globals, locals, fromlist, level)
+    finally:
+        elapsed = time.time() - start
+        own = elapsed - stack.pop()
+        stack[-1] += elapsed
+        print '%%d\t%%s\t%%f\t%%f' %% (depth, name, elapsed, own)
+__builtin__.__import__ = timedImport
+import %s
+__builtin__.__import__ = original
+print 'modules\t' + ' '.join(name for name, module in sys.modules.items() if module is not None)
+'''
+
+# Modules that a harvest does not need, and should not import
+HEAVY_MODULES = ('folium', 'numpy', 'pandas', 'jinja2', 'webbrowser', 'easygui',
+                 'wx', 'PyQt4', 'PySide', 'gtk', 'scipy', 'bs4')
+
+def syntheticStations(stations=1000):
+    '''
+    Returns a list of station value tuples (as from
+    METARTxtFile.stationValues()) for a number of synthetic stations.
+    '''
+    values = []
+    for i in range(stations):
+        station = 'S%03d' % i
+        lon, lat = -180 + i*(360./stations), -60 + (i % 120)
+        values.append((station, 'Station %s, Nowhere (%s)' % (station, station),
+                       'Station %s' % station, 'Nowhere', lat, lon, 10))
+    return values
+
+def syntheticObservations(n, stations=1000, start=None):
+    '''
+    Returns a list of n observation value tuples (as from
+    METARTxtFile.observationValues()), spread over a number of synthetic
+    stations at half-hourly intervals from start (default 2014-10-01).
+    '''
+    start = start or dt.datetime(2014, 10, 1)
+    observations = []
+    for i in range(n):
+        station = 'S%03d' % (i % stations)
+        when = start + dt.timedelta(minutes=30*(i // stations))
+        observations.append((station, str(when), calendar.timegm(when.utctimetuple()), i % 40, i % 35, (i*10) % 360,
+                             i % 30 - 5, 32 + (i % 30 - 5)*9/5, 20 + (i*7) % 81))
+    return observations
+
+def timed(function, *args, **kwargs):
+    '''Returns the result of function(*args, **kwargs) and the seconds it took'''
+    start = time.time()
+    result = function(*args, **kwargs)
+    return result, time.time() - start
+
+def benchmarkIngest(n=10000):
+    '''
+    Compares the rows/second of adding n synthetic observations one at a time
+    (one transaction each, as METARTxtFile.addIfMissing does), with the bulk
+    ingest of metarsqlite3db.addObservations, with and without tuned pragmas.
+    Each case writes to a new database in a temporary directory.
+    '''
+    observations = syntheticObservations(n)
+    def oneAtATime(metardb):
+        for vals in observations:
+            metardb.addObservations([vals])
+    cases = [('one transaction per row', False, oneAtATime),
+             ('addObservations', False, lambda metardb: metardb.addObservations(observations)),
+             ('addObservations, tuned', True, lambda metardb: metardb.addObservations(observations))]
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for i, (name, tune, ingest) in enumerate(cases):
+            metardb = m.metarsqlite3db(os.path.join(tmpdir, 'bench%d.db' % i), tune=tune)
+            metardb.addStations(syntheticStations())
+            result, elapsed = timed(ingest, metardb)
+            metardb.conn.close()
+            print '{name}: {n} rows in {elapsed:.2f} s ({rate:.0f} rows/second)'.format(name=name, n=n, elapsed=elapsed, rate=n/elapsed)
+    finally:
+        shutil.rmtree(tmpdir)
+    return None
+
+def benchmarkParse(n=10000):
+    '''
+    Measures the files/second of metarparse.parse, and of building
+    METARTxtFile objects and their database values, over a corpus of n
+    synthetic decoded METAR files.
+    '''
+    corpus = [standin.syntheticTxt(i) for i in range(n)]
+    corpus = [(station, text.splitlines(True)) for station, text in corpus]
+    def parseAll():
+        for station, lines in corpus:
+            metarparse.parse(station, lines)
+    def wrapAll():
+        for station, lines in corpus:
+            m.METARTxtFile(station, dataList=lines).observationValues()
+    for name, function in [('metarparse.parse', parseAll),
+                           ('METARTxtFile.observationValues', wrapAll)]:
+        result, elapsed = timed(function)
+        print '{name}: {n} files in {elapsed:.2f} s ({rate:.0f} files/second)'.format(name=name, n=n, elapsed=elapsed, rate=n/elapsed)
+    return None
+
+def benchmarkBulkIngest(n=20000):
+    '''
+    Measures the observations/second of streaming n synthetic decoded .TXT
+    files (see standin.syntheticTxt) into a new database with ingest.ingest, from a
+    directory and from a .tar.gz archive of it.
+    '''
+    tmpdir = tempfile.mkdtemp()
+    try:
+        directory = os.path.join(tmpdir, 'decoded')
+        for i in range(n):
+            station, text = standin.syntheticTxt(i)
+            path = os.path.join(directory, '%03d' % (i // 1000))
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            with open(os.path.join(path, station + '.TXT'), 'w') as f:
+                f.write(text)
+        archive = tarfile.open(os.path.join(tmpdir, 'decoded.tar.gz'), 'w:gz')
+        archive.add(directory, 'decoded')
+        archive.close()
+        for i, (name, path) in enumerate([('directory', directory), ('tar.gz', archive.name)]):
+            metardb = m.metarsqlite3db(os.path.join(tmpdir, 'bench%d.db' % i), tune=True)
+            stats = ingest.ingest(path, metardb)
+            metardb.conn.close()
+            print 'ingest from a {name}: {files} files in {elapsed:.2f} s ({rate:.0f} observations/second), {added} added'.format(name=name, **stats)
+    finally:
+        shutil.rmtree(tmpdir)
+    return None
+
+def benchmarkFetchCache(n=1000, changed=0.1, concurrency=16):
+    '''
+    Harvests n synthetic stations from a local standin.standinServer three
+    times through a fetch.httpCache: from an empty cache, with nothing
+    changed, and with a fraction (changed) of the stations updated. Prints
+    the time of each run and the server's count of full (200) and
+    not-modified (304) responses.
+    '''
+    files = dict(standin.syntheticTxt(i) for i in range(n))
+    server = standin.standinServer(files)
+    server.start()
+    tmpdir = tempfile.mkdtemp()
+    try:
+        metardb = m.metarsqlite3db(os.path.join(tmpdir, 'bench.db'))
+        cache = fetch.httpCache(os.path.join(tmpdir, 'httpcache'))
+        stations = m.getStations(cache, server.source)
+        for name, update in [('empty cache', 0), ('nothing changed', 0),
+                             ('%d%% changed' % (changed*100), int(n*changed))]:
+            for station in stations[:update]:
+                server.update(station, files[station].replace('2014.09', '2014.10'))
+            before = dict(server.counts)
+            harvester = m.metarHarvester(metardb, concurrency=concurrency, source=server.source, cache=cache)
+            stats = harvester.harvest(stations)
+            print '{name}: {elapsed:.2f} s, {full} full and {notmodified} not-modified responses, {parsed} parsed, {added} added'.format(
+                name=name, elapsed=stats['elapsed'], full=server.counts[200]-before[200],
+                notmodified=server.counts[304]-before[304], parsed=stats['parsed'], added=stats['added'])
+        metardb.conn.close()
+    finally:
+        server.stop()
+        shutil.rmtree(tmpdir)
+    return None
+
+def syntheticCycle(n, directory='./data/fixtures'):
+    '''
+    Returns the text of a cycle file of n synthetic stations (as in
+    standin.syntheticTxt), each with one of the reports of the fixture cycle file.
+    '''
+    with open(os.path.join(directory, 'cycles', '01Z.TXT')) as f:
+        reports = [(when, code) for when, code in metarcode.readCycle(f.read())
+                   if not code.startswith('METAR') and ' NIL' not in code and 'garbled' not in code]
+    lines = []
+    for i in range(n):
+        when, code = reports[i % len(reports)]
+        lines += [when.strftime('%Y/%m/%d %H:%M'), 'S%03d' % (i % 1000) + code[4:], '']
+    return '\n'.join(lines)
+
+def benchmarkCycles(n=1000, concurrency=16):
+    '''
+    Compares decoding n raw reports from a cycle file with parsing n decoded .TXT files, and harvesting n synthetic
+    stations from a local standin.standinServer file by file
+    (metarHarvester.harvest) with reading them from one cycle file
+    (metarHarvester.harvestCycles), counting the requests each makes.
+    '''
+    cycle = syntheticCycle(n)
+    corpus = [standin.syntheticTxt(i) for i in range(n)]
+    for name, function in [('metarcode.cycleObservations', lambda: metarcode.cycleObservations(cycle)),
+                           ('metarparse.parse', lambda: [metarparse.parse(station, text) for station, text in corpus])]:
+        result, elapsed = timed(function)
+        print '{name}: {n} reports in {elapsed:.3f} s ({rate:.0f} reports/second)'.format(name=name, n=n, elapsed=elapsed, rate=n/elapsed)
+    server = standin.standinServer(dict(corpus), cycles={'01Z': cycle})
+    server.start()
+    tmpdir = tempfile.mkdtemp()
+    try:
+        metardb = m.metarsqlite3db(os.path.join(tmpdir, 'bench.db'))
+        stations = sorted(server.files)
+        harvester = m.metarHarvester(metardb, concurrency=concurrency, source=server.source)
+        for name, harvest in [('harvest, a file per station', lambda: harvester.harvest(stations)),
+                              ('harvestCycles, one cycle file', lambda: harvester.harvestCycles(stations, [1], server.cyclesSource))]:
+            before = server.counts[200]
+            stats, elapsed = timed(harvest)
+            print '{name}: {n} stations in {elapsed:.2f} s, {requests} requests, {added} added'.format(
+                name=name, n=len(stations), elapsed=elapsed, requests=server.counts[200] - before, added=stats['added'])
+        metardb.conn.close()
+    finally:
+        server.stop()
+        shutil.rmtree(tmpdir)
+    return None
+
+def benchmarkPipeline(counts=(3, 500, 5000), concurrency=16):
+    '''
+    Harvests increasing numbers of synthetic stations from a local
+    standin.standinServer, printing the peak memory of the process after
+    each (which only grows if a harvest needs more than the ones before it;
+    it includes the stand-in's files, which are held in memory), and the
+    throughput of each stage of the harvest and the depth of the
+    queues between them.
+    '''
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for n in counts:
+            server = standin.standinServer(dict(standin.syntheticTxt(i, n) for i in range(n)))
+            server.start()
+            metardb = m.metarsqlite3db(os.path.join(tmpdir, 'bench%d.db' % n))
+            harvester = m.metarHarvester(metardb, concurrency=concurrency, source=server.source)
+            stats = harvester.harvest(sorted(server.files))
+            server.stop()
+            metardb.conn.close()
+            print '{n} stations in {elapsed:.2f} s, peak memory {peak:.1f} MB'.format(n=n,
+                elapsed=stats['elapsed'], peak=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.)
+            for line in pipeline.report([(name, stats['stages'][name]) for name in ['fetch', 'parse', 'dedupe', 'write']],
+                                        [(name, stats['queues'][name]) for name in ['fetched', 'parsed']]):
+                print '    ' + line
+    finally:
+        shutil.rmtree(tmpdir)
+    return None
+
+def benchmarkKnown(stations=1000, concurrency=16):
+    '''
+    Harvests synthetic stations from a local standin.standinServer, then
+    harvests them again (every file unchanged, so every observation already
+    stored), with and without the check of each file's date line against
+    the latest stored observations (metarHarvester's skipKnown), printing
+    the time taken and the busy seconds of the parse stage.
+    '''
+    tmpdir = tempfile.mkdtemp()
+    server = standin.standinServer(dict(standin.syntheticTxt(i, stations) for i in range(stations)))
+    server.start()
+    try:
+        for skipKnown in (False, True):
+            metardb = m.metarsqlite3db(os.path.join(tmpdir, 'bench%d.db' % skipKnown))
+            m.metarHarvester(metardb, concurrency=concurrency, source=server.source).harvest(sorted(server.files))
+            metardb.conn.close()
+            metardb = m.metarsqlite3db(os.path.join(tmpdir, 'bench%d.db' % skipKnown))
+            harvester = m.metarHarvester(metardb, concurrency=concurrency, source=server.source, skipKnown=skipKnown)
+            stats = harvester.harvest(sorted(server.files))
+            metardb.conn.close()
+            print '{name}: {n} stations again in {elapsed:.2f} s, parse {busy:.2f} s busy, {known} skipped before parsing, {duplicates} after'.format(
+                name='date line checked' if skipKnown else 'every file parsed', n=stations, elapsed=stats['elapsed'],
+                busy=stats['stages']['parse']['busy'], known=stats['known'], duplicates=stats['duplicates'])
+    finally:
+        server.stop()
+        shutil.rmtree(tmpdir)
+    return None
+
+def benchmarkStartup(entries=('harvest', 'main'), top=8):
+    '''
+    Imports each of entries in a new interpreter, printing the time taken
+    by the process and by the import, the modules that took longest to
+    import themselves (excluding the modules they imported), and any of
+    HEAVY_MODULES that were imported. The harvest should import none of
+    them: if it does, a map or GUI dependency has crept back into the
+    harvest's start-up.
+    '''
+    here = os.path.dirname(os.path.abspath(__file__))
+    for entry in entries:
+        start = time.time()
+        output = subprocess.check_output([sys.executable, '-c', IMPORT_TIMER % entry], cwd=here)
+        process = time.time() - start
+        records, modules = [], []
+        for line in output.splitlines():
+            fields = line.split('\t')
+            if fields[0] == 'modules':
+                modules = fields[1].split()
+            elif len(fields) == 4 and fields[0].isdigit():
+                records.append((int(fields[0]), fields[1], float(fields[2]), float(fields[3])))
+        total = sum(cumulative for depth, name, cumulative, own in records if depth == 1)
+        heavy = sorted(set(name.split('.')[0] for name in modules) & set(HEAVY_MODULES))
+        print '{entry}: {process:.3f} s process, {total:.3f} s importing {n} modules'.format(entry=entry,
+            process=process, total=total, n=len(modules))
+        for depth, name, cumulative, own in sorted(records, key=lambda record: -record[3])[:top]:
+            print '    {own:.4f} s {name} ({cumulative:.4f} s with its imports)'.format(own=own, name=name, cumulative=cumulative)
+        print '    imports {heavy}'.format(heavy=', '.join(heavy) or 'no map or GUI modules')
+    return None
+
+def benchmarkMap(stations=3000):
+    '''
+    Compares the time taken and HTML written by foliumMap.makeMap with Folium
+    writing every marker, and with the data-driven payload (inline, and in a
+    sidecar file), for a number of synthetic stations observed in the last
+    hour.
+    '''
+    start = dt.datetime.utcnow() - dt.timedelta(hours=1)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        metardb = m.metarsqlite3db(os.path.join(tmpdir, 'bench.db'), cacheSize=0)
+        metardb.addStations(syntheticStations(stations))
+        metardb.addObservations(syntheticObservations(stations, stations, start))
+        for i, (name, data, sidecar) in enumerate([('per-marker JavaScript', False, False),
+                                                   ('inline payload', True, False),
+                                                   ('sidecar payload', True, True)]):
+            mapName = os.path.join(tmpdir, 'map%d.html' % i)
+            fmap = m.foliumMap(metardb, mapName, 'Mapbox Bright')
+            result, elapsed = timed(fmap.makeMap, point=False, data=data, sidecar=sidecar)
+            size = sum(os.path.getsize(os.path.join(tmpdir, f)) for f in os.listdir(tmpdir) if f.startswith('map%d.' % i))
+            print '{name}: {stations} stations in {elapsed:.2f} s, {size:.0f} kB written'.format(name=name, stations=stations, elapsed=elapsed, size=size/1024.)
+        metardb.conn.close()
+    finally:
+        shutil.rmtree(tmpdir)
+    return None
+
+def benchmarkLevels(counts=(3000, 30000, 300000), zooms=range(0, 6)):
+    '''
+    Measures the time taken by cluster.levels to cluster random stations at
+    each of zooms, for each number of stations in counts, and the number of
+    markers drawn at the lowest and highest level.
+    '''
+    random = np.random.RandomState(0)
+    for n in counts:
+        data = {'lon': random.uniform(-180, 180, n), 'lat': random.uniform(-60, 75, n),
+                'temperature': random.randint(-20, 35, n).astype(float),
+                'speed': random.randint(0, 40, n).astype(float),
+                'direction': random.randint(0, 36, n)*10.}
+        data['temperature'][::20] = np.nan
+        payloads, elapsed = timed(cluster.levels, data, symbology.TEMPERATURE, zooms)
+        print '{n} stations: {levels} levels in {elapsed:.3f} s, {low} to {high} markers'.format(
+            n=n, levels=len(zooms), elapsed=elapsed, low=len(payloads[min(zooms)]['rows']),
+            high=len(payloads[max(zooms)]['rows']))
+    return None
+
+def benchmarkOverlay(path='./data/nzcoastline-1-250k.json'):
+    '''
+    Encodes each zoom level of the coastline overlay at path into an empty
+    cache, then again from the cache, printing the points, size and time of
+    each level against the size of the source file.
+    '''
+    tmpdir = tempfile.mkdtemp()
+    try:
+        print '{path}: {size:.0f} kB'.format(path=path, size=os.path.getsize(path)/1024.)
+        coastline = overlay.coastlineLevels(path, tmpdir)
+        for zoom in coastline.zooms:
+            coastline.level(zoom)
+            stats = coastline.stats[zoom]
+            print 'zoom {zoom}: {points} points, {size:.1f} kB in {seconds:.3f} s'.format(
+                zoom=zoom, points=stats['points'], size=stats['bytes']/1024., seconds=stats['seconds'])
+        cached = overlay.coastlineLevels(path, tmpdir)
+        result, elapsed = timed(lambda: [cached.level(zoom) for zoom in cached.zooms])
+        print 'all levels from the cache: {elapsed:.3f} s'.format(elapsed=elapsed)
+    finally:
+        shutil.rmtree(tmpdir)
+    return None
+
+def syntheticRows(n):
+    '''
+    Returns a list of n dictionaries of the latest observations of synthetic
+    stations, as from metarsqlite3db.returnMostRecent(returnDict=True). Every
+    twentieth has no temperature.
+    '''
+    rows = []
+    for i in range(n):
+        rows.append({'X': -180 + i*(360./n), 'Y': -60 + (i % 120), 'station': 'S%05d' % i,
+                     'label': 'Station S%05d' % i, 'country': 'Nowhere', 'utc': u'2014-10-01 00:00:00',
+                     'windspeed_mph': i % 40, 'windspeed_kts': i % 35, 'winddirection': (i*10) % 360,
+                     'temperature_c': i % 30 - 5 if i % 20 else None,
+                     'temperature_f': 32 + (i % 30 - 5)*9/5 if i % 20 else None,
+                     'relativehumidity': 20 + (i*7) % 81})
+    return rows
+
+def benchmarkSymbology(counts=(10000, 100000)):
+    '''
+    Compares styling the markers (fill colour and escaped popup text) of
+    each number of stations in counts row by row, as foliumMap.makeMap did
+    (scanning a dictionary of ranges for the colour), with symbology, which
+    styles them and makes their popups a column at a time (from the columns
+    of metarsqlite3db.returnMostRecent(returnColumns=True)).
+    '''
+    ranges = {'#4393C3': range(0,4), '#92C5DE': range(4,7), '#D1E5F0': range(7,10),
+              '#FDDBC7': range(10,13), '#F4A582': range(13,16), '#D6604D': range(16,19)}
+    def rowByRow(rows):
+        styles = []
+        for row in rows:
+            try:
+                popup = '%s, %s\nUTC %s\nWind speed: <b>%d mph</b>\nDirection: <b>%d degrees</b>\nTemperature: <b>%d C</b>' % (row['station'], row['label'], str(row['utc']), row['windspeed_mph'], row['winddirection'], row['temperature_c'])
+            except:
+                continue
+            for sc in [':',',','\n','-']:
+                popup = popup.replace(sc, '<br>' if sc == '\n' else '\\%s' % sc)
+            temp = row['temperature_c']
+            colour = '#2166AC' if temp < 0 else '#B2182B' if temp > 19 else None
+            for k in ranges:
+                if colour is None and temp in ranges[k]:
+                    colour = k
+            styles.append((popup, colour))
+        return styles
+    for n in counts:
+        rows = syntheticRows(n)
+        result, elapsed = timed(rowByRow, rows)
+        print 'row by row: {n} stations in {elapsed:.3f} s'.format(n=n, elapsed=elapsed)
+        data = m.columnArrays([tuple(row[name] for name, dtype in m.MOST_RECENT_SCHEMA) for row in rows])
+        styles, style = timed(symbology.style, data)
+        result, popups = timed(symbology.popups, data, styles['known'])
+        print 'vectorized: {n} stations in {elapsed:.3f} s (style {style:.4f} s, popups {popups:.3f} s)'.format(
+            n=n, elapsed=style+popups, style=style, popups=popups)
+    return None
+
+def resultSize(result):
+    '''Returns an estimate of the bytes held by a result of
+    metarsqlite3db.returnMostRecent: a list of dictionaries or tuples, or a
+    dictionary of arrays. Values shared between rows are counted each time.'''
+    if isinstance(result, dict):
+        size = sys.getsizeof(result)
+        for values in result.values():
+            size += values.nbytes
+            if values.dtype == object:
+                size += sum(sys.getsizeof(value) for value in values)
+        return size
+    size = sys.getsizeof(result)
+    for row in result:
+        size += sys.getsizeof(row)
+        size += sum(sys.getsizeof(value) for value in (row.values() if isinstance(row, dict) else row))
+    return size
+
+def benchmarkColumns(stations=100000, repeat=3):
+    '''
+    Compares the time and memory of the result of
+    metarsqlite3db.returnMostRecent as tuples, dictionaries and columns
+    (returnColumns), and of returnBoundingBox, on a database of a number of
+    synthetic stations observed in the last hour. The query cache is off,
+    except for the last comparison, of a cache miss and a hit.
+    '''
+    start = dt.datetime.utcnow() - dt.timedelta(hours=1)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        metardb = m.metarsqlite3db(os.path.join(tmpdir, 'bench.db'), tune=True, cacheSize=0)
+        metardb.addStations(syntheticStations(stations))
+        metardb.addObservations(syntheticObservations(stations, stations, start))
+        for name, kwargs in [('tuples', {}), ('dictionaries', {'returnDict': True}),
+                             ('columns', {'returnColumns': True})]:
+            elapsed = min(timed(metardb.returnMostRecent, **kwargs)[1] for i in range(repeat))
+            size = resultSize(metardb.returnMostRecent(**kwargs))
+            print '{name}: {stations} stations in {elapsed:.3f} s, about {size:.1f} MB'.format(
+                name=name, stations=stations, elapsed=elapsed, size=size/1048576.)
+        elapsed = min(timed(metardb.returnBoundingBox)[1] for i in range(repeat))
+        print 'returnBoundingBox: {elapsed:.3f} s'.format(elapsed=elapsed)
+        metardb.cacheSize = 32
+        result, miss = timed(metardb.returnMostRecent, returnColumns=True)
+        result, hit = timed(metardb.returnMostRecent, returnColumns=True)
+        print 'columns, cached: {miss:.3f} s, then {hit:.6f} s'.format(miss=miss, hit=hit)
+        metardb.conn.close()
+    finally:
+        shutil.rmtree(tmpdir)
+    return None
+
+# The latest observations of the stations in the last day, found by scanning
+# every row of the archive (as before the latest table), without any index:
+# the archive is read first (CROSS JOIN), each station looked up by its code
+ARCHIVE_SCAN = '''SELECT X(s.geom) AS X, Y(s.geom) AS Y, o.station, s.label, s.country,
+o.utc, o.windspeed_mph, o.windspeed_kts, o.winddirection, o.temperature_c,
+o.temperature_f, o.relativehumidity, MAX(o.obs_epoch)
+FROM metarvals AS o NOT INDEXED CROSS JOIN stations AS s ON s.station = o.station
+WHERE o.obs_epoch >= ? %s
+GROUP BY o.station;'''
+
+def benchmarkSpatial(rows=1000000, stations=10000, repeat=5):
+    '''
+    Compares the latency of viewport (bounding box) and radius queries that
+    use the spatial index of the stations table with the same queries
+    scanning the latest observation of every station (the latest table),
+    and scanning the whole archive of observations (ARCHIVE_SCAN), and the
+    extent computed by the database with min/max over the result in Python,
+    on an archive of rows synthetic observations (half-hourly, the last in
+    the last hour) of a number of stations. The query cache is off.
+    '''
+    start = dt.datetime.utcnow() - dt.timedelta(minutes=30*(rows // stations))
+    tmpdir = tempfile.mkdtemp()
+    try:
+        metardb = m.metarsqlite3db(os.path.join(tmpdir, 'bench.db'), tune=True, cacheSize=0)
+        metardb.addStations(syntheticStations(stations))
+        result, elapsed = timed(metardb.addObservations, syntheticObservations(rows, stations, start), 10000)
+        print 'archive: {rows} rows of {stations} stations written in {elapsed:.1f} s'.format(rows=rows, stations=stations, elapsed=elapsed)
+        bbox = ((165., -48.), (179., -34.))
+        scanBox = ('AND X(s.geom) BETWEEN ? AND ? AND Y(s.geom) BETWEEN ? AND ?', (165., 179., -48., -34.))
+        scanNear = ('AND Distance(s.geom, MakePoint(?, ?, 4326), 1) <= ?', (174.8, -41.3, 500000.))
+        def archiveScan(where, params):
+            return metardb.cur.execute(ARCHIVE_SCAN % where, (m.nDaysAgo(1),) + params).fetchall()
+        def pythonExtent():
+            result = metardb.queryMostRecent(None, 'tuples')
+            xs, ys = [row[0] for row in result], [row[1] for row in result]
+            return ((min(xs),min(ys)),(max(xs),max(ys)))
+        cases = [('bounding box, spatial index', lambda: metardb.returnWithin(bbox)),
+                 ('bounding box, scan of the latest table', lambda: metardb.queryMostRecent(None, 'tuples', *scanBox)),
+                 ('bounding box, scan of the archive', lambda: archiveScan(*scanBox)),
+                 ('500 km radius, spatial index', lambda: metardb.returnNear(174.8, -41.3, 500)),
+                 ('500 km radius, scan of the latest table', lambda: metardb.queryMostRecent(None, 'tuples', *scanNear)),
+                 ('500 km radius, scan of the archive', lambda: archiveScan(*scanNear)),
+                 ('extent, in SQL', metardb.returnBoundingBox),
+                 ('extent, in Python', pythonExtent)]
+        for name, query in cases:
+            result, elapsed = timed(query)
+            elapsed = min([elapsed] + [timed(query)[1] for i in range(repeat - 1)])
+            print '{name}: {elapsed:.4f} s ({n} results)'.format(name=name, elapsed=elapsed,
+                n=len(result) if isinstance(result, list) else 1)
+        metardb.conn.close()
+    finally:
+        shutil.rmtree(tmpdir)
+    return None
+
+def benchmarkHistory(stations=200, days=60, repeat=3):
+    '''
+    Compares hourly and daily history (min/mean/max temperature and wind
+    speed) aggregated by the database (metarsqlite3db.returnHistory) with
+    fetching the raw observations and aggregating them in Python, for
+    every station over an archive of half-hourly synthetic observations.
+    The query cache is off.
+    '''
+    start = dt.datetime(2014, 10, 1)
+    end = start + dt.timedelta(days=days)
+    rows = stations*days*48
+    measures = ('temperature_c', 'windspeed_mph')
+    tmpdir = tempfile.mkdtemp()
+    try:
+        metardb = m.metarsqlite3db(os.path.join(tmpdir, 'bench.db'), tune=True, cacheSize=0)
+        metardb.addStations(syntheticStations(stations))
+        metardb.addObservations(syntheticObservations(rows, stations, start), 10000)
+        def pythonHistory(size):
+            raw = metardb.cur.execute('''SELECT station, obs_epoch, temperature_c, windspeed_mph
+            FROM metarvals WHERE obs_epoch >= ? AND obs_epoch < ?;''', (m.epochTime(start), m.epochTime(end))).fetchall()
+            buckets = {}
+            for station, epoch, temperature, speed in raw:
+                buckets.setdefault((station, epoch // size*size), []).append((temperature, speed))
+            result = []
+            for key in sorted(buckets):
+                values = zip(*buckets[key])
+                row = list(key) + [len(values[0])]
+                for series in values:
+                    row += [min(series), sum(series)/float(len(series)), max(series)]
+                result.append(tuple(row))
+            return result
+        for bucket, size in [('hour', 3600), ('day', 86400)]:
+            cases = [('in SQL', lambda: metardb.returnHistory(None, start, end, bucket, measures)),
+                     ('in Python', lambda: pythonHistory(size))]
+            for name, query in cases:
+                result, elapsed = timed(query)
+                elapsed = min([elapsed] + [timed(query)[1] for i in range(repeat - 1)])
+                print 'history of {rows} rows by {bucket}, {name}: {elapsed:.3f} s ({n} buckets)'.format(
+                    rows=rows, bucket=bucket, name=name, elapsed=elapsed, n=len(result))
+        metardb.conn.close()
+    finally:
+        shutil.rmtree(tmpdir)
+    return None
+
+def benchmarkPartitions(stations=200, days=120, repeat=3):
+    '''
+    Times rolling an archive of half-hourly synthetic observations (up to
+    now) into monthly partitions (metarsqlite3db.rollPartitions), and compares the
+    daily history of every station and the latest observations before and
+    after. The query cache is off.
+    '''
+    end = dt.datetime.utcnow()
+    start = end - dt.timedelta(days=days)
+    rows = stations*days*48
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'bench.db')
+        metardb = m.metarsqlite3db(path, tune=True, cacheSize=0)
+        metardb.addStations(syntheticStations(stations))
+        metardb.addObservations(syntheticObservations(rows, stations, start), 10000)
+        cases = [('history by day', lambda: metardb.returnHistory(None, start, end, 'day')),
+                 ('most recent', lambda: metardb.queryMostRecent(None, 'tuples'))]
+        def run(label):
+            for name, query in cases:
+                result, elapsed = timed(query)
+                elapsed = min([elapsed] + [timed(query)[1] for i in range(repeat - 1)])
+                print '{name}, {label}: {elapsed:.4f} s'.format(name=name, label=label, elapsed=elapsed)
+        run('one table')
+        metardb.conn.close()
+        metardb = m.metarsqlite3db(path, tune=True, cacheSize=0, partition='month')
+        moved, elapsed = timed(metardb.rollPartitions)
+        print 'rolled {moved} of {rows} rows into {n} partitions in {elapsed:.1f} s'.format(moved=moved,
+            rows=rows, n=len(metardb.partitionsBetween(0, m.epochTime(end))), elapsed=elapsed)
+        run('partitioned')
+        metardb.conn.close()
+    finally:
+        shutil.rmtree(tmpdir)
+    return None
+
+def bestOf(repeat, function, setup=None):
+    '''Returns the result and the fewest seconds of repeat calls of
+    function(), each given the result of setup() (if any) as its argument,
+    which is not timed'''
+    best, result = None, None
+    for i in range(repeat):
+        argument = setup() if setup is not None else None
+        result, elapsed = timed(function, argument) if setup is not None else timed(function)
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+def suiteEnvironment():
+    '''Returns a dictionary of what a suite's results were measured with:
+    the commit (None outside a git checkout) and whether the checkout had
+    uncommitted changes, and the versions of Python and SQLite, and the
+    platform'''
+    here = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=here, stderr=subprocess.STDOUT).strip()
+        dirty = bool(subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=here).strip())
+    except (OSError, subprocess.CalledProcessError):
+        commit, dirty = None, None
+    return {'commit': commit, 'dirty': dirty, 'python': platform.python_version(),
+            'sqlite': m.dbapi.sqlite_version, 'platform': platform.platform(),
+            'date': dt.datetime.utcnow().isoformat() + 'Z'}
+
+def benchmarkSuite(counts=(10, 1000, 10000), repeat=3, concurrency=16, output=None, compare=None):
+    '''
+    Times, for synthetic networks of each number of stations in counts (see
+    standin.syntheticNetwork(): with restricted stations, times of 2400, calm winds
+    and stations without a locale), served by a local standin.standinServer:
+        harvest -- the end-to-end harvest of every listed station, from the
+                   listing (main.getStations) to a new database
+        parse -- METARTxtFile's parse of every file, from memory
+        ingest -- writing the parsed stations and observations to a new
+                  database (metarsqlite3db.addStations and addObservations)
+        mostRecent -- metarsqlite3db.returnMostRecent(returnColumns=True),
+                      without the query cache
+        makeMap -- foliumMap.makeMap, as main.main() makes it
+    Each is the best of repeat runs, to be steady from run to run; the data
+    depend only on the number of stations and the hour of the run.
+
+    Input:
+    counts -- default (10, 1000, 10000), the numbers of stations
+    repeat -- default 3, the runs of each measure
+    concurrency -- default 16, the stations retrieved at the same time
+    output -- default None, a path to write the results to as JSON, with
+              the commit and versions they were measured with (see
+              suiteEnvironment())
+    compare -- default None, the path of the results of an earlier run
+               (e.g. of another commit) to compare these with
+    Output:
+    A dictionary of environment (see suiteEnvironment()), results: a list
+    of dictionaries of stations, measure, seconds and rate (stations per
+    second), and errors: a list of the harvests that did not fail the
+    restricted stations, and only them.
+    '''
+    start = dt.datetime.utcnow().replace(minute=0, second=0, microsecond=0)
+    results = []
+    errors = []
+    def record(n, measure, seconds):
+        results.append({'stations': n, 'measure': measure, 'seconds': seconds,
+                        'rate': n/seconds if seconds > 0 else 0.})
+        print '{n} stations, {measure}: {seconds:.3f} s ({rate:.0f} stations/second)'.format(n=n, measure=measure, seconds=seconds, rate=results[-1]['rate'])
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for n in counts:
+            files, forbidden = standin.syntheticNetwork(n, start)
+            server = standin.standinServer(files, forbidden)
+            server.start()
+            databases = iter(range(repeat*3))
+            def newDatabase():
+                return m.metarsqlite3db(os.path.join(tmpdir, 'suite%d-%d.db' % (n, next(databases))), cacheSize=0)
+            try:
+                def harvest(metardb):
+                    stations = m.getStations(source=server.source)
+                    stats = m.metarHarvester(metardb, concurrency=concurrency, source=server.source).harvest(stations)
+                    metardb.conn.close()
+                    return stats
+                stats, seconds = bestOf(repeat, harvest, newDatabase)
+                if sorted(stats['failed']) != sorted(forbidden):
+                    errors.append('{n} stations: expected {expected} stations to fail, not {failed}'.format(n=n, expected=len(forbidden), failed=len(stats['failed'])))
+                    print errors[-1]
+                record(n, 'harvest', seconds)
+            finally:
+                server.stop()
+            corpus = [(station, text.splitlines(True)) for station, text in sorted(files.items())]
+            def parse():
+                values = []
+                for station, lines in corpus:
+                    metar = m.METARTxtFile(station, dataList=lines)
+                    values.append((metar.stationValues(), metar.observationValues()))
+                return values
+            values, seconds = bestOf(repeat, parse)
+            record(n, 'parse', seconds)
+            def ingest(metardb):
+                metardb.addStations([stationValues for stationValues, observation in values if stationValues is not None])
+                metardb.addObservations([observation for stationValues, observation in values])
+                return metardb
+            metardb, seconds = bestOf(repeat, ingest, newDatabase)
+            record(n, 'ingest', seconds)
+            result, seconds = bestOf(repeat, lambda: metardb.returnMostRecent(returnColumns=True))
+            record(n, 'mostRecent', seconds)
+            mapName = os.path.join(tmpdir, 'suite%d.html' % n)
+            result, seconds = bestOf(repeat, lambda: m.foliumMap(metardb, mapName, 'Mapbox Bright').makeMap(point=False, levels=range(0, 6)))
+            record(n, 'makeMap', seconds)
+            metardb.conn.close()
+    finally:
+        shutil.rmtree(tmpdir)
+    suite = {'environment': suiteEnvironment(), 'results': results, 'errors': errors}
+    if output is not None:
+        with open(output, 'w') as f:
+            json.dump(suite, f, indent=2, sort_keys=True)
+    if compare is not None:
+        with open(compare) as f:
+            baseline = json.load(f)
+        print 'Compared with {commit} ({date}):'.format(commit=(baseline['environment']['commit'] or 'unknown')[:10], date=baseline['environment']['date'])
+        before = dict(((result['stations'], result['measure']), result['seconds']) for result in baseline['results'])
+        for result in results:
+            seconds = before.get((result['stations'], result['measure']))
+            if seconds:
+                print '    {stations} stations, {measure}: {before:.3f} s -> {seconds:.3f} s ({ratio:.2f}x)'.format(before=seconds, ratio=result['seconds']/seconds, **result)
+    return suite
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark METAR-vis on synthetic data, without the network.')
+    parser.add_argument('--suite', action='store_true', help='run only the suite (benchmarkSuite)')
+    parser.add_argument('--counts', type=int, nargs='+', default=[10, 1000, 10000], help='the numbers of stations of the suite (default 10 1000 10000)')
+    parser.add_argument('--repeat', type=int, default=3, help='the runs of each measure of the suite (default 3)')
+    parser.add_argument('--output', default=None, help='write the results of the suite to this path as JSON')
+    parser.add_argument('--compare', default=None, help='compare the results of the suite with these earlier results')
+    args = parser.parse_args()
+    def suite():
+        '''Runs the suite, returning the exit status: 1 if a harvest failed
+        other stations than the restricted ones'''
+        return 1 if benchmarkSuite(args.counts, args.repeat, output=args.output, compare=args.compare)['errors'] else 0
+    if args.suite:
+        return suite()
+    benchmarkStartup()
+    benchmarkParse()
+    benchmarkIngest()
+    benchmarkBulkIngest()
+    benchmarkFetchCache()
+    benchmarkCycles()
+    benchmarkPipeline()
+    benchmarkKnown()
+    benchmarkMap()
+    benchmarkLevels()
+    benchmarkOverlay()
+    benchmarkSymbology()
+    benchmarkColumns()
+    benchmarkSpatial()
+    benchmarkHistory()
+    benchmarkPartitions()
+    return suite()
+
+if __name__ == '__main__':
+    sys.exit(main())
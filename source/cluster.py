@@ -0,0 +1,237 @@
+# /usr/bin/env python
+'''
+cluster
+-------
+
+Level-of-detail clustering of the latest observations for the Leaflet map.
+
+At low zooms, plotting every station means thousands of markers on top of
+each other. Instead, the stations are binned into a grid of square cells in
+Web Mercator, one grid per zoom level (the cells being a fixed number of
+screen pixels across at that zoom), and each non-empty cell is summarised as
+one cluster: how many stations it holds, their mean, minimum and maximum
+temperature, mean wind speed, and dominant (speed-weighted mean) wind
+direction. Each cluster is coloured by the mean of the column the map is
+coloured by (see main.foliumMap.makeMap).
+
+The grouping is done with NumPy over the whole result set at once, so its
+cost grows with the number of stations, not the number of cells.
+
+Each level is written to its own sidecar .js file, which the map loads only
+when it is zoomed to that level; past the last level, the map shows the
+station markers (see mapdata) instead.
+
+'''
+
+import os
+import math
+import numpy as np
+
+import mapdata
+
+# The columns of each row of a level's payload
+COLUMNS = ['lon', 'lat', 'count', 'temperature_mean', 'temperature_min',
+           'temperature_max', 'windspeed_mean', 'winddirection', 'colour']
+
+# Swaps between the cluster levels and metarStations as the map is zoomed,
+# loading each level's sidecar file the first time it is needed
+LEVELS_JS = '''
+(function (minZoom, maxZoom, prefix) {
+    var clusters = L.layerGroup(), levels = {}, requested = {}, shown;
+    function escape(s) {
+        return String(s).replace(/&/g, '&amp;').replace(/</g, '&lt;').replace(/>/g, '&gt;');
+    }
+    function draw() {
+        var zoom = map.getZoom(), level = zoom > maxZoom ? null : Math.max(zoom, minZoom);
+        if (level === shown) { return; }
+        if (level === null) {
+            map.removeLayer(clusters);
+            map.addLayer(metarStations);
+            shown = null;
+            return;
+        }
+        if (!(level in levels)) {
+            if (!requested[level]) {
+                requested[level] = true;
+                var script = document.createElement('script');
+                script.src = prefix + level + '.js';
+                document.body.appendChild(script);
+            }
+            return; // Drawn when it has loaded
+        }
+        var data = levels[level], c = {};
+        for (var i = 0; i < data.columns.length; i++) { c[data.columns[i]] = i; }
+        clusters.clearLayers();
+        for (var i = 0; i < data.rows.length; i++) {
+            var r = data.rows[i], colour = data.colours[r[c.colour]];
+            var marker = L.circleMarker(new L.LatLng(r[c.lat], r[c.lon]), {color: 'black',
+                weight: 1, fillColor: colour, fillOpacity: 0.8,
+                radius: 6 + 3*Math.log(r[c.count])/Math.LN2});
+            marker.bindPopup('<b>' + r[c.count] + ' stations</b>' +
+                '<br>Temperature: <b>' + escape(r[c.temperature_mean]) + ' C</b> (' +
+                escape(r[c.temperature_min]) + ' to ' + escape(r[c.temperature_max]) + ')' +
+                '<br>Wind speed: <b>' + escape(r[c.windspeed_mean]) + ' mph</b>' +
+                '<br>Direction: <b>' + escape(r[c.winddirection]) + ' degrees</b>');
+            clusters.addLayer(marker);
+        }
+        map.removeLayer(metarStations);
+        map.addLayer(clusters);
+        shown = level;
+    }
+    window.metarLevel = function (level, data) {
+        levels[level] = data;
+        shown = undefined;
+        draw();
+    };
+    map.on('zoomend', draw);
+    draw();
+})(%(minZoom)d, %(maxZoom)d, '%(prefix)s');
+'''
+
+def mercator(lon, lat):
+    '''Returns arrays of the Web Mercator x and y of arrays of longitudes and
+    latitudes, scaled to the unit square (0, 0 at the top left).'''
+    lat = np.clip(lat, -85.0511, 85.0511)
+    x = (lon + 180.)/360.
+    y = 0.5 - np.log(np.tan(np.pi/4 + np.radians(lat)/2))/(2*np.pi)
+    return x, y
+
+def groupStats(groups, n, values, reduce):
+    '''Returns an array of reduce (e.g. np.fmin) over values for each of n
+    groups, where groups gives the group (0 to n-1) of each value.
+    NaN values are ignored; groups with only NaN values give NaN.'''
+    order = np.argsort(groups, kind='mergesort')
+    starts = np.searchsorted(groups[order], np.arange(n))
+    return reduce.reduceat(values[order], starts)
+
+def groupMean(groups, n, values):
+    '''Returns an array of the mean of values for each of n groups, where
+    groups gives the group (0 to n-1) of each value.
+    NaN values are ignored; groups with only NaN values give NaN.'''
+    known = ~np.isnan(values)
+    total = np.bincount(groups, weights=np.where(known, values, 0), minlength=n)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return total/np.bincount(groups, weights=known, minlength=n)
+
+def clusterLevel(x, y, lon, lat, temperature, speed, direction, zoom, cellPixels=64, colour=None):
+    '''
+    Returns a dictionary of arrays, one per COLUMNS (but colour), of the
+    clusters of the stations at a zoom level, and, with colour, colour_mean.
+
+    Input:
+    x, y -- arrays of the stations' Web Mercator coordinates (from mercator())
+    lon, lat -- arrays of the stations' coordinates
+    temperature, speed, direction -- arrays of the stations' temperature (C),
+                                     wind speed (mph) and wind direction
+                                     (degrees). NaN marks a missing value.
+    zoom -- the zoom level
+    cellPixels -- default 64, the width of each grid cell in screen pixels
+    colour -- default None, an array of the values the clusters are coloured
+              by (NaN marks a missing value): the mean of each cluster's is
+              returned as colour_mean
+    '''
+    cells = 256*2**zoom/float(cellPixels) # Across the world
+    width = int(math.ceil(cells))
+    # x or y of 1.0 (the antimeridian, or -85.05 degrees) is in the last
+    # cell, not one past it, which would be the first of the next column
+    column = np.clip(np.floor(x*cells).astype(np.int64), 0, width - 1)
+    row = np.clip(np.floor(y*cells).astype(np.int64), 0, width - 1)
+    keys, groups = np.unique(column*width + row, return_inverse=True)
+    n = len(keys)
+    count = np.bincount(groups, minlength=n)
+    windy = ~(np.isnan(speed) | np.isnan(direction))
+    speed = np.where(windy, speed, 0)
+    radians = np.radians(np.where(windy, direction, 0))
+    windCount = np.bincount(groups, weights=windy, minlength=n)
+    # Wind is summed as vectors, so opposing winds cancel and strong winds dominate
+    u = np.bincount(groups, weights=speed*np.sin(radians), minlength=n)
+    v = np.bincount(groups, weights=speed*np.cos(radians), minlength=n)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        speedMean = np.bincount(groups, weights=speed, minlength=n)/windCount
+    winddirection = np.degrees(np.arctan2(u, v)) % 360
+    winddirection[windCount == 0] = np.nan
+    level = {'lon': np.bincount(groups, weights=lon, minlength=n)/count,
+             'lat': np.bincount(groups, weights=lat, minlength=n)/count,
+             'count': count,
+             'temperature_mean': groupMean(groups, n, temperature),
+             'temperature_min': groupStats(groups, n, temperature, np.fmin),
+             'temperature_max': groupStats(groups, n, temperature, np.fmax),
+             'windspeed_mean': speedMean,
+             'winddirection': winddirection}
+    if colour is not None:
+        level['colour_mean'] = groupMean(groups, n, colour)
+    return level
+
+def columns(data, colourBy='temperature_c'):
+    '''Returns a dictionary of the lon, lat, temperature, speed and direction
+    arrays of data (a dictionary of arrays, from
+    metarsqlite3db.returnMostRecent(returnColumns=True)), and as colour, the
+    array of its column colourBy (default 'temperature_c')'''
+    keys = [('lon', 'X'), ('lat', 'Y'), ('temperature', 'temperature_c'),
+            ('speed', 'windspeed_mph'), ('direction', 'winddirection'),
+            ('colour', colourBy)]
+    return dict((name, data[key]) for name, key in keys)
+
+def jsonValues(values, decimals=2):
+    '''Returns a list of an array's values rounded to decimals, with None for NaN'''
+    values = np.round(values, decimals)
+    return np.where(np.isnan(values), None, values).tolist()
+
+def levels(data, classification, zooms=range(0, 6), cellPixels=64):
+    '''
+    Returns a dictionary of zoom: payload of the clusters at each zoom level.
+    Each payload is a dictionary of columns (COLUMNS), colours (the palette
+    of the fill colours) and rows, as in mapdata.payload.
+
+    Input:
+    data -- a dictionary of arrays of lon, lat, temperature, speed,
+            direction and colour (the values the clusters are coloured by),
+            as from columns(). Without colour, they are coloured by
+            temperature.
+    classification -- a symbology.classification of the mean of colour
+    zooms -- default 0 to 5, the zoom levels to cluster
+    cellPixels -- default 64, the width of each grid cell in screen pixels
+    '''
+    located = ~(np.isnan(data['lon']) | np.isnan(data['lat']))
+    data = dict((name, values[located]) for name, values in data.items())
+    x, y = mercator(data['lon'], data['lat'])
+    payloads = {}
+    for zoom in zooms:
+        level = clusterLevel(x, y, data['lon'], data['lat'], data['temperature'],
+                             data['speed'], data['direction'], zoom, cellPixels,
+                             data.get('colour', data['temperature']))
+        fills = classification.classify(np.round(level['colour_mean']))
+        values = [jsonValues(level['lon'], 4), jsonValues(level['lat'], 4),
+                  level['count'].tolist()]
+        values += [jsonValues(level[name], 1) for name in COLUMNS[3:-1]]
+        payloads[zoom] = {'columns': COLUMNS, 'colours': classification.palette,
+                          'rows': [list(row) for row in zip(*(values + [fills.tolist()]))]}
+    return payloads
+
+def levelPrefix(mapName):
+    '''Returns the path, less the zoom level and extension, of the sidecar
+    files of the cluster levels of the map at mapName'''
+    return os.path.splitext(mapName)[0] + '.level'
+
+def writeLevels(payloads, prefix):
+    '''Writes each level's payload to prefix + zoom + '.js', as a script
+    handing it to the map'''
+    for zoom, data in payloads.items():
+        with open('%s%d.js' % (prefix, zoom), 'w') as f:
+            f.write('metarLevel(%d, %s);\n' % (zoom, mapdata.dumps(data)))
+    return None
+
+def script(zooms, prefix):
+    '''
+    Returns the HTML to add to the end of the map's body, after the station
+    markers (mapdata.script), to show the cluster levels.
+
+    Input:
+    zooms -- the zoom levels that have been clustered, which must be a
+             continuous range. Below it, the lowest level is shown; above it,
+             the stations.
+    prefix -- the path, relative to the HTML, of the levels' sidecar files
+              (as written by writeLevels)
+    '''
+    return '<script>%s</script>\n' % (LEVELS_JS % {'minZoom': min(zooms),
+        'maxZoom': max(zooms), 'prefix': prefix})
@@ -0,0 +1,279 @@
+# /usr/bin/env python
+'''
+fetch
+-------
+
+Conditional, cached retrieval of the NOAA METAR files.
+
+The last body, Last-Modified and ETag of each URL are kept on disk, and sent
+back to the server with the next request so that it can answer 304 Not
+Modified. Callers are told whether the body has changed since it was last
+retrieved (by either a 304, or an identical SHA-1 of a full response), so
+they can skip parsing and storing data they already have.
+
+NOTE: the cache only knows what has been retrieved, not what has been
+stored. A harvest defers saving each response until its observation has
+been written (see httpCache.commit()), so that a run that fails part way
+does not leave files looking unchanged that were never stored; but if the
+database is replaced, clear the cache directory too.
+
+Also keeps a persisted index of the stations in the NOAA directory listing,
+so that station codes can be validated without a request each.
+
+'''
+
+import os
+import re
+import json
+import time
+import hashlib
+import threading
+import urllib2
+
+NOAA_SOURCE = 'http://weather.noaa.gov/pub/data/observations/metar/decoded/'
+# The hourly cycle files of raw reports, 00Z.TXT to 23Z.TXT (see metarcode)
+CYCLES_SOURCE = 'http://weather.noaa.gov/pub/data/observations/metar/cycles/'
+STATION_HREF = re.compile(r'href="([^"]*\.TXT[^"]*)"')
+
+class httpCache:
+    '''
+    An on-disk cache of responses, one pair of files per URL in a directory:
+    the body, and a JSON file of its ETag, Last-Modified and SHA-1.
+    Safe to use from many threads at once.
+    '''
+    def __init__(self, directory='./data/httpcache', timeout=10):
+        '''
+        Input:
+        directory -- default './data/httpcache', where the responses are kept.
+                     It is created if it does not exist.
+        timeout -- default 10, seconds to wait for each request.
+        '''
+        self.directory = directory
+        self.timeout = timeout
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self.lock = threading.Lock()
+        self.stats = {'fetched': 0, 'notmodified': 0, 'unchanged': 0}
+        self.pending = {} # URL: (body, headers) of deferred responses, see self.commit()
+
+    def paths(self, url):
+        '''Returns the paths of the body and metadata files of url'''
+        key = hashlib.sha1(url).hexdigest()
+        base = os.path.join(self.directory, key)
+        return base + '.body', base + '.json'
+
+    def count(self, key):
+        '''Adds one to self.stats[key]'''
+        with self.lock:
+            self.stats[key] += 1
+
+    def metadata(self, url):
+        '''Returns the stored metadata dictionary of url, or an empty one'''
+        body, meta = self.paths(url)
+        try:
+            with open(meta) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def cached(self, url):
+        '''Returns the stored body of url, or None if there is none'''
+        body, meta = self.paths(url)
+        try:
+            with open(body, 'rb') as f:
+                return f.read()
+        except IOError:
+            return None
+
+    def store(self, url, text, headers):
+        '''Stores the body and validators of a response. Each file is written
+        to a temporary name and renamed, so readers never see half a file.'''
+        body, meta = self.paths(url)
+        metadata = {'url': url, 'sha1': hashlib.sha1(text).hexdigest(),
+                    'etag': headers.get('ETag'),
+                    'last_modified': headers.get('Last-Modified')}
+        for path, content in [(body, text), (meta, json.dumps(metadata))]:
+            tmp = '%s.%s.tmp' % (path, threading.current_thread().ident)
+            with open(tmp, 'wb') as f:
+                f.write(content)
+            os.rename(tmp, path)
+        return None
+
+    def commit(self, urls):
+        '''Stores the deferred responses of urls (see self.fetch()), once
+        what was retrieved has been stored'''
+        for url in urls:
+            with self.lock:
+                response = self.pending.pop(url, None)
+            if response is not None:
+                self.store(url, *response)
+        return None
+
+    def discard(self, urls=None):
+        '''Forgets the deferred responses of urls (None for every one), so
+        that they are retrieved in full next time'''
+        with self.lock:
+            if urls is None:
+                self.pending.clear()
+            for url in urls or ():
+                self.pending.pop(url, None)
+        return None
+
+    def fetch(self, url, timeout=None, defer=False):
+        '''Retrieves url, sending the stored validators (if any) so the server
+        can reply 304 Not Modified.
+
+        Input:
+        url -- the URL to retrieve
+        timeout -- default None, seconds to wait; if None, self.timeout is used.
+        defer -- Boolean (default False), keep a full response in memory
+                 rather than storing it, until self.commit() (or
+                 self.discard()) is called with url: until then, it is not
+                 seen as unchanged by the next request.
+        Output:
+        A (body, changed) tuple. body is the text of the response (from the
+        cache, on a 304), and changed is False if it is identical to the body
+        last retrieved.
+        HTTP errors other than 304 are raised as urllib2.HTTPError.'''
+        metadata = self.metadata(url)
+        request = urllib2.Request(url)
+        if metadata.get('etag'):
+            request.add_header('If-None-Match', metadata['etag'])
+        if metadata.get('last_modified'):
+            request.add_header('If-Modified-Since', metadata['last_modified'])
+        try:
+            response = urllib2.urlopen(request, timeout=timeout or self.timeout)
+        except urllib2.HTTPError, e:
+            if e.code == 304:
+                text = self.cached(url)
+                if text is not None:
+                    self.count('notmodified')
+                    return text, False
+                # The body has gone missing: ask again, unconditionally
+                os.remove(self.paths(url)[1])
+                return self.fetch(url, timeout, defer)
+            raise
+        try:
+            text = response.read()
+            headers = response.info()
+        finally:
+            response.close()
+        if metadata.get('sha1') == hashlib.sha1(text).hexdigest():
+            self.count('unchanged')
+            changed = False
+        else:
+            self.count('fetched')
+            changed = True
+        if defer:
+            with self.lock:
+                self.pending[url] = (text, headers)
+        else:
+            self.store(url, text, headers)
+        return text, changed
+
+def parseListing(chunks):
+    '''Returns a list of the station codes linked to from a directory listing
+    of .TXT files, given as an iterable of chunks of its HTML. The chunks are
+    scanned as they arrive, without building a document tree, so a response
+    can be parsed while it downloads.'''
+    stations, tail = [], ''
+    for chunk in chunks:
+        lines = (tail + chunk).split('\n')
+        tail = lines.pop() # May be cut off part way through a link
+        for line in lines:
+            stations.extend(href.split('.')[0] for href in STATION_HREF.findall(line))
+    stations.extend(href.split('.')[0] for href in STATION_HREF.findall(tail))
+    return stations
+
+def readChunks(response, size=65536):
+    '''Yields the body of a response in chunks of size bytes'''
+    while True:
+        chunk = response.read(size)
+        if not chunk:
+            return
+        yield chunk
+
+def listStations(source=NOAA_SOURCE, cache=None, timeout=30):
+    '''Returns a list of the station codes in the directory listing at source.
+
+    Input:
+    source -- the directory URL listing the .TXT files.
+    cache -- default None, an httpCache to retrieve the listing through.
+    timeout -- default 30, seconds to wait for the listing.'''
+    if cache is not None:
+        return parseListing([cache.fetch(source, timeout)[0]])
+    response = urllib2.urlopen(source, timeout=timeout)
+    try:
+        return parseListing(readChunks(response))
+    finally:
+        response.close()
+
+class stationIndex:
+    '''
+    The station codes of the directory listing, persisted to a JSON file and
+    refreshed from the listing when they are older than a time-to-live.
+    Supports `station in index`, without any requests once loaded.
+    '''
+    def __init__(self, path='./data/stations.json', ttl=86400, source=NOAA_SOURCE, timeout=30):
+        '''
+        Input:
+        path -- default './data/stations.json', where the index is kept.
+        ttl -- default 86400 (a day), seconds before the index is refreshed.
+        source -- the directory URL listing the .TXT files.
+        timeout -- default 30, seconds to wait for the listing.
+        '''
+        self.path = path
+        self.ttl = ttl
+        self.source = source
+        self.timeout = timeout
+        self.codes = None # Loaded when first needed
+        self.updated = None
+
+    def read(self):
+        '''Loads the persisted index, if it exists and is for self.source'''
+        try:
+            with open(self.path) as f:
+                index = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if index.get('source') == self.source:
+            self.codes = set(str(code) for code in index['stations'])
+            self.updated = index['updated']
+        return None
+
+    def refresh(self):
+        '''Rebuilds the index from the directory listing and persists it'''
+        codes = listStations(self.source, timeout=self.timeout)
+        self.codes, self.updated = set(codes), time.time()
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'source': self.source, 'updated': self.updated,
+                       'stations': sorted(self.codes)}, f)
+        os.rename(tmp, self.path)
+        return None
+
+    def load(self):
+        '''Makes sure the index is loaded and no older than self.ttl. If it
+        cannot be refreshed, an out of date index is used rather than none;
+        with no index at all, the error is raised.'''
+        if self.codes is None:
+            self.read()
+        if self.codes is None or time.time() - self.updated > self.ttl:
+            try:
+                self.refresh()
+            except (urllib2.URLError, IOError):
+                if self.codes is None:
+                    raise
+        return None
+
+    def stations(self):
+        '''Returns a sorted list of all of the station codes'''
+        self.load()
+        return sorted(self.codes)
+
+    def __contains__(self, station):
+        self.load()
+        return station in self.codes
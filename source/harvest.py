@@ -0,0 +1,84 @@
+# /usr/bin/env python
+'''
+METAR-vis harvest
+-------
+
+Harvests the stations' observations into the database once, without making
+a map: the entry point for cron, e.g. every 30 minutes. Only the fetch,
+parse and storage layers are imported (Folium, NumPy and the GUI toolkits
+are not), so that the start-up of a short run is not spent importing them
+(see benchmark.benchmarkStartup).
+
+Where the time goes can be written after each run as a JSON report (--report),
+a Prometheus text file for node_exporter's textfile collector (--prometheus),
+and a cProfile profile next to the report (--profile); see
+pipeline.instrumentedRun().
+
+Usage: `python source/harvest.py [STATION ...] [--database ./data/metar.db] [--cycles] [--verbose] [--report ./data/harvest.json] [--prometheus PATH.prom] [--profile]`
+
+'''
+
+import argparse
+
+import main as m
+import fetch
+import pipeline
+
+def harvest(stations=None, database='./data/metar.db', cycles=False, concurrency=8, timeout=10, retries=2, cache='./data/httpcache', verbose=False, report=None, prometheus=None, profile=False):
+    '''
+    Harvests stations into database, returning the harvest's statistics
+    (see main.metarHarvester.harvest() and harvestCycles()).
+
+    Input:
+    stations -- default None, a list of station codes. None harvests every
+                station in the index of NOAA's listing (fetch.stationIndex).
+    database -- default './data/metar.db', the path of the database
+    cycles -- Boolean (default False), read the hourly cycle files rather
+              than each station's .TXT file (see main.main())
+    concurrency -- default 8, the stations retrieved at the same time
+    timeout -- default 10, seconds to wait for each request
+    retries -- default 2, times a failed request is repeated
+    cache -- default './data/httpcache', the directory of the cache of
+             retrieved files (None to disable)
+    verbose -- Boolean (default False), prints the stations retrieved and
+               the statistics
+    report -- default None, a path to write the JSON report of the run to
+    prometheus -- default None, a path to write the report to in the
+                  Prometheus text format
+    profile -- Boolean (default False), profile the run with cProfile,
+               writing the profile next to the report
+    '''
+    def run():
+        codes = stations if stations is not None else fetch.stationIndex().stations()
+        httpCache = fetch.httpCache(cache, timeout=timeout) if cache is not None else None
+        metardb = m.metarsqlite3db(database)
+        harvester = m.metarHarvester(metardb, concurrency=concurrency, timeout=timeout, retries=retries, verbose=verbose, cache=httpCache)
+        try:
+            if cycles:
+                return harvester.harvestCycles(codes)
+            return harvester.harvest(codes)
+        finally:
+            metardb.conn.close()
+    return pipeline.instrumentedRun('harvest', run, report, prometheus, profile)
+
+def main():
+    parser = argparse.ArgumentParser(description='Harvest METAR observations into the database, without making a map.')
+    parser.add_argument('stations', nargs='*', help='station codes (default: every station NOAA lists)')
+    parser.add_argument('--database', default='./data/metar.db', help='the database (default ./data/metar.db)')
+    parser.add_argument('--cycles', action='store_true', help='read the hourly cycle files rather than each station\'s file')
+    parser.add_argument('--concurrency', type=int, default=8, help='stations retrieved at the same time (default 8)')
+    parser.add_argument('--timeout', type=float, default=10, help='seconds to wait for each request (default 10)')
+    parser.add_argument('--retries', type=int, default=2, help='times a failed request is repeated (default 2)')
+    parser.add_argument('--cache', default='./data/httpcache', help='the cache of retrieved files (default ./data/httpcache)')
+    parser.add_argument('--no-cache', action='store_true', help='do not cache retrieved files')
+    parser.add_argument('--verbose', action='store_true', help='print the stations retrieved and the statistics')
+    parser.add_argument('--report', default=None, help='write a JSON report of the run to this path')
+    parser.add_argument('--prometheus', default=None, help='write the report in the Prometheus text format to this path (e.g. a .prom file in node_exporter\'s textfile directory)')
+    parser.add_argument('--profile', action='store_true', help='profile the run with cProfile, writing the profile next to the report')
+    args = parser.parse_args()
+    harvest(args.stations or None, args.database, args.cycles, args.concurrency, args.timeout,
+            args.retries, None if args.no_cache else args.cache, args.verbose,
+            args.report, args.prometheus, args.profile)
+
+if __name__ == '__main__':
+    main()
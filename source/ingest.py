@@ -0,0 +1,171 @@
+# /usr/bin/env python
+'''
+METAR-vis ingest
+-------
+
+Loads observations from local copies of NOAA's files, without the network:
+a directory, a tar archive (compressed or not) or a gzip file of decoded
+station files (XXXX.TXT) and hourly cycle files of raw reports (NNZ.TXT, see
+metarcode), e.g. to backfill years of archived reports into the database.
+
+The files are streamed through generator stages, one file at a time:
+
+    read -> parse -> dedupe -> batch -> write
+
+so the memory used depends on the batch size and the number of stations,
+not on the size of the archive. Each batch is written to the database in
+one transaction.
+
+Usage: `python source/ingest.py ARCHIVE [--database ./data/metar.db] [--batch-size 1000]`
+
+'''
+
+import os
+import re
+import gzip
+import time
+import tarfile
+import argparse
+import datetime as dt
+from collections import deque
+
+import main as m
+import metarcode
+
+# The name of a cycle file; any other .TXT file is a station's decoded file
+CYCLE_NAME = re.compile(r'^\d\dZ\.TXT$')
+
+def readArchive(path):
+    '''
+    Yields a (name, modified, text) tuple for each .TXT file in path: its
+    file name, the UNIX time it was last modified, and its contents.
+
+    Input:
+    path -- a directory (searched recursively, in name order), a tar archive
+            (read as a stream, so it can be compressed), a gzip file of a
+            single file (named as the gzip file, less .gz), or a file
+    '''
+    if os.path.isdir(path):
+        for directory, dirs, names in os.walk(path):
+            dirs.sort()
+            for name in sorted(names):
+                if name.upper().endswith('.TXT'):
+                    filePath = os.path.join(directory, name)
+                    with open(filePath, 'rb') as f:
+                        yield name, os.path.getmtime(filePath), f.read()
+    elif tarfile.is_tarfile(path):
+        archive = tarfile.open(path, 'r|*')
+        try:
+            for member in archive:
+                name = os.path.basename(member.name)
+                if member.isfile() and name.upper().endswith('.TXT'):
+                    yield name, member.mtime, archive.extractfile(member).read()
+        finally:
+            archive.close()
+    elif path.endswith('.gz'):
+        f = gzip.open(path, 'rb')
+        try:
+            yield os.path.basename(path[:-3]), os.path.getmtime(path), f.read()
+        finally:
+            f.close()
+    else:
+        with open(path, 'rb') as f:
+            yield os.path.basename(path), os.path.getmtime(path), f.read()
+
+def parseFiles(files, stats):
+    '''
+    Yields a (stationValues, observationValues) tuple for each observation
+    in files (from readArchive()), as from METARTxtFile.stationValues() and
+    METARTxtFile.observationValues(). Observations from cycle files have no
+    station values (None). Files and reports that cannot be parsed are
+    counted in stats['failed'].
+    '''
+    for name, modified, text in files:
+        stats['files'] += 1
+        if CYCLE_NAME.match(name.upper()):
+            observations, failed = metarcode.cycleObservations(text, cycle=dt.datetime.utcfromtimestamp(modified))
+            stats['failed'] += len(failed)
+            for values in observations:
+                yield None, values
+            continue
+        try:
+            metar = m.METARTxtFile(os.path.splitext(name)[0].upper(), dataList=text.splitlines(True))
+            yield metar.stationValues(), metar.observationValues()
+        except Exception:
+            stats['failed'] += 1
+
+def dedupe(records, stats, window=8):
+    '''
+    Yields the records (from parseFiles()) whose observation has not been
+    seen in the stream already, e.g. a report in two overlapping cycle
+    files, counting the rest in stats['duplicates']. Only the last window
+    observation times of each station are remembered, so that memory is
+    bounded by the number of stations; the database ignores any older
+    duplicates.
+    '''
+    seen = {} # station: deque of its last observation times
+    for stationValues, values in records:
+        station, epoch = values[0], values[2]
+        recent = seen.get(station)
+        if recent is None:
+            recent = seen[station] = deque(maxlen=window)
+        elif epoch in recent:
+            stats['duplicates'] += 1
+            continue
+        recent.append(epoch)
+        yield stationValues, values
+
+def batches(records, size=1000):
+    '''Yields lists of up to size records'''
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def ingest(path, metardb, batchsize=1000, verbose=False):
+    '''
+    Streams the files in path (see readArchive()) into metardb, writing the
+    stations (new, or whose locale has changed) and observations (new) of
+    each batch in one transaction each.
+
+    Input:
+    path -- a directory, tar archive, gzip file or file of decoded .TXT
+            files and cycle files
+    metardb -- a main.metarsqlite3db object
+    batchsize -- default 1000, the number of observations written at a time
+    verbose -- Boolean (default False), prints the statistics
+    Output:
+    A dictionary of statistics: files, observations (parsed, less the
+    duplicates), failed (files and reports that could not be parsed),
+    duplicates (observations seen already in path), added (new rows in the
+    database), elapsed (seconds) and rate (observations per second).
+    '''
+    stats = {'files': 0, 'observations': 0, 'failed': 0, 'duplicates': 0, 'added': 0}
+    start = time.time()
+    records = dedupe(parseFiles(readArchive(path), stats), stats)
+    for batch in batches(records, batchsize):
+        metardb.addStations([stationValues for stationValues, values in batch if stationValues is not None])
+        stats['added'] += metardb.addObservations([values for stationValues, values in batch], batchsize)
+        stats['observations'] += len(batch)
+    stats['elapsed'] = time.time() - start
+    stats['rate'] = stats['observations']/stats['elapsed'] if stats['elapsed'] > 0 else 0.
+    if verbose:
+        print 'Ingested {files} files in {elapsed:.1f} s ({rate:.0f} observations/second): {observations} observations, {added} new, {duplicates} duplicates, {failed} unparsable'.format(**stats)
+    return stats
+
+def main():
+    parser = argparse.ArgumentParser(description='Load METAR observations from a directory or archive of decoded .TXT files and cycle files.')
+    parser.add_argument('archive', help='a directory, tar archive (.tar, .tar.gz, .tgz), gzip file or file')
+    parser.add_argument('--database', default='./data/metar.db', help='the database (default ./data/metar.db)')
+    parser.add_argument('--batch-size', type=int, default=1000, help='observations written per transaction (default 1000)')
+    args = parser.parse_args()
+    metardb = m.metarsqlite3db(args.database, tune=True)
+    ingest(args.archive, metardb, args.batch_size, verbose=True)
+    metardb.conn.close()
+
+if __name__ == '__main__':
+    main()
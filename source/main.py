@@ -17,6 +17,11 @@ folium (and hence pandas, numpy and jinja2): pip install folium
 
 Other imported modules are all standard libraries
 
+Only the fetch, parse and storage layers are imported with this module, so
+that a harvest (see harvest.py) starts quickly: Folium, NumPy and the map
+modules are imported when a map is made (foliumMap), or the most recent
+observations are returned as columns (columnArrays).
+
 See ./requirements.txt for versions used when writing
 
 Author
@@ -30,62 +35,108 @@ Date
 '''
 
 import urllib2 # For acquring station data .TXT files
-import webbrowser # To see output
-import re # For matching patterns in the .TXT files to extract useful data
 import datetime as dt # For creating a datetime object of the observation time
 import calendar # To convert datetime to UNIX timestamp
+import math
 import os
 import time
+import socket # For catching request timeouts
+import threading # For fetching stations concurrently
+import Queue # For handing work between the fetching threads and the database writer
+from collections import OrderedDict # For the query cache
 
 from pyspatialite import dbapi2 as dbapi # For storage and retrieval of spatial and non-spatial data
-import folium # For building a Leaflet tile map
-from bs4 import BeautifulSoup
+
+import metarparse # For parsing the decoded METAR .TXT files
+import metarcode # For decoding the raw reports of the hourly cycle files
+import fetch # For conditional, cached retrieval of the .TXT files
+import pipeline # For the stages of the harvest, and the metrics of a run
+
+NOAA_SOURCE = fetch.NOAA_SOURCE
+CYCLES_SOURCE = fetch.CYCLES_SOURCE
+
+# The columns of metarsqlite3db.returnMostRecent(returnColumns=True), in order,
+# with the NumPy dtype of each column's array. Missing numbers are NaN; text
+# is kept as Python strings (object arrays), with None where it is missing.
+MOST_RECENT_SCHEMA = [('X', 'f8'), ('Y', 'f8'), ('station', 'O'), ('label', 'O'),
+    ('country', 'O'), ('utc', 'O'), ('windspeed_mph', 'f8'), ('windspeed_kts', 'f8'),
+    ('winddirection', 'f8'), ('temperature_c', 'f8'), ('temperature_f', 'f8'),
+    ('relativehumidity', 'f8')]
+
+# The columns that metarsqlite3db.returnHistory can aggregate (wind direction
+# cannot be: its mean is not the mean of the angles), and its bucket sizes
+HISTORY_MEASURES = ('temperature_c', 'temperature_f', 'windspeed_mph', 'windspeed_kts')
+BUCKETS = {'hour': 3600, 'day': 86400}
+# The periods that metarsqlite3db can partition observations by, and the
+# format of the key of each partition
+PARTITIONS = {'month': '%Y%m', 'year': '%Y'}
+# The values of a file that holds the latest observation already stored,
+# which is not parsed (see metarHarvester.parseWorker)
+KNOWN = 'known'
 
 class METARTxtFile:
     '''
     A .TXT file of METAR data, at a particular place and time.
     '''
-    def __init__(self, station, metardb):
+    def __init__(self, station, metardb=None, dataList=None, source=NOAA_SOURCE, cache=None):
         '''
         Input:
         station -- The four-character station code of the station.
         metardb -- a metarsqlite3db object representing the SQLite/Spatialite
                    database where the data will be stored if it does not already
-                   exist.'''
-        source = 'http://weather.noaa.gov/pub/data/observations/metar/decoded/'
+                   exist. If None, the data is only parsed, and can be added
+                   later with self.addIfMissing(metardb).
+        dataList -- default None, the lines of an already retrieved .TXT file
+                    (e.g. by a metarHarvester). If None, the file is retrieved
+                    from source.
+        source -- the directory URL the .TXT files are retrieved from.
+        cache -- default None, a fetch.httpCache to retrieve the file through.
+        
+        The retrieval (fetch, and the bytes retrieved) and the parse are timed
+        in pipeline.METRICS.'''
         self.url = source + station + '.TXT'
         self.station = station
-        try:
-            self.text = urllib2.urlopen(self.url)
-        except urllib2.HTTPError, e:
-            
-            if 'Error 403: Forbidden' in str(e):
-                # Restricted site, do nothing
-                print 'Cannot process {station}: {forbidden}'.format(station=self.station,
-                                                                     forbidden=str(e))
-                return None
-        self.dataList = self.text.readlines()
-        self.datadict = self.makeDataDict()
-        locale = self.getLine(0) # Location
-        if locale == 'Station name not available':
-            self.locale = None
-        else:
-            self.locale = locale
+        if dataList is None:
+            start = time.time()
+            try:
+                if cache is None:
+                    self.text = urllib2.urlopen(self.url)
+                    dataList = self.text.readlines()
+                else:
+                    dataList = cache.fetch(self.url)[0].splitlines(True)
+            except urllib2.HTTPError, e:
+                # E.g. a restricted site (403): report it rather than leave a half-made object
+                pipeline.METRICS.count('fetch.http_{code}'.format(code=e.code))
+                print 'Cannot process {station}: {error}'.format(station=self.station, error=str(e))
+                raise
+            finally:
+                pipeline.METRICS.time('fetch', time.time() - start)
+            pipeline.METRICS.count('fetch.bytes', sum(len(line) for line in dataList))
+        self.dataList = dataList
+        # All of the values are parsed once, here; the methods below return them
+        start = time.time()
+        self.observation = metarparse.parse(self.station, self.dataList)
+        pipeline.METRICS.time('parse', time.time() - start)
+        if self.observation.utc is None:
+            pipeline.METRICS.count('parse.no_time')
+        obs = self.observation
+        self.locale = obs.locale # Location
         # Not all of these are constrained to exist. Nonetype indicates that the attribute does not exist
-        self.when = self.getLine(1) # Date and time
-        self.wind = self.datadict.get('Wind') # Wind attributes
-        self.visibility = self.datadict.get('Visibility') # Visibility attributes
-        self.skyconditions = self.datadict.get('Sky conditions') # Sky condition attributes
-        self.temperature = self.datadict.get('Temperature') # Temperature attributes
-        self.dewpoint = self.datadict.get('Dew Point') # Dew point attributes
-        self.relativehumidity = self.datadict.get('Relative Humidity') # Relative humidity attributes
-        self.pressure = self.datadict.get('Pressure (altimeter)') # Pressure (altimeter) attributes
-        self.ob = self.datadict.get('ob') # "ob" attributes
-        self.cycle = self.datadict.get('cycle') # "cycle" attributes
+        self.when = obs.when # Date and time
+        self.wind = obs.wind # Wind attributes
+        self.visibility = obs.visibility # Visibility attributes
+        self.skyconditions = obs.skyconditions # Sky condition attributes
+        self.temperature = obs.temperature # Temperature attributes
+        self.dewpoint = obs.dewpoint # Dew point attributes
+        self.relativehumidity = obs.relativehumidity # Relative humidity attributes
+        self.pressure = obs.pressure # Pressure (altimeter) attributes
+        self.ob = obs.ob # "ob" attributes
+        self.cycle = obs.cycle # "cycle" attributes
         
         # Each object is associated with a DB where it's data is added if it is missing
         self.metardb = metardb 
-        self.addIfMissing() # Adds the data to self.metardb, ignoring data conflicts
+        if self.metardb is not None:
+            self.addIfMissing() # Adds the data to self.metardb, ignoring data conflicts
     
     def __repr__(self):
         '''Nicely prints the available information.'''
@@ -96,11 +147,7 @@ class METARTxtFile:
         
     def makeDataDict(self):
         '''Returns a dictionary of available information from the METAR txt file'''
-        dataDict = {}
-        for i in range(2,len(self.dataList)):
-            k,v = self.getLine(i).split(':',1)
-            dataDict[k.strip()] = v.strip()
-        return dataDict
+        return metarparse.dataDict([line.strip() for line in self.dataList])
             
     def getLine(self, index):
         '''Returns the text of the line n (index) from the raw METAR TXT record'''
@@ -110,35 +157,14 @@ class METARTxtFile:
         '''Returns the text in self.locale up to the first comma: this is the label of the location
         Example: 'Wellington Airport'
         '''
-        if self.locale == None:
-            return None
-        pattern = '[\w,\s]+,' # regex pattern
-        m = re.search(pattern, self.locale)
-        if m == None:
-            return None
-        elif m.start() == 0:
-            # The match is at the beginning of the line
-            return m.group().replace(',','').strip()
-        else:
-            # The match is not where we expected
-            return None
+        return self.observation.label
             
     def localeCountry(self):
         '''Returns the text in self.locale after the first comma and up to an open bracket
         this is the country of the location
         Example: 'New Zealand'
         '''
-        if self.locale == None:
-            return None
-        pattern = ',\s\w+\s\(' # regex pattern
-        m = re.search(pattern, self.locale)
-        if m == None:
-            return None
-        else:
-            country = m.group()
-            for s in [', ', ' (']:
-                country = country.replace(s,'').strip()
-            return country
+        return self.observation.country
     
     def localeXY(self):
         '''Returns the latitude and longitude of the station as a tuple of
@@ -146,155 +172,104 @@ class METARTxtFile:
         Example:
             input: '42-29S 172-33E'
             output: (-43.29, 172.33)'''
-        if self.locale == None:
+        if self.observation.lat is None:
             return None
-        patterns = ['\)\s\d+-\d+[S,N]', '\s\d+-\d+[E,W]']
-        coords = ()
-        for pattern in patterns:
-            m = re.search(pattern, self.locale)
-            if m == None:
-                return None
-            else:
-                coord = m.group().strip().replace(') ','').replace('-','.')
-                hemi = coord[-1]
-                if hemi in ['S','W']:
-                    negative = True
-                elif hemi in ['N','E']:
-                    negative = False
-                else:
-                    print coord
-                    raise Exception # Latitude (longitude) not in ['S','N'] (['E','W'])
-                coord = float(coord[:-1])
-                if negative:
-                    coord = coord*-1
-            coords = coords + (coord,) # Append the coord to the tuple
-        return coords # lat lon tuple
+        return (self.observation.lat, self.observation.lon) # lat lon tuple
         
     def localeZ(self):
         '''Returns the Z coordinate of the station as an integer
         Does not handle negative elevations'''
-        if self.locale == None:
-            return None
-        pattern = '[E,W]\s\d+M'
-        m = re.search(pattern, self.locale)
-        if m == None:
-            return None
-        m = m.group()
-        m = m.replace('E ','').replace('W ','')
-        if m[-1] != 'M':
-            raise Exception # Elevation not in metres
-        m = m.strip('M')
-        return int(m)
+        return self.observation.elevation
             
     def xyzmstring(self):
         '''Returns a WKT representation of the XYZM point, where M is UNIX time
         of the measurement (from the UTC recorded time).'''
-        if self.locale is None or self.localeXY() is None:
+        obs = self.observation
+        if obs.locale is None or obs.lat is None:
             # It has no location, only an M value, so we don't populate its location
             return None
+        if obs.epoch is None:
+            raise ValueError('Station {station}: no observation time in {date}'.format(station=self.station, date=self.when))
         # NOTE: have to give lon lat
-        xyzm = (self.localeXY()[1], self.localeXY()[0], max(self.localeZ(),0), calendar.timegm(self.whenDatetime().utctimetuple()))
-        return 'POINT ZM(%s %s %s %s)' % (str(xyzm[0]),str(xyzm[1]),str(xyzm[2]),str(xyzm[3]))
+        return 'POINT ZM(%s %s %s %s)' % (str(obs.lon),str(obs.lat),str(max(obs.elevation,0)),str(obs.epoch))
             
     def whenDatetime(self):
         '''Returns a datetime.datetime object representing the date and time of
         the data represents, in UTC.'''
-        pattern = '\d\d\d\d.\d\d.\d\d \d\d\d\d UTC'
-        m = re.search(pattern, self.when)
-        if m == None:
-            return None
-        else:
-            try:
-                m = dt.datetime.strptime(m.group(), '%Y.%m.%d %H%M %Z')
-            except ValueError, e:
-                if '2400' in m.group():
-                    # Ugh, 2400 is not a time!
-                    m = m.group()
-                    m = m.split(' ')[0]
-                    m = dt.datetime.strptime(m,'%Y.%m.%d')
-                    m = m + dt.timedelta(days=1)
-                else:
-                    print "Station {station}: cannot parse date/time {date}".format(station=self.station,date=self.when)
-                    return None    
-            return m
+        return self.observation.utc
             
     def windSpeed(self, MPH=True):
         '''Returns the wind speed
         if MPH: returns an integer in miles per hour (MPH)
         else: returns an integer in knots (KT)'''
-        if self.wind is None:
-            return None
         if MPH == True:
-            pattern = '\d+\sMPH'
-        else:
-            pattern = '\d+\sKT'
-        m = re.search(pattern, self.wind)
-        if m == None:
-            if 'calm' in self.wind.lower():
-                return 0
-            else:
-                return None
-        else:
-            return int(m.group().split(' ')[0])
+            return self.observation.windspeed_mph
+        return self.observation.windspeed_kts
     
     def windDirection(self):
         '''Returns the wind direction in degrees, as an integer
         Example input (self.wind): "Wind: from the SE (130 degrees) at 12 MPH (10 KT):0"
         Example output: 130'''
-        if self.wind is None:
-            return None
-        pattern = '\d+\sdegrees'
-        m = re.search(pattern, self.wind)
-        if m == None:
-            if 'calm' in self.wind.lower():
-                return 0
-            else:
-                return None
-        else:
-            return int(m.group().strip(' degrees'))
+        return self.observation.winddirection
     
     def temperatureTemp(self, celsius=True):
         '''Returns the temperature
         if celsius: returns an integer in degrees Celsius
         else: returns an integer in degrees fahrenheit'''
-        if self.temperature is None:
-            return None
         if celsius == True:
-            pattern = '\d+\sC'
-        else:
-            pattern = '\d+\sF'
-        m = re.search(pattern, self.temperature)
-        if m == None:
-            return None
-        else:
-            return int(m.group().split(' ')[0])
+            return self.observation.temperature_c
+        return self.observation.temperature_f
+    
+    def relativeHumidity(self):
+        '''Returns the relative humidity, as an integer percentage
+        Example input (self.relativehumidity): "66%"
+        Example output: 66'''
+        return self.observation.relativehumidity_pct
             
-    def addIfMissing(self):
+    def addIfMissing(self, metardb=None):
         '''Adds the data from self into metardb, if the data does not exist in
         the DB.
         NOTE: ON CONFLICT IGNORE and a primary key on the station code and the
         UTC time record control for repeated runs of the script and ensures data
-        is not duplicated'''
-        sql = '''INSERT OR IGNORE INTO tableName (label, station, country, utc,
-        windspeed_mph, windspeed_kts, winddirection, temperature_c, temperature_f, geom)
-        VALUES ('''.replace('tableName', self.metardb.tableName)
-        vals = (self.localeLabel(), self.station, self.localeCountry(), str(self.whenDatetime()), self.windSpeed(), self.windSpeed(False), self.windDirection(), self.temperatureTemp(), self.temperatureTemp(False), self.xyzmstring())
-        if self.locale is not None:
-            # If there's a location, geom will be populated
-            self.metardb.cur.execute(sql+'?,?,?,?,?,?,?,?,?,GeomFromText(?, 4326))', vals)
-        else:
-            # If there isn't a location, geom will be None
-            sql = sql.replace(', geom','')
-            vals = vals[:-1]
-            self.metardb.cur.execute(sql+'?,?,?,?,?,?,?,?,?)', vals)
-        self.metardb.conn.commit()
+        is not duplicated
+        
+        Input:
+        metardb -- default None, a metarsqlite3db object to add the data to,
+                   replacing self.metardb. If None, self.metardb is used.'''
+        if metardb is not None:
+            self.metardb = metardb
+        stationValues = self.stationValues()
+        if stationValues is not None:
+            self.metardb.addStations([stationValues])
+        self.metardb.addObservations([self.observationValues()])
         return None
+        
+    def observationValues(self):
+        '''Returns a tuple of the values stored in the database for this
+        observation, in the order expected by metarsqlite3db.addObservations:
+        (station, utc, obs_epoch, windspeed_mph, windspeed_kts, winddirection,
+        temperature_c, temperature_f, relativehumidity)
+        Raises a ValueError if the observation has no time.'''
+        obs = self.observation
+        if obs.utc is None:
+            raise ValueError('Station {station}: no observation time in {date}'.format(station=self.station, date=self.when))
+        return (self.station, str(obs.utc), obs.epoch, obs.windspeed_mph, obs.windspeed_kts, obs.winddirection, obs.temperature_c, obs.temperature_f, obs.relativehumidity_pct)
+        
+    def stationValues(self):
+        '''Returns a tuple of the static values of the station, in the order
+        expected by metarsqlite3db.addStations:
+        (station, locale, label, country, lat, lon, elevation)
+        or None if the station has no location.'''
+        obs = self.observation
+        if obs.locale is None or obs.lat is None:
+            return None
+        return (self.station, obs.locale, obs.label, obs.country, obs.lat, obs.lon, obs.elevation)
             
 class metarsqlite3db:
     '''
     A class for a SQLite3/Spatialite database that will hold METAR data.
     '''
-    def __init__(self, connstring, verbose=False):
+    def __init__(self, connstring, verbose=False, tune=False, cacheSize=32, cacheAge=300, partition=None, maxAttached=8):
         '''
         A SQLite3/Spatialite database connection and cursor. Handles database
         transactions for MetarTxtFile and foliumMap objects in such a way
@@ -304,10 +279,32 @@ class metarsqlite3db:
         
         Input:
         connstring -- path to database and name of database, e.g. './data/metar.sqlite'
+        tune -- Boolean (default False), calls self.tune() with its defaults,
+                switching the database to WAL mode for faster bulk ingest.
+        cacheSize -- default 32, the number of query results kept (see
+                     self.cachedQuery). 0 disables the cache.
+        cacheAge -- default 300, seconds a cached result is used for, at most,
+                    so that the "last 24 hours" window does not drift far.
+        partition -- default None, the period of the partitions that old
+                     observations are rolled into (see self.rollPartitions):
+                     any of PARTITIONS, e.g. 'month'. If None, the period of
+                     the database's existing partitions, if it has any.
+        maxAttached -- default 8, the number of partitions attached at once
+                       (SQLite allows 10 attached databases)
         '''
         self.conn = dbapi.connect(connstring)
+        self.path = connstring
         self.cur = self.conn.cursor()
         self.tableName = 'metarvals' # Only using one table to store everything for this simple application
+        self.cacheSize = cacheSize
+        self.cacheAge = cacheAge
+        self.queryCache = OrderedDict() # key: (time, data version, result), least recently used first
+        self.cacheStats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+        self.partition = partition
+        self.maxAttached = maxAttached
+        self.attached = OrderedDict() # Partition key: schema, least recently used first
+        self.latestIndex = None # Loaded when first needed, by self.knownIndex()
+        self.knownSkipped = 0 # Observations not written, as they were the latest stored
         self.tableCreate() # Creates table, adds spatial metadata, adds XYZM geometry column
         self.sqlite_version = self.getSQLiteVersion()
         self.spatialite_version = self.getSpatialiteVersion()
@@ -316,41 +313,726 @@ class metarsqlite3db:
         if self.spatialite_version != '4.1.1':
             print 'This code has only been tested with Spatialite v.4.1.1; you are using Spatialite v.%s' % self.spatialite_version
         self.verbose = verbose # Verbose SELECT queries
+        if tune:
+            self.tune()
+        
+    def tune(self, wal=True, synchronous='NORMAL', cacheSize=-16000):
+        '''Sets pragmas that make large ingests faster.
+        
+        Input:
+        wal -- Boolean (default True), use the write-ahead log journal mode, so
+               commits append to the log rather than rewriting the database.
+               The setting is persistent, and leaves metar.db-wal and
+               metar.db-shm files alongside the database while it is open.
+        synchronous -- default 'NORMAL', the synchronous pragma. With WAL this
+                       only syncs at checkpoints, and remains safe against
+                       corruption (but not against losing the last commits on
+                       power loss). None leaves the setting alone.
+        cacheSize -- default -16000, the cache_size pragma (negative values are
+                     KiB, so 16 MB). None leaves the setting alone.'''
+        if wal:
+            self.conn.execute('PRAGMA journal_mode=WAL;')
+        if synchronous is not None:
+            self.conn.execute('PRAGMA synchronous=%s;' % synchronous)
+        if cacheSize is not None:
+            self.conn.execute('PRAGMA cache_size=%d;' % int(cacheSize))
+        return None
         
     def tableCreate(self):
         '''Checks whether the table self.tableName exists, and creates it if it
         does not exist.
         If the table already exists, nothing happens.
         Also checks for the existence of spatialite metadata, and adds it if it
-        does not exist.
-        Then adds an XYZM point geometry column to self.tableName.'''
-        sql = '''CREATE TABLE IF NOT EXISTS tableName (
+        does not exist, and then creates the stations table (see
+        self.stationsCreate()).
+        A self.tableName from before the stations table existed (with label,
+        country and an XYZM geom on every observation) is migrated in place,
+        as is one from before the obs_epoch column existed (see
+        self.latestCreate()).'''
+        self.observationsCreate()
+        # Check if spatial meta data has been initialised
+        check = self.cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='geometry_columns'")
+        if check.fetchone() is None:
+            self.conn.execute("SELECT InitSpatialMetaData();")
+        self.stationsCreate()
+        self.spatialIndexCreate()
+        if 'geom' in self.columnNames(self.tableName):
+            self.migrateStations()
+        self.latestCreate()
+        self.healthCreate()
+        self.runsCreate()
+        self.partitionsCreate()
+        return None
+        
+    def observationsCreate(self, schema='main'):
+        '''Creates the table self.tableName in schema (the main database, or an
+        attached partition), if it does not exist. One from before relative
+        humidity was stored gets its (empty) relativehumidity column.'''
+        sql = '''CREATE TABLE IF NOT EXISTS schema.tableName (
         station TEXT NOT NULL,
-        label TEXT,
-        country TEXT,
         utc TEXT NOT NULL,
+        obs_epoch INTEGER,
         windspeed_mph INTEGER,
         windspeed_kts INTEGER,
         winddirection INTEGER,
         temperature_c INTEGER,
         temperature_f INTEGER,
+        relativehumidity INTEGER,
         PRIMARY KEY (station, utc));
-        '''.replace('tableName', self.tableName)
+        '''.replace('tableName', self.tableName).replace('schema', schema)
         self.conn.execute(sql)
-        # Check if spatial meta data has been initialised
-        check = self.cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='geometry_columns'")
-        for c in check:
-            if 'spatial_ref_sys' not in c:
-                self.conn.execute("SELECT InitSpatialMetaData();")
+        if 'relativehumidity' not in self.columnNames(self.tableName, schema):
+            self.conn.execute('ALTER TABLE schema.tableName ADD COLUMN relativehumidity INTEGER;'.replace('tableName', self.tableName).replace('schema', schema))
+        return None
+        
+    def runsCreate(self):
+        '''Creates the harvest_runs and harvest_progress tables if they do not
+        exist. Each run of a metarHarvester has an id, a status ('running',
+        'interrupted', 'complete' or 'abandoned') and a heartbeat (the UNIX
+        time of its last checkpoint), and each of its stations a state
+        ('pending', 'done', 'failed' or 'skipped': not tried in the run, as
+        it was backing off or left to another run).'''
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS harvest_runs (
+        run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        started INTEGER NOT NULL,
+        heartbeat INTEGER NOT NULL,
+        finished INTEGER,
+        status TEXT NOT NULL,
+        pid INTEGER);
+        ''')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS harvest_progress (
+        run_id INTEGER NOT NULL,
+        station TEXT NOT NULL,
+        state TEXT NOT NULL,
+        PRIMARY KEY (run_id, station));
+        ''')
+        self.conn.commit()
+        return None
+        
+    def startRun(self, stations, skipped=()):
+        '''Records the start of a harvest of stations, all pending, and
+        returns its run id. The skipped stations were asked for, but are not
+        to be tried in the run; they are recorded so that the run can be
+        matched with a later request for the same stations (see
+        self.resumeRun()).'''
+        now = int(time.time())
         try:
-            self.cur.execute("SELECT geom FROM tableName;".replace('tableName', self.tableName))
-        except Exception as e:
-            if 'no such column' in str(e):
-                self.conn.execute("SELECT AddGeometryColumn('tableName', 'geom', 4326, 'POINT', 'XYZM');".replace('tableName', self.tableName))
-            else:
-                raise e # Did not succeed
+            self.cur.execute("INSERT INTO harvest_runs (started, heartbeat, status, pid) VALUES (?,?,'running',?);", (now, now, os.getpid()))
+            run = self.cur.lastrowid
+            self.cur.executemany("INSERT OR IGNORE INTO harvest_progress (run_id, station, state) VALUES (?,?,'pending');", [(run, station) for station in stations])
+            self.cur.executemany("INSERT OR IGNORE INTO harvest_progress (run_id, station, state) VALUES (?,?,'skipped');", [(run, station) for station in skipped])
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        return run
+        
+    def resumeRun(self, stations=None, stale=900, within=6*3600):
+        '''Finds the most recent run that was interrupted, or that has not
+        checkpointed for stale seconds (its process died), and takes it over.
+        If stations are given, only a run of exactly those stations is taken
+        over; runs of other stations are left alone, to be resumed by a
+        request for their own stations.
+        Runs that started more than within seconds ago are abandoned instead,
+        as their data would be out of date anyway.
+        Returns a tuple of its run id and a list of its pending stations, or
+        (None, None) if there is no run to resume.'''
+        now = int(time.time())
+        wanted = set(stations) if stations is not None else None
+        try:
+            self.conn.execute('''UPDATE harvest_runs SET status = 'abandoned'
+            WHERE status IN ('running', 'interrupted') AND started < ?;''', (now - within,))
+            runs = self.cur.execute('''SELECT run_id FROM harvest_runs
+            WHERE status = 'interrupted' OR (status = 'running' AND heartbeat < ?)
+            ORDER BY started DESC, run_id DESC;''', (now - stale,)).fetchall()
+            run = None
+            for candidate, in runs:
+                if wanted is None or wanted == self.runStations(candidate):
+                    run = candidate
+                    break
+            if run is None:
+                self.conn.commit()
+                return None, None
+            self.conn.execute("UPDATE harvest_runs SET status = 'running', heartbeat = ?, pid = ? WHERE run_id = ?;", (now, os.getpid(), run))
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        pending = self.cur.execute("SELECT station FROM harvest_progress WHERE run_id = ? AND state = 'pending';", (run,)).fetchall()
+        return run, [str(station) for station, in pending]
+        
+    def runStations(self, run):
+        '''Returns a set of every station of a run, whatever its state'''
+        return set(str(station) for station, in self.cur.execute('SELECT station FROM harvest_progress WHERE run_id = ?;', (run,)).fetchall())
+        
+    def busyStations(self, stale=900, exclude=None):
+        '''Returns a set of the stations still pending in runs that are
+        running and have checkpointed in the last stale seconds (other than
+        the run exclude)'''
+        sql = '''SELECT p.station FROM harvest_progress AS p
+        JOIN harvest_runs AS r ON r.run_id = p.run_id
+        WHERE r.status = 'running' AND r.heartbeat >= ? AND r.run_id IS NOT ?
+        AND p.state = 'pending';'''
+        return set(str(station) for station, in self.cur.execute(sql, (int(time.time()) - stale, exclude)).fetchall())
+        
+    def checkpointRun(self, run, states):
+        '''Records the state of stations in a run, and its heartbeat.
+        
+        Input:
+        run -- the run id
+        states -- a list of (state, station) tuples'''
+        try:
+            self.cur.executemany('UPDATE harvest_progress SET state = ? WHERE run_id = %d AND station = ?;' % run, states)
+            self.conn.execute('UPDATE harvest_runs SET heartbeat = ? WHERE run_id = ?;', (int(time.time()), run))
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        return None
+        
+    def finishRun(self, run, status='complete'):
+        '''Records the end of a run, with the given status'''
+        now = int(time.time())
+        self.conn.execute('UPDATE harvest_runs SET status = ?, heartbeat = ?, finished = ? WHERE run_id = ?;', (status, now, now if status == 'complete' else None, run))
+        self.conn.commit()
+        return None
+        
+    def healthCreate(self):
+        '''Creates the station_health table if it does not exist. It holds the
+        stations whose last retrieval failed: how many times in a row, the
+        last error, and the UNIX time before which they should not be tried
+        again (see self.recordFailures()).'''
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS station_health (
+        station TEXT NOT NULL PRIMARY KEY,
+        failures INTEGER NOT NULL,
+        last_error TEXT,
+        last_failure INTEGER,
+        retry_after INTEGER);
+        ''')
+        self.conn.commit()
+        return None
+        
+    def failingStations(self):
+        '''Returns a dictionary of station: (failures, retry_after) of the
+        stations whose last retrieval failed'''
+        sql = 'SELECT station, failures, retry_after FROM station_health;'
+        return dict((station, (failures, retry_after)) for station, failures, retry_after in self.cur.execute(sql).fetchall())
+        
+    def recordFailures(self, failed, now=None, base=1800, maximum=7*86400):
+        '''Records the failure of stations, and when they may next be tried:
+        base seconds after the first failure in a row, doubling with each
+        further failure up to maximum seconds.
+        
+        Input:
+        failed -- a dictionary of station: error string
+        now -- default None, the UNIX time of the failures (None for now)
+        base -- default 1800 (30 minutes), the backoff after one failure
+        maximum -- default 604800 (a week), the longest backoff'''
+        if not failed:
+            return None
+        now = int(now if now is not None else time.time())
+        previous = self.failingStations()
+        rows = []
+        for station, error in failed.items():
+            failures = previous.get(station, (0, None))[0] + 1
+            rows.append((station, failures, error, now, now + backoffDelay(failures, base, maximum)))
+        try:
+            self.cur.executemany('''INSERT OR REPLACE INTO station_health (station, failures,
+            last_error, last_failure, retry_after) VALUES (?,?,?,?,?);''', rows)
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        return None
+        
+    def clearFailures(self, stations):
+        '''Forgets the failures of stations, once they have been retrieved'''
+        try:
+            self.cur.executemany('DELETE FROM station_health WHERE station = ?;', [(station,) for station in stations])
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        return None
+        
+    def latestCreate(self):
+        '''Makes the most recent observation of each station cheap to find.
+        self.tableName gets an obs_epoch column (UNIX time of the observation,
+        filled in for existing rows if it is missing) with an index on
+        (station, obs_epoch), and the latest table holds a copy of the newest
+        observation of each station, kept up to date by a trigger on inserts
+        into self.tableName. Queries for the current weather read latest, and
+        so cost O(stations) rather than O(history).
+        A latest table from before relative humidity was stored gets its
+        column, and the trigger is made again to copy it.'''
+        if 'obs_epoch' not in self.columnNames(self.tableName):
+            self.conn.execute('ALTER TABLE tableName ADD COLUMN obs_epoch INTEGER;'.replace('tableName', self.tableName))
+            self.conn.execute("UPDATE tableName SET obs_epoch = CAST(strftime('%s', utc) AS INTEGER);".replace('tableName', self.tableName))
+        self.conn.execute('CREATE INDEX IF NOT EXISTS idx_tableName_station_epoch ON tableName (station, obs_epoch);'.replace('tableName', self.tableName))
+        exists = self.cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='latest'").fetchone()
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS latest (
+        station TEXT NOT NULL PRIMARY KEY,
+        utc TEXT NOT NULL,
+        obs_epoch INTEGER,
+        windspeed_mph INTEGER,
+        windspeed_kts INTEGER,
+        winddirection INTEGER,
+        temperature_c INTEGER,
+        temperature_f INTEGER,
+        relativehumidity INTEGER);
+        ''')
+        if 'relativehumidity' not in self.columnNames('latest'):
+            self.conn.execute('ALTER TABLE latest ADD COLUMN relativehumidity INTEGER;')
+            self.conn.execute('DROP TRIGGER IF EXISTS tableName_latest;'.replace('tableName', self.tableName))
+        self.conn.execute(self.latestTrigger())
+        if exists is None:
+            # Fill it from the observations already stored
+            self.conn.execute('''INSERT OR REPLACE INTO latest (station, utc, obs_epoch,
+            windspeed_mph, windspeed_kts, winddirection, temperature_c, temperature_f,
+            relativehumidity)
+            SELECT station, utc, MAX(obs_epoch), windspeed_mph, windspeed_kts,
+            winddirection, temperature_c, temperature_f, relativehumidity
+            FROM tableName GROUP BY station;'''.replace('tableName', self.tableName))
+        self.conn.commit()
+        return None
+        
+    def latestTrigger(self, schema=None):
+        '''Returns the SQL creating the trigger that copies new observations
+        into latest (see self.latestCreate()), on self.tableName in the main
+        database, or in the attached partition schema. The trigger on a
+        partition is a TEMP trigger, the only kind that can write to a table
+        in another database, and so lasts only while it is attached.'''
+        sql = '''CREATE createTrigger IF NOT EXISTS triggerName AFTER INSERT ON triggerTable
+        WHEN NEW.obs_epoch >= COALESCE((SELECT obs_epoch FROM latest WHERE station = NEW.station), NEW.obs_epoch)
+        BEGIN
+            -- Not INSERT OR REPLACE: the OR IGNORE of the inserts into tableName would override it
+            UPDATE latest SET utc = NEW.utc, obs_epoch = NEW.obs_epoch,
+            windspeed_mph = NEW.windspeed_mph, windspeed_kts = NEW.windspeed_kts,
+            winddirection = NEW.winddirection, temperature_c = NEW.temperature_c,
+            temperature_f = NEW.temperature_f, relativehumidity = NEW.relativehumidity
+            WHERE station = NEW.station;
+            INSERT INTO latest (station, utc, obs_epoch, windspeed_mph,
+            windspeed_kts, winddirection, temperature_c, temperature_f, relativehumidity)
+            SELECT NEW.station, NEW.utc, NEW.obs_epoch, NEW.windspeed_mph,
+            NEW.windspeed_kts, NEW.winddirection, NEW.temperature_c, NEW.temperature_f,
+            NEW.relativehumidity
+            WHERE NOT EXISTS (SELECT 1 FROM latest WHERE station = NEW.station);
+        END;'''
+        if schema is None:
+            create, name, table = 'TRIGGER', 'tableName_latest', 'tableName'
+        else:
+            create, name, table = 'TEMP TRIGGER', schema + '_tableName_latest', schema + '.tableName'
+        sql = sql.replace('createTrigger', create).replace('triggerName', name).replace('triggerTable', table)
+        return sql.replace('tableName', self.tableName)
+        
+    def stationsCreate(self):
+        '''Creates the stations table if it does not exist. It holds the static
+        values of each station, from the first line of its .TXT file, keyed by
+        the station code, with a POINT geometry of its location.'''
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS stations (
+        station TEXT NOT NULL PRIMARY KEY,
+        locale TEXT,
+        label TEXT,
+        country TEXT,
+        elevation INTEGER);
+        ''')
+        if 'geom' not in self.columnNames('stations'):
+            self.conn.execute("SELECT AddGeometryColumn('stations', 'geom', 4326, 'POINT', 'XY');")
+        self.conn.commit()
+        self.stationLocales = None # Loaded when first needed, by self.addStations()
+        return None
+        
+    def spatialIndexCreate(self):
+        '''Creates the spatial (R*Tree) index of the stations' geom, if it does
+        not exist. SpatiaLite keeps it up to date with triggers, as long as
+        rows are updated in place (see self.addStations()).'''
+        check = self.cur.execute("SELECT name FROM sqlite_master WHERE name='idx_stations_geom'")
+        if check.fetchone() is None:
+            self.conn.execute("SELECT CreateSpatialIndex('stations', 'geom');")
+            self.conn.commit()
+        return None
+        
+    def columnNames(self, table, schema='main'):
+        '''Returns a list of the column names of table (in schema, the main
+        database by default, or an attached partition)'''
+        return [row[1] for row in self.cur.execute('PRAGMA %s.table_info(%s);' % (schema, table)).fetchall()]
+        
+    def migrateStations(self):
+        '''Moves the label, country and location of each station out of
+        self.tableName and into the stations table (taking the most recent
+        values of each station), then rebuilds self.tableName without them.'''
+        try:
+            self.conn.execute('''INSERT OR IGNORE INTO stations (station, label, country, elevation, geom)
+            SELECT station, label, country, CAST(Z(geom) AS INTEGER), MakePoint(X(geom), Y(geom), 4326)
+            FROM tableName WHERE geom IS NOT NULL ORDER BY utc DESC;'''.replace('tableName', self.tableName))
+            self.conn.execute("SELECT DiscardGeometryColumn('tableName', 'geom');".replace('tableName', self.tableName))
+            self.conn.execute('ALTER TABLE tableName RENAME TO tableName_migrating;'.replace('tableName', self.tableName))
+            self.conn.execute('''CREATE TABLE tableName (
+            station TEXT NOT NULL,
+            utc TEXT NOT NULL,
+            obs_epoch INTEGER,
+            windspeed_mph INTEGER,
+            windspeed_kts INTEGER,
+            winddirection INTEGER,
+            temperature_c INTEGER,
+            temperature_f INTEGER,
+            relativehumidity INTEGER,
+            PRIMARY KEY (station, utc));'''.replace('tableName', self.tableName))
+            self.conn.execute('''INSERT INTO tableName SELECT station, utc,
+            CAST(strftime('%s', utc) AS INTEGER), windspeed_mph,
+            windspeed_kts, winddirection, temperature_c, temperature_f,
+            relativehumidity
+            FROM tableName_migrating;'''.replace('tableName', self.tableName))
+            self.conn.execute('DROP TABLE tableName_migrating;'.replace('tableName', self.tableName))
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        return None
+        
+    def addStations(self, stations):
+        '''Adds or updates the static values of stations, writing only those
+        that are new or whose locale line has changed since they were stored.
+        
+        Input:
+        stations -- an iterable of tuples of values, as returned by
+                    METARTxtFile.stationValues()
+        Output:
+        The number of stations that were added or updated'''
+        if self.stationLocales is None:
+            self.stationLocales = dict(self.cur.execute('SELECT station, locale FROM stations;').fetchall())
+        changed = {}
+        for station, locale, label, country, lat, lon, elevation in stations:
+            if self.stationLocales.get(station) != locale:
+                # NOTE: have to give lon lat
+                changed[station] = (station, locale, label, country, elevation, lon, lat)
+        if not changed:
+            return 0
+        # Stations are updated in place, and inserted if they are not there: a
+        # REPLACE would delete the row without the spatial index's trigger
+        # firing, leaving its entry in the index behind
+        try:
+            self.cur.executemany('''UPDATE stations SET locale=?, label=?, country=?,
+            elevation=?, geom=MakePoint(?,?,4326) WHERE station=?;''',
+            [values[1:] + values[:1] for values in changed.values()])
+            self.cur.executemany('''INSERT OR IGNORE INTO stations (station, locale, label, country, elevation, geom)
+            VALUES (?,?,?,?,?,MakePoint(?,?,4326));''', changed.values())
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        self.invalidate()
+        for station, values in changed.items():
+            self.stationLocales[station] = values[1]
+        return len(changed)
+        
+    def addObservations(self, observations, chunksize=1000):
+        '''Adds many observations to self.tableName, ignoring those already in
+        the database (see METARTxtFile.addIfMissing). Rows are written with
+        executemany, committing once per chunk rather than once per row.
+        
+        Input:
+        observations -- an iterable of tuples of values, as returned by
+                        METARTxtFile.observationValues()
+        chunksize -- default 1000, the number of observations written in each
+                     transaction
+        Output:
+        The number of rows that were added (i.e. not already present)
+        Observations that are the latest already stored for their station
+        (see self.knownIndex()) are dropped without going to the database,
+        and counted in self.knownSkipped (and as db.rows_known in
+        pipeline.METRICS).'''
+        known = self.knownIndex()
+        skipped = self.knownSkipped
+        added = 0
+        chunk = []
+        for vals in observations:
+            if known.isKnown(vals[0], vals[2]):
+                self.knownSkipped += 1
+                continue
+            chunk.append(vals)
+            if len(chunk) >= chunksize:
+                added += self.writeChunk(chunk)
+                chunk = []
+        if chunk:
+            added += self.writeChunk(chunk)
+        if self.knownSkipped > skipped:
+            pipeline.METRICS.count('db.rows_known', self.knownSkipped - skipped)
+        return added
+        
+    def writeChunk(self, chunk):
+        '''Writes a list of observation value tuples in a single transaction,
+        returning the number of rows added (not counting the changes made by
+        triggers). If anything fails the whole chunk is rolled back and the
+        error raised.
+        Observations from before self.hotStart() are written to their
+        partitions instead, in a transaction for each partition.
+        Each transaction is timed as db.insert in pipeline.METRICS, with the
+        rows written and ignored (as they were already stored).'''
+        hot = self.hotStart()
+        groups = {None: chunk}
+        if hot is not None:
+            groups = {None: []}
+            for values in chunk:
+                if values[2] is not None and values[2] < hot:
+                    groups.setdefault(partitionKey(values[2], self.partition), []).append(values)
+                else:
+                    groups[None].append(values)
+        added = 0
+        for key, rows in sorted(groups.items()):
+            if not rows:
+                continue
+            schema = 'main' if key is None else self.attachPartition(key)
+            sql = '''INSERT OR IGNORE INTO schema.tableName (station, utc, obs_epoch, windspeed_mph,
+            windspeed_kts, winddirection, temperature_c, temperature_f, relativehumidity)
+            VALUES (?,?,?,?,?,?,?,?,?)'''.replace('tableName', self.tableName).replace('schema', schema)
+            start = time.time()
+            try:
+                self.cur.executemany(sql, rows)
+                written = self.cur.rowcount
+                if key is not None and written:
+                    self.cur.execute('UPDATE partitions SET compacted = NULL WHERE key = ?;', (key,))
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+            pipeline.METRICS.time('db.insert', time.time() - start, len(rows))
+            pipeline.METRICS.count('db.rows_written', written)
+            pipeline.METRICS.count('db.rows_ignored', len(rows) - written)
+            added += written
+        if self.latestIndex is not None:
+            self.latestIndex.update(chunk)
+        if added:
+            self.invalidate()
+        return added
+        
+    def partitionsCreate(self):
+        '''Creates the partitions table if it does not exist. It lists the
+        partition databases that observations have been rolled into (see
+        self.rollPartitions()): the key of each (e.g. '201410'), the period of
+        partitioning, its file name (beside the main database), the UNIX
+        times its observations start at and end before, and when it was
+        last compacted (NULL if it has been written to since).
+        Adopts the period of the existing partitions if self.partition is
+        None, and raises a ValueError if it is not theirs.'''
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS partitions (
+        key TEXT NOT NULL PRIMARY KEY,
+        period TEXT NOT NULL,
+        path TEXT NOT NULL,
+        start_epoch INTEGER NOT NULL,
+        end_epoch INTEGER NOT NULL,
+        compacted INTEGER);
+        ''')
+        self.conn.commit()
+        periods = [row[0] for row in self.cur.execute('SELECT DISTINCT period FROM partitions;').fetchall()]
+        if self.partition is None and periods:
+            self.partition = periods[0]
+        if self.partition is not None and self.partition not in PARTITIONS:
+            raise ValueError('partition must be one of {partitions}, not {partition}'.format(partitions=sorted(PARTITIONS), partition=self.partition))
+        if periods and periods != [self.partition]:
+            raise ValueError('The database is partitioned by {periods}, not {partition}'.format(periods=', '.join(periods), partition=self.partition))
         return None
         
+    def hotStart(self):
+        '''Returns the UNIX time that the observations in the main database
+        (the hot partition) start at: the end of the last partition that
+        observations have been rolled into. Observations from before it are
+        in their partitions. None if nothing has been rolled.'''
+        if self.partition is None:
+            return None
+        return self.cur.execute('SELECT MAX(end_epoch) FROM partitions;').fetchone()[0]
+        
+    def partitionPath(self, key):
+        '''Returns the path of the partition database of key: beside the main
+        database, e.g. ./data/metar.201410.db for ./data/metar.db'''
+        root, ext = os.path.splitext(self.path)
+        return '%s.%s%s' % (root, key, ext or '.db')
+        
+    def attachPartition(self, key):
+        '''Attaches the partition database of key, creating it (and its entry
+        in the partitions table) if it does not exist, and returns its schema
+        name. If self.maxAttached partitions are already attached, the least
+        recently used is detached.'''
+        schema = self.attached.pop(key, None)
+        if schema is not None:
+            self.attached[key] = schema # Now the most recently used
+            return schema
+        while len(self.attached) >= self.maxAttached:
+            self.detachPartition(next(iter(self.attached)))
+        schema = 'p' + key
+        self.conn.commit() # Databases cannot be attached within a transaction
+        self.cur.execute('ATTACH DATABASE ? AS %s;' % schema, (self.partitionPath(key),))
+        self.attached[key] = schema
+        self.observationsCreate(schema)
+        self.conn.execute('CREATE INDEX IF NOT EXISTS schema.idx_tableName_station_epoch ON tableName (station, obs_epoch);'.replace('tableName', self.tableName).replace('schema', schema))
+        self.conn.execute(self.latestTrigger(schema))
+        start, end = partitionBounds(key, self.partition)
+        self.conn.execute('''INSERT OR IGNORE INTO partitions (key, period, path, start_epoch, end_epoch)
+        VALUES (?,?,?,?,?);''', (key, self.partition, os.path.basename(self.partitionPath(key)), start, end))
+        self.conn.commit()
+        return schema
+        
+    def detachPartition(self, key):
+        '''Detaches the partition database of key, if it is attached'''
+        schema = self.attached.pop(key, None)
+        if schema is None:
+            return None
+        self.conn.commit()
+        self.conn.execute('DROP TRIGGER IF EXISTS temp.%s;' % (schema + '_' + self.tableName + '_latest'))
+        self.conn.execute('DETACH DATABASE %s;' % schema)
+        return None
+        
+    def partitionsBetween(self, start, end):
+        '''Returns a list of the keys of the partitions holding observations
+        from start to end (UNIX times; end is not included), in order'''
+        return [row[0] for row in self.cur.execute('''SELECT key FROM partitions
+        WHERE start_epoch < ? AND end_epoch > ? ORDER BY start_epoch;''', (end, start)).fetchall()]
+        
+    def rollPartitions(self, before=None):
+        '''Moves the observations from before the start of the current period
+        (or of the period of before, a UNIX time) out of the main database and
+        into their partitions, so that the main database holds only the hot
+        partition, and its index stays small. Later observations from before
+        the last period rolled are written straight to their partitions.
+        The latest table stays in the main database, so self.returnMostRecent()
+        never reads the partitions.
+        
+        Input:
+        before -- default None, a UNIX time; None for now
+        Output:
+        The number of observations moved'''
+        if self.partition is None:
+            raise ValueError('The database is not partitioned')
+        if before is None:
+            before = time.time()
+        before = partitionBounds(partitionKey(before, self.partition), self.partition)[0]
+        columns = 'station, utc, obs_epoch, windspeed_mph, windspeed_kts, winddirection, temperature_c, temperature_f, relativehumidity'
+        moved = 0
+        while True:
+            first = self.cur.execute('SELECT MIN(obs_epoch) FROM main.tableName WHERE obs_epoch < ?;'.replace('tableName', self.tableName), (before,)).fetchone()[0]
+            if first is None:
+                break
+            key = partitionKey(first, self.partition)
+            start, end = partitionBounds(key, self.partition)
+            schema = self.attachPartition(key)
+            # Copied, then deleted: if this is interrupted between the two (the
+            # databases only commit together outside WAL mode), rolling again
+            # finishes it, as the copies are ignored
+            try:
+                self.cur.execute('''INSERT OR IGNORE INTO schema.tableName (columns)
+                SELECT columns FROM main.tableName WHERE obs_epoch >= ? AND obs_epoch < ?;
+                '''.replace('tableName', self.tableName).replace('schema', schema).replace('columns', columns), (start, end))
+                self.cur.execute('DELETE FROM main.tableName WHERE obs_epoch >= ? AND obs_epoch < ?;'.replace('tableName', self.tableName), (start, end))
+                moved += self.cur.rowcount
+                self.cur.execute('UPDATE partitions SET compacted = NULL WHERE key = ?;', (key,))
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+        if moved:
+            self.invalidate()
+        return moved
+        
+    def dropPartitions(self, before):
+        '''Deletes the partitions (and their databases) of the periods that end
+        at or before before (a UNIX time): the retention of the archive.
+        Returns a list of the keys of the partitions deleted.'''
+        keys = [row[0] for row in self.cur.execute('SELECT key FROM partitions WHERE end_epoch <= ? ORDER BY key;', (before,)).fetchall()]
+        for key in keys:
+            self.detachPartition(key)
+            path = self.partitionPath(key)
+            for suffix in ['', '-journal', '-wal', '-shm']:
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+            self.conn.execute('DELETE FROM partitions WHERE key = ?;', (key,))
+            self.conn.commit()
+        if keys:
+            self.invalidate()
+        return keys
+        
+    def compactPartitions(self):
+        '''VACUUMs and ANALYZEs each partition written to since it was last
+        compacted, and returns a list of their keys. Partitions are only
+        written to when observations are rolled into them or arrive late, so
+        each is usually compacted once.'''
+        keys = [row[0] for row in self.cur.execute('SELECT key FROM partitions WHERE compacted IS NULL ORDER BY key;').fetchall()]
+        for key in keys:
+            self.detachPartition(key)
+            conn = dbapi.connect(self.partitionPath(key))
+            try:
+                conn.execute('VACUUM;')
+                conn.execute('ANALYZE;')
+                conn.commit()
+            finally:
+                conn.close()
+            self.conn.execute('UPDATE partitions SET compacted = ? WHERE key = ?;', (int(time.time()), key))
+            self.conn.commit()
+        return keys
+        
+    def latestTimes(self):
+        '''Returns a dictionary of station: the UNIX time of its latest
+        stored observation'''
+        return dict(self.cur.execute('SELECT station, obs_epoch FROM latest;').fetchall())
+        
+    def knownIndex(self):
+        '''Returns the latestIndex of the stations' latest observations,
+        loading it from the latest table the first time it is needed. It is
+        kept up to date with the observations written by this object.'''
+        if self.latestIndex is None:
+            self.latestIndex = latestIndex(self.latestTimes())
+        return self.latestIndex
+        
+    def dataVersion(self):
+        '''Returns SQLite's data_version, which changes when another
+        connection commits to the database, or None if this version of
+        SQLite does not have it (before 3.12.0)'''
+        row = self.cur.execute('PRAGMA data_version;').fetchone()
+        return row[0] if row is not None else None
+        
+    def invalidate(self):
+        '''Empties the query cache. Called whenever this object writes new
+        rows; changes committed by other connections are noticed through
+        self.dataVersion().'''
+        if self.queryCache:
+            self.queryCache.clear()
+            self.cacheStats['invalidations'] += 1
+        return None
+        
+    def cachedQuery(self, key, query):
+        '''Returns the result of query() (a function) from the least recently
+        used cache of results, keyed by key (e.g. the kind of query, its
+        station restriction and time window), calling it only if the result
+        is not cached, is older than self.cacheAge, or the database has been
+        changed by another connection since. Counts hits and misses in
+        self.cacheStats. The queries run are timed in pipeline.METRICS, as
+        db.query.<kind> (the first item of key), and the hits counted as
+        db.cache_hits.
+        Cached results are shared between callers: do not modify them.'''
+        if self.cacheSize <= 0:
+            return self.timedQuery(key, query)
+        version = self.dataVersion()
+        entry = self.queryCache.pop(key, None)
+        if entry is not None and entry[1] == version and time.time() - entry[0] <= self.cacheAge:
+            self.queryCache[key] = entry # Now the most recently used
+            self.cacheStats['hits'] += 1
+            pipeline.METRICS.count('db.cache_hits')
+            return entry[2]
+        self.cacheStats['misses'] += 1
+        result = self.timedQuery(key, query)
+        self.queryCache[key] = (time.time(), version, result)
+        while len(self.queryCache) > self.cacheSize:
+            self.queryCache.popitem(last=False)
+        return result
+        
+    def timedQuery(self, key, query):
+        '''Returns the result of query() (a function), timing it in
+        pipeline.METRICS as db.query.<kind>, where kind is the first item of
+        key (see self.cachedQuery())'''
+        start = time.time()
+        result = query()
+        pipeline.METRICS.time('db.query.{kind}'.format(kind=key[0]), time.time() - start)
+        return result
+        
     def getSQLiteVersion(self):
         '''Returns a string of the sqlite version number'''
         r = self.cur.execute('SELECT sqlite_version()')
@@ -363,12 +1045,12 @@ class metarsqlite3db:
         for l in r:
             return l[0]
             
-    def returnMostRecent(self, restrict=None, returnDict=False):
+    def returnMostRecent(self, restrict=None, returnDict=False, returnColumns=False):
         '''Returns the most recent METAR record of all unique stations,
         provided that the data is not more than 24 hours old, by default as the
         output of self.cur.fetchall() (a list of tuples).
         X and Y coordinates (floats) are returned in EPSG:4326 coordinates (from
-        the XYZM geom)
+        the geom of the station, in the stations table)
         
         Input:
         restrict -- Optionally, include a list of (string) stations for which
@@ -379,32 +1061,89 @@ class metarsqlite3db:
                       default output of self.cur.fetchall(). This is useful to 
                       be able to get values fro, the result using column names
                       rather than index positions from self.cur.fetchall(), 
-                      which is harder to read and more fragile.'''
-        if restrict != None:
-            # Limit to given stations
-            restriction = "AND station IN ("
-            for s in restrict:
-                restriction = restriction + "'" + s + "',"
-            restriction = restriction[:-1] + ")"
+                      which is harder to read and more fragile.
+        returnColumns -- Optionally, return the values as a dictionary of
+                         column name: NumPy array, with the names and dtypes
+                         of MOST_RECENT_SCHEMA. This avoids a Python object
+                         per row, and is the form to use for analysis.
+        Results come from self.cachedQuery, so repeated calls do not run the
+        query again until new observations are written. Do not modify them.'''
+        mode = resultMode(returnDict, returnColumns)
+        # Kind of query, form of result, stations, and days of observations
+        key = ('mostRecent', mode, stationsKey(restrict), 1)
+        return self.cachedQuery(key, lambda: self.queryMostRecent(restrict, mode))
+        
+    def returnWithin(self, bbox, restrict=None, returnDict=False, returnColumns=False):
+        '''Returns the most recent METAR record of the stations inside a
+        bounding box, as self.returnMostRecent() does for all of them. The
+        stations are found with the spatial index of the stations table.
+        
+        Input:
+        bbox -- the box, in EPSG:4326 coordinates, in the form returned by
+                self.returnBoundingBox(): ((Xmin,Ymin),(Xmax,Ymax))
+        restrict, returnDict, returnColumns -- as for self.returnMostRecent()'''
+        (xmin, ymin), (xmax, ymax) = bbox
+        mode = resultMode(returnDict, returnColumns)
+        key = ('within', mode, stationsKey(restrict), 1, tuple(bbox[0]) + tuple(bbox[1]))
+        # The index holds single precision boxes, so the points are checked too
+        where = '''AND s.ROWID IN (SELECT pkid FROM idx_stations_geom
+            WHERE xmin <= ? AND xmax >= ? AND ymin <= ? AND ymax >= ?)
+        AND X(s.geom) BETWEEN ? AND ? AND Y(s.geom) BETWEEN ? AND ?'''
+        params = (xmax, xmin, ymax, ymin, xmin, xmax, ymin, ymax)
+        return self.cachedQuery(key, lambda: self.queryMostRecent(restrict, mode, where, params))
+        
+    def returnNear(self, lon, lat, radius, restrict=None, returnDict=False, returnColumns=False):
+        '''Returns the most recent METAR record of the stations within a
+        distance of a point, as self.returnMostRecent() does for all of them.
+        Candidates are found with the spatial index of the stations table,
+        then their distance (on the ellipsoid) is checked.
+        
+        Input:
+        lon, lat -- the point, in EPSG:4326 coordinates
+        radius -- the distance, in kilometres
+        restrict, returnDict, returnColumns -- as for self.returnMostRecent()'''
+        mode = resultMode(returnDict, returnColumns)
+        key = ('near', mode, stationsKey(restrict), 1, (lon, lat, radius))
+        dlat = radius/111.32 # Degrees of latitude, less than a degree of arc anywhere
+        if abs(lat) + dlat >= 89.:
+            xmin, xmax = -180., 180.
         else:
-            restriction = ""
-        sql = '''SELECT X(geom) AS X, Y(geom) AS Y,
-        station, label, country, utc, windspeed_mph, windspeed_kts, winddirection,
-        temperature_c, temperature_f FROM metarvals
-        WHERE rowid IN
-	        (SELECT rowid FROM metarvals 
-	        WHERE station = station
-	        ORDER BY utc DESC)
-	    %s
-        AND CAST(M(geom) AS INTEGER) >= '%s' --M coordinate is time, so check currency
-        GROUP BY station
-        ORDER BY utc DESC;
-        ''' % (restriction, str(nDaysAgo(1)))
+            dlon = dlat/math.cos(math.radians(abs(lat) + dlat))
+            xmin, xmax = lon - dlon, lon + dlon
+            if xmin < -180. or xmax > 180.:
+                xmin, xmax = -180., 180. # Across the antimeridian
+        where = '''AND s.ROWID IN (SELECT pkid FROM idx_stations_geom
+            WHERE xmin <= ? AND xmax >= ? AND ymin <= ? AND ymax >= ?)
+        AND Distance(s.geom, MakePoint(?, ?, 4326), 1) <= ?'''
+        params = (xmax, xmin, lat + dlat, lat - dlat, lon, lat, radius*1000.)
+        return self.cachedQuery(key, lambda: self.queryMostRecent(restrict, mode, where, params))
+        
+    def queryMostRecent(self, restrict, mode, where='', params=()):
+        '''Runs the query of self.returnMostRecent, without the cache.
+        
+        Input:
+        restrict -- as for self.returnMostRecent()
+        mode -- 'tuples', 'dict' or 'columns', the form of the result
+        where -- default '', more conditions on the stations (s) and latest
+                 observations (l), starting with AND
+        params -- the parameters of where'''
+        restriction, stations = stationRestriction(restrict)
+        sql = '''SELECT X(s.geom) AS X, Y(s.geom) AS Y,
+        l.station, s.label, s.country, l.utc, l.windspeed_mph, l.windspeed_kts,
+        l.winddirection, l.temperature_c, l.temperature_f, l.relativehumidity
+        FROM latest AS l JOIN stations AS s ON s.station = l.station
+        WHERE l.obs_epoch >= %d --Check currency
+        %s
+        %s
+        ORDER BY l.utc DESC;
+        ''' % (nDaysAgo(1), restriction, where)
         if self.verbose: print sql
-        self.cur.execute(sql)
-        if returnDict == False:
+        self.cur.execute(sql, stations + tuple(params))
+        if mode == 'columns':
+            return columnArrays(self.cur.fetchall())
+        if mode == 'tuples':
             return self.cur.fetchall()
-        elif returnDict == True:
+        elif mode == 'dict':
             # Return a list of dictionaries
             result, retval = self.cur.fetchall(), []
             for vals in result:
@@ -412,23 +1151,614 @@ class metarsqlite3db:
                         'label': str(vals[3]), 'country': str(vals[4]),
                         'utc': str(vals[5]), 'windspeed_mph': vals[6],
                         'windspeed_kts': vals[7], 'winddirection': vals[8],
-                        'temperature_c': vals[9], 'temperature_f': vals[10]})
+                        'temperature_c': vals[9], 'temperature_f': vals[10],
+                        'relativehumidity': vals[11]})
             return retval
             
     def returnBoundingBox(self, restrict=None):
-        '''Returns the bounding box of the points to be mapped, in EPSG:4326 coordinates
-        Calls self.returnMostRecent(restrict)
+        '''Returns the bounding box of the points to be mapped (the stations
+        with observations in the last 24 hours), in EPSG:4326 coordinates.
+        The extent is computed by the database, from the spatial index (whose
+        single precision boxes may be larger than the points by about 1e-5
+        degrees).
         
         Input:
         restrict -- default None, a list of strings of METAR station names to
                     restrict the determination of the boounding box from.
         Output: 
         A tuple of tuples, containing a pair of floats representing coordinates
-        of the form: lower left corner XY, upper right corner XY: ((X,Y),(X,Y))'''
-        xs,ys = [],[]
-        for pt in self.returnMostRecent(restrict=restrict):
-            xs.append(pt[0]), ys.append(pt[1])
-        return ((min(xs),min(ys)),(max(xs),max(ys)))
+        of the form: lower left corner XY, upper right corner XY: ((X,Y),(X,Y))
+        Raises ValueError if there are no points to map.'''
+        def query():
+            restriction, stations = stationRestriction(restrict)
+            # The boxes in the spatial index are the points, without parsing each geom
+            sql = '''SELECT MIN(i.xmin), MIN(i.ymin), MAX(i.xmax), MAX(i.ymax)
+            FROM latest AS l JOIN stations AS s ON s.station = l.station
+            JOIN idx_stations_geom AS i ON i.pkid = s.ROWID
+            WHERE l.obs_epoch >= %d --Check currency
+            %s;
+            ''' % (nDaysAgo(1), restriction)
+            if self.verbose: print sql
+            xmin, ymin, xmax, ymax = self.cur.execute(sql, stations).fetchone()
+            if xmin is None:
+                raise ValueError('There are no observations from the last 24 hours to map')
+            return ((xmin,ymin),(xmax,ymax))
+        return self.cachedQuery(('boundingBox', None, stationsKey(restrict), 1), query)
+            
+    def returnHistory(self, stations, start, end, bucket='hour', measures=HISTORY_MEASURES, returnDict=False, returnColumns=False):
+        '''Returns the observations of stations over a period of time,
+        aggregated by the database into buckets of time: for each station and
+        bucket, the number of observations, and the minimum, mean and maximum
+        of each measure. Buckets without observations are left out.
+        
+        Input:
+        stations -- a list of (string) station codes, or None for all stations
+        start, end -- the period, as datetime.datetime objects (in UTC) or UNIX
+                      times. start is included, end is not.
+        bucket -- default 'hour', the size of the buckets: 'hour', 'day', or a
+                  number of seconds. Buckets start at whole multiples of their
+                  size since the UNIX epoch (so days start at midnight UTC).
+        measures -- default HISTORY_MEASURES, the columns to aggregate, any
+                    of HISTORY_MEASURES
+        returnDict, returnColumns -- as for self.returnMostRecent(). The
+                                     columns are those of historySchema(measures).
+        Output:
+        By default a list of tuples of station, bucket (the UNIX time of its
+        start), count, then the minimum, mean and maximum of each measure,
+        ordered by station and bucket.'''
+        size = BUCKETS.get(bucket, bucket)
+        if not isinstance(size, (int, long)) or size <= 0:
+            raise ValueError('bucket must be one of {buckets} or a positive number of seconds, not {bucket}'.format(buckets=sorted(BUCKETS), bucket=bucket))
+        for measure in measures:
+            if measure not in HISTORY_MEASURES:
+                raise ValueError('Cannot aggregate {measure}: expected any of {measures}'.format(measure=measure, measures=HISTORY_MEASURES))
+        start, end = epochTime(start), epochTime(end)
+        mode = resultMode(returnDict, returnColumns)
+        key = ('history', mode, stationsKey(stations), start, end, size, tuple(measures))
+        return self.cachedQuery(key, lambda: self.queryHistory(stations, start, end, size, measures, mode))
+        
+    def queryHistory(self, stations, start, end, size, measures, mode):
+        '''Runs the query of self.returnHistory, without the cache, with start
+        and end as UNIX times and the bucket size in seconds. The observations
+        of the main database and the partitions of the period are queried as
+        one (UNION ALL); if there are more partitions than can be attached at
+        once, they are aggregated a batch at a time into a temporary table,
+        and the batches combined.'''
+        restriction, params = stationRestriction(stations)
+        keys = self.partitionsBetween(start, end)
+        batches = [keys[i:i + self.maxAttached] for i in range(0, len(keys), self.maxAttached)] or [[]]
+        def source(keys, main=True):
+            # The observations of the partitions of keys (and the main database)
+            selects = ['''SELECT l.station, l.obs_epoch, measures FROM schema.tableName AS l
+            WHERE l.obs_epoch >= ? AND l.obs_epoch < ? %s'''.replace('tableName', self.tableName).replace('schema', schema).replace('measures', ', '.join(measures)) % restriction
+                for schema in (['main'] if main else []) + [self.attachPartition(key) for key in keys]]
+            return '(%s)' % '\nUNION ALL\n'.join(selects), ((start, end) + params)*len(selects)
+        if len(batches) == 1:
+            table, values = source(batches[0])
+            if not batches[0]:
+                # Uses the (station, obs_epoch) index
+                table, values = 'main.' + self.tableName, (start, end) + params
+                restriction = 'WHERE obs_epoch >= ? AND obs_epoch < ? ' + restriction.replace('l.station', 'station')
+            else:
+                restriction = ''
+            aggregates = ''.join(', MIN(%s), AVG(%s), MAX(%s)' % (measure, measure, measure) for measure in measures)
+            sql = '''SELECT station, (obs_epoch / %d) * %d AS bucket, COUNT(*)%s
+            FROM %s
+            %s
+            GROUP BY station, bucket
+            ORDER BY station, bucket;
+            ''' % (size, size, aggregates, table, restriction)
+            if self.verbose: print sql
+            result = self.cur.execute(sql, values).fetchall()
+        else:
+            partials = ''.join(', MIN(%s), SUM(%s), COUNT(%s), MAX(%s)' % ((measure,)*4) for measure in measures)
+            self.conn.execute('DROP TABLE IF EXISTS temp.history;')
+            self.conn.execute('CREATE TEMP TABLE history (station, bucket, count%s);' %
+                ''.join(', %s_min, %s_sum, %s_n, %s_max' % ((measure,)*4) for measure in measures))
+            for i, keys in enumerate(batches):
+                table, values = source(keys, i == 0)
+                sql = '''INSERT INTO temp.history SELECT station, (obs_epoch / %d) * %d AS bucket, COUNT(*)%s
+                FROM %s GROUP BY station, bucket;''' % (size, size, partials, table)
+                if self.verbose: print sql
+                self.cur.execute(sql, values)
+            aggregates = ''.join(', MIN(%s_min), SUM(%s_sum)*1.0/SUM(%s_n), MAX(%s_max)' % ((measure,)*4) for measure in measures)
+            result = self.cur.execute('''SELECT station, bucket, SUM(count)%s FROM temp.history
+            GROUP BY station, bucket ORDER BY station, bucket;''' % aggregates).fetchall()
+            self.conn.execute('DROP TABLE temp.history;')
+            self.conn.commit()
+        schema = historySchema(measures)
+        if mode == 'columns':
+            return columnArrays(result, schema)
+        if mode == 'dict':
+            names = [name for name, dtype in schema]
+            return [dict(zip(names, row)) for row in result]
+        return result
+            
+class latestIndex:
+    '''
+    The UNIX time of the latest stored observation of each station, held in
+    memory, so that an observation can be checked against it without a
+    query: on a 30-minute cron, most stations' files still hold the
+    observation stored by the run before.
+    '''
+    def __init__(self, times):
+        '''
+        Input:
+        times -- a dictionary of station: UNIX time of its latest observation
+                 (from metarsqlite3db.latestTimes())
+        '''
+        self.times = times
+        
+    def isKnown(self, station, epoch):
+        '''Returns True if epoch is the time of the latest observation of station'''
+        return epoch is not None and self.times.get(station) == epoch
+        
+    def isKnownFile(self, station, lines):
+        '''Returns True if the lines of a decoded .TXT file hold the latest
+        observation of station, from their date line alone (see
+        metarparse.lineEpoch()), without parsing the file'''
+        return len(lines) > 1 and self.isKnown(station, metarparse.lineEpoch(lines[1]))
+        
+    def update(self, observations):
+        '''Records the times of observations (tuples of values, as from
+        METARTxtFile.observationValues()) that have been stored'''
+        times = self.times
+        for values in observations:
+            station, epoch = values[0], values[2]
+            if epoch is not None and epoch > times.get(station):
+                times[station] = epoch
+        return None
+        
+class metarHarvester:
+    '''
+    Retrieves the METAR .TXT files of many stations concurrently, handing the
+    parsed results to a single writer (the thread that calls self.harvest)
+    which adds them to the database.
+    '''
+    def __init__(self, metardb, concurrency=8, timeout=10, retries=2, source=NOAA_SOURCE, verbose=False, batchsize=200, cache=None, backoff=True, resume=True, stale=900, skipKnown=True):
+        '''
+        Input:
+        metardb -- a metarsqlite3db object where the harvested data is stored.
+                   Only the thread calling self.harvest() writes to it.
+        concurrency -- default 8, the maximum number of stations retrieved at
+                       the same time.
+        timeout -- default 10, seconds to wait for each request before giving up.
+        retries -- default 2, the number of times a request is repeated after a
+                   timeout, connection error or server (5xx) error. Client
+                   errors (e.g. 403 Forbidden, 404 Not Found) are not retried.
+        source -- the directory URL the .TXT files are retrieved from. Can be
+                  pointed at a local stand-in server for testing.
+        verbose -- Boolean (default False), prints each station as it is stored.
+        batchsize -- default 200, the number of parsed stations written to
+                     metardb in each transaction.
+        cache -- default None, a fetch.httpCache. If given, stations are
+                 retrieved through it, and those whose file has not changed
+                 since it was last retrieved are neither parsed nor stored.
+        backoff -- Boolean (default True), skip stations that have recently
+                   failed (forbidden, missing, empty or unparsable), trying
+                   them again after an exponentially growing delay (see
+                   metarsqlite3db.recordFailures()).
+        resume -- Boolean (default True), resume an interrupted run, if there
+                  is one, rather than start a new one (see self.harvest()).
+        stale -- default 900, seconds without a checkpoint after which a run
+                 is taken to have died, and can be resumed.
+        skipKnown -- Boolean (default True), do not parse files whose date
+                     line shows that they hold the latest observation
+                     already stored (see self.parseWorker()).
+        '''
+        self.metardb = metardb
+        self.concurrency = max(int(concurrency), 1)
+        self.timeout = timeout
+        self.retries = retries
+        self.source = source
+        self.verbose = verbose
+        self.batchsize = max(int(batchsize), 1)
+        self.cache = cache
+        self.backoff = backoff
+        self.resume = resume
+        self.stale = stale
+        self.skipKnown = skipKnown
+        self.retryDelay = 0.5 # Seconds, multiplied by the attempt number
+        self.stats = {}
+        self.stages = {} # Name: pipeline.stage, of the current or last run
+        
+    def fetch(self, station):
+        '''Returns the lines of the .TXT file of station, as a list of strings,
+        or None if self.cache reports that it has not changed (see
+        self.fetchURL()).'''
+        return self.fetchURL(self.source + station + '.TXT')
+        
+    def fetchURL(self, url):
+        '''Returns the lines of the file at url, as a list of strings, or None
+        if self.cache reports that it has not changed.
+        Timeouts, connection errors and server errors are retried up to
+        self.retries times; if the last attempt fails its error is raised.
+        Each attempt is timed as fetch in pipeline.METRICS, and the bytes
+        retrieved, unchanged files, HTTP errors (by code) and retries are
+        counted.
+        Responses are not saved in self.cache until the caller has stored
+        what they hold, and commits them (see self.commitURLs()).'''
+        attempt = 0
+        while True:
+            start = time.time()
+            try:
+                if self.cache is not None:
+                    text, changed = self.cache.fetch(url, self.timeout, defer=True)
+                    pipeline.METRICS.time('fetch', time.time() - start)
+                    if not changed:
+                        pipeline.METRICS.count('fetch.unchanged')
+                        return None
+                    pipeline.METRICS.count('fetch.bytes', len(text))
+                    return text.splitlines(True)
+                response = urllib2.urlopen(url, timeout=self.timeout)
+                try:
+                    lines = response.readlines()
+                finally:
+                    response.close()
+                pipeline.METRICS.time('fetch', time.time() - start)
+                pipeline.METRICS.count('fetch.bytes', sum(len(line) for line in lines))
+                return lines
+            except urllib2.HTTPError, e:
+                pipeline.METRICS.time('fetch', time.time() - start)
+                pipeline.METRICS.count('fetch.http_{code}'.format(code=e.code))
+                if e.code < 500 or attempt >= self.retries:
+                    raise # Retrying will not help, or we have run out of attempts
+            except (urllib2.URLError, socket.error), e:
+                # Includes socket.timeout
+                pipeline.METRICS.time('fetch', time.time() - start)
+                pipeline.METRICS.count('fetch.errors')
+                if attempt >= self.retries:
+                    raise
+            pipeline.METRICS.count('fetch.retries')
+            attempt += 1
+            time.sleep(self.retryDelay * attempt)
+            
+    def commitURLs(self, urls, failed=()):
+        '''Saves the responses of urls in self.cache (if any), now that their
+        observations have been stored, and forgets those of the failed urls,
+        so that they are retrieved again in full'''
+        if self.cache is not None:
+            self.cache.commit(urls)
+            self.cache.discard(failed)
+        return None
+        
+    def fetchWorker(self, stations, fetched, stopping):
+        '''The fetch stage: takes stations from the stations queue until it
+        is empty (or until stopping is set), retrieving each, and puts a
+        (station, lines, error, seconds) tuple on the fetched queue for the
+        parse stage, where lines is the lines of its file (None if it has not
+        changed since it was last retrieved, or if it could not be retrieved,
+        when error is the error) and seconds is the time spent retrieving it.
+        If the stage itself fails (rather than a station), a tuple of None,
+        None, the error and 0 is put on the fetched queue instead, and the
+        thread stops. It stops without a word if the pipeline is stopped
+        (see pipeline.stop()).'''
+        try:
+            while not stopping.is_set():
+                try:
+                    station = stations.get_nowait()
+                except Queue.Empty:
+                    return None
+                start = time.time()
+                try:
+                    lines, error = self.fetch(station), None
+                except Exception, e:
+                    lines, error = None, e
+                seconds = time.time() - start
+                self.stages['fetch'].record(seconds)
+                fetched.put((station, lines, error, seconds))
+        except pipeline.stopped:
+            pass
+        except BaseException, e:
+            try:
+                fetched.put((None, None, e, 0.))
+            except pipeline.stopped:
+                pass
+        return None
+                
+    def parseWorker(self, fetched, parsed, n, stopping):
+        '''The parse stage: takes n (station, lines, error, seconds) tuples
+        from the fetched queue (or fewer, if stopping is set), parsing the lines of each, and puts a
+        (station, values, error, seconds) tuple on the parsed queue for the
+        writer, where values is a tuple of METARTxtFile.stationValues() and
+        METARTxtFile.observationValues().
+        One of values and error is None, or both are if the station's file has
+        not changed since it was last retrieved. Only the values are kept, so
+        the lines of each file are let go as soon as it has been parsed.
+        If self.skipKnown, files whose date line shows that they hold the
+        latest observation already stored (see metarsqlite3db.knownIndex())
+        are not parsed, and their values are KNOWN.
+        If a stage fails (rather than a station), a tuple of None, None, the
+        error and 0 is put on the parsed queue instead, and the thread
+        stops. It stops without a word if the pipeline is stopped (see
+        pipeline.stop()).'''
+        try:
+            known = self.metardb.knownIndex() if self.skipKnown else None
+            for i in range(n):
+                if stopping.is_set():
+                    return None
+                station, lines, error, seconds = fetched.get()
+                if station is None:
+                    # A fetch thread failed: pass its error on to the writer
+                    parsed.put((None, None, error, seconds))
+                    return None
+                start = time.time()
+                values = None
+                if lines is not None and known is not None and known.isKnownFile(station, lines):
+                    values = KNOWN
+                    pipeline.METRICS.count('parse.known')
+                elif lines is not None:
+                    try:
+                        metar = METARTxtFile(station, dataList=lines, source=self.source)
+                        values = (metar.stationValues(), metar.observationValues())
+                    except Exception, e:
+                        error = e
+                lines = None
+                self.stages['parse'].record(time.time() - start)
+                parsed.put((station, values, error, seconds))
+        except pipeline.stopped:
+            pass
+        except BaseException, e:
+            try:
+                parsed.put((None, None, e, 0.))
+            except pipeline.stopped:
+                pass
+        return None
+                
+    def write(self, batch, failed):
+        '''Adds a batch of (station, values) tuples to self.metardb in one
+        transaction, returning the number of rows added. If the batch cannot be
+        written, its rows are written one at a time so that a single bad row
+        only fails its own station, which is recorded in failed.'''
+        if not batch:
+            return 0
+        try:
+            self.metardb.addStations([vals[0] for station, vals in batch if vals[0] is not None])
+            return self.metardb.addObservations([vals[1] for station, vals in batch])
+        except Exception:
+            added = 0
+            for station, (stationValues, observationValues) in batch:
+                try:
+                    if stationValues is not None:
+                        self.metardb.addStations([stationValues])
+                    added += self.metardb.addObservations([observationValues])
+                except Exception, e:
+                    failed[station] = str(e)
+            return added
+                
+    def harvest(self, stations, resume=None):
+        '''Retrieves and stores the data of all stations, as a pipeline of
+        stages joined by bounded queues (see pipeline): up to self.concurrency
+        threads retrieve the files (self.fetchWorker()), another thread
+        parses them (self.parseWorker()), and this thread, the writer, drops
+        observations that are already stored as it takes them off its queue
+        (the dedupe stage, comparing them with the latest observation of each
+        station) and writes the rest to self.metardb in batches of
+        self.batchsize. The queues hold at most self.concurrency*4 files, so
+        that however many stations there are, only a few files are in memory
+        at once.
+        
+        Each harvest is a run, recorded in self.metardb with the progress of
+        each of its stations, checkpointed with each batch. If self.resume,
+        an interrupted (or killed) run of the same stations is resumed
+        instead: only its pending stations are harvested. Interrupted runs of
+        other stations are left alone (see metarsqlite3db.resumeRun()).
+        Stations still pending in another live run (e.g. an overlapping cron
+        job) are left to it.
+        
+        A station that cannot be retrieved, parsed or written is recorded in
+        failed; if a stage itself fails, the pipeline is stopped (see
+        pipeline.stop()), so that no thread is left waiting on a queue, and
+        its error is raised here and the run is left interrupted.
+        
+        Input:
+        stations -- A list of station names to retrieve and store data for.
+        resume -- default None, whether to resume an interrupted run; None
+                  uses self.resume.
+        Output:
+        A dictionary of statistics about the run (also kept as self.stats):
+        run (its id), resumed (Boolean), stations, busy (stations left to
+        another live run), skipped (stations not tried, as they are backing
+        off after failing), saved (an estimate of the seconds of retrieval time
+        that skipping them saved), parsed, unchanged (files not parsed, as
+        they had not changed), known (files not parsed, as their date line
+        showed they held the latest observation already stored), duplicates
+        (observations parsed but not written, as they were already stored), added (new rows in the database), failed (a
+        dictionary of station: error string), elapsed (seconds), rate
+        (stations per second), stages (a dictionary of the fetch, parse,
+        dedupe and write stages' items, busy seconds, rate and throughput)
+        and queues (a dictionary of the fetched and parsed queues' depths).'''
+        run, resumed = None, False
+        if self.resume if resume is None else resume:
+            run, pending = self.metardb.resumeRun(stations, self.stale)
+            if run is not None:
+                stations, resumed = pending, True
+                if self.verbose: print 'Resuming run {run}: {n} stations to go'.format(run=run, n=len(stations))
+        live = self.metardb.busyStations(self.stale, exclude=run)
+        busy = [station for station in stations if station in live]
+        if busy:
+            stations = [station for station in stations if station not in live]
+        failing = self.metardb.failingStations() if self.backoff else {}
+        now = time.time()
+        skipped = [station for station in stations if failing.get(station, (0, 0))[1] > now]
+        if skipped:
+            skipping = set(skipped)
+            stations = [station for station in stations if station not in skipping]
+        if run is None:
+            run = self.metardb.startRun(stations, busy + skipped)
+        elif busy or skipped:
+            self.metardb.checkpointRun(run, [('skipped', station) for station in busy + skipped])
+        known = self.metardb.knownIndex()
+        todo = Queue.Queue()
+        for station in stations:
+            todo.put(station)
+        # Bounded, so the fetchers cannot run too far ahead of the parser, nor
+        # the parser ahead of the writer
+        stopping = threading.Event()
+        fetched = pipeline.boundedQueue(maxsize=self.concurrency*4, stopping=stopping)
+        parsed = pipeline.boundedQueue(maxsize=self.concurrency*4, stopping=stopping)
+        workers = min(self.concurrency, len(stations))
+        self.stages = {'fetch': pipeline.stage('fetch', workers), 'parse': pipeline.stage('parse'),
+                       'dedupe': pipeline.stage('dedupe'), 'write': pipeline.stage('write')}
+        threads = []
+        for i in range(workers):
+            threads.append(threading.Thread(target=self.fetchWorker, args=(todo, fetched, stopping), name='fetch-%d' % i))
+        threads.append(threading.Thread(target=self.parseWorker, args=(fetched, parsed, len(stations), stopping), name='parse'))
+        for t in threads:
+            t.daemon = True
+            t.start()
+        start = time.time()
+        parsedCount, unchanged, knownCount, duplicates, added, failed, batch, settled = 0, 0, 0, 0, 0, {}, [], []
+        fetchTime, failedTime = 0., 0.
+        try:
+            for i in range(len(stations)):
+                station, vals, error, seconds = parsed.get()
+                if station is None:
+                    # A stage failed, and cannot finish the run
+                    raise error
+                fetchTime += seconds
+                if error is not None:
+                    failedTime += seconds
+                    failed[station] = str(error)
+                    settled.append(station)
+                    if self.verbose: print 'Cannot process {station}: {error}'.format(station=station, error=str(error))
+                elif vals is None:
+                    unchanged += 1
+                    settled.append(station)
+                elif vals is KNOWN:
+                    knownCount += 1
+                    settled.append(station)
+                else:
+                    parsedCount += 1
+                    dedupeStart = time.time()
+                    epoch = vals[1][2]
+                    duplicate = known.isKnown(station, epoch)
+                    self.stages['dedupe'].record(time.time() - dedupeStart)
+                    if duplicate:
+                        # Already stored: the station has not reported since
+                        duplicates += 1
+                        settled.append(station)
+                    else:
+                        if self.verbose: print(station)
+                        batch.append((station, vals))
+                if len(batch) >= self.batchsize or len(settled) >= self.batchsize:
+                    added += self.writeBatch(run, batch, settled, failed)
+                    batch, settled = [], []
+            added += self.writeBatch(run, batch, settled, failed)
+        except BaseException:
+            # Including KeyboardInterrupt: leave it to be resumed, once the
+            # other stages have stopped
+            pipeline.stop(stopping, [fetched, parsed], threads)
+            if self.cache is not None:
+                self.cache.discard()
+            self.metardb.finishRun(run, 'interrupted')
+            raise
+        for t in threads:
+            t.join()
+        self.metardb.finishRun(run)
+        if self.backoff:
+            self.metardb.recordFailures(failed)
+            self.metardb.clearFailures([station for station in stations if station in failing and station not in failed])
+        # Stations that fail tend to fail slowly (timeouts, retries), so
+        # estimate from those if there are any
+        if failed:
+            saved = len(skipped)*failedTime/len(failed)
+        else:
+            saved = len(skipped)*fetchTime/len(stations) if stations else 0.
+        elapsed = time.time() - start
+        self.stats = {'run': run, 'resumed': resumed, 'stations': len(stations),
+                      'busy': len(busy), 'skipped': len(skipped),
+                      'saved': saved, 'parsed': parsedCount,
+                      'unchanged': unchanged, 'known': knownCount, 'duplicates': duplicates,
+                      'added': added, 'failed': failed, 'elapsed': elapsed,
+                      'rate': len(stations)/elapsed if elapsed > 0 else 0.,
+                      'stages': dict((name, s.summary(elapsed)) for name, s in self.stages.items()),
+                      'queues': {'fetched': fetched.summary(), 'parsed': parsed.summary()}}
+        if self.verbose:
+            print 'Harvested {n} stations in {elapsed:.1f} s ({rate:.1f} stations/second), {added} new observations, {unchanged} unchanged, {known} already stored'.format(n=len(stations), elapsed=elapsed, rate=self.stats['rate'], added=added, unchanged=unchanged, known=knownCount + duplicates)
+            for line in pipeline.report([(name, self.stats['stages'][name]) for name in ['fetch', 'parse', 'dedupe', 'write']],
+                                        [(name, self.stats['queues'][name]) for name in ['fetched', 'parsed']]):
+                print line
+            if skipped:
+                print 'Skipped {skipped} failing stations, saving about {saved:.1f} s of retrieval'.format(skipped=len(skipped), saved=saved)
+            if busy:
+                print 'Left {busy} stations to another harvest that is still running'.format(busy=len(busy))
+        return self.stats
+        
+    def harvestCycles(self, stations=None, hours=None, source=CYCLES_SOURCE):
+        '''Retrieves and stores the reports of every station (or of stations)
+        from NOAA's hourly cycle files of raw METAR reports: one request per
+        hour, rather than one per station. Reports are decoded with metarcode.
+        The cycle files do not give the stations' locations, so stations that
+        are not yet in the database are harvested from their .TXT files first
+        (see self.harvest()).
+        
+        Input:
+        stations -- default None, a list of station names to store data for;
+                    None stores every station in the cycle files
+        hours -- default None, a list of the hours (UTC) of the cycle files
+                 to read. None reads the current hour's and, as reports
+                 arrive late, the previous hour's.
+        source -- the directory URL the cycle files are retrieved from
+        Output:
+        A dictionary of statistics (also kept as self.stats): cycles (files
+        read), unchanged (files not decoded, as they had not changed),
+        reports (observations decoded), added (new rows in the database),
+        failed (a dictionary of station: error string, for reports that
+        could not be decoded), elapsed (seconds) and rate (reports per second).'''
+        start = time.time()
+        now = dt.datetime.utcnow()
+        if hours is None:
+            hours = [(now - dt.timedelta(hours=1)).hour, now.hour]
+        keep = None
+        if stations is not None:
+            keep = set(stations)
+            known = set(row[0] for row in self.metardb.cur.execute('SELECT station FROM stations;').fetchall())
+            new = [station for station in stations if station not in known]
+            if new:
+                # Their locations, never an interrupted run's stations instead
+                self.harvest(new, resume=False)
+        cycles, unchanged, reports, added, failed = 0, 0, 0, 0, {}
+        for hour in hours:
+            lines = self.fetchURL(source + metarcode.cycleName(hour))
+            cycles += 1
+            if lines is None:
+                unchanged += 1
+                continue
+            observations, errors = metarcode.cycleObservations(''.join(lines), keep, now)
+            failed.update(errors)
+            reports += len(observations)
+            added += self.metardb.addObservations(observations, self.batchsize)
+            self.commitURLs([source + metarcode.cycleName(hour)])
+        elapsed = time.time() - start
+        self.stats = {'cycles': cycles, 'unchanged': unchanged, 'reports': reports,
+                      'added': added, 'failed': failed, 'elapsed': elapsed,
+                      'rate': reports/elapsed if elapsed > 0 else 0.}
+        if self.verbose:
+            print 'Read {cycles} cycle files in {elapsed:.1f} s: {reports} reports, {added} new observations, {failed} undecodable'.format(cycles=cycles, elapsed=elapsed, reports=reports, added=added, failed=len(failed))
+        return self.stats
+        
+    def writeBatch(self, run, batch, settled, failed):
+        '''The write stage: writes a batch of (station, values) tuples (see
+        self.write()) and checkpoints them, with the settled stations (those
+        with nothing to write), in run, then saves their responses in
+        self.cache, so that a file is only seen as unchanged once what it
+        holds has been stored. Returns the number of rows added.'''
+        start = time.time()
+        added = self.write(batch, failed)
+        stations = settled + [station for station, vals in batch]
+        self.checkpoint(run, stations, failed)
+        self.commitURLs([self.source + station + '.TXT' for station in stations if station not in failed],
+                        [self.source + station + '.TXT' for station in stations if station in failed])
+        self.stages['write'].record(time.time() - start, len(batch))
+        return added
+        
+    def checkpoint(self, run, stations, failed):
+        '''Records stations as settled in run: failed if they are in failed,
+        done otherwise.'''
+        if stations:
+            self.metardb.checkpointRun(run, [('failed' if station in failed else 'done', station) for station in stations])
+        return None
             
 class foliumMap():
     '''
@@ -453,14 +1783,18 @@ class foliumMap():
                   "Stamen Toner"]
         restrict -- default None, a list of strings of METAR station names to
                     restrict the map to.
-        coastline -- default None, a path to a GeoJSON overlay. This parameter is
-                     is currently ignored, due to a bug in Folium.
+        coastline -- default None, a path to a GeoJSON overlay. Folium's
+                     overlay is disabled, due to a bug in Folium; it is drawn
+                     by makeMap(data=True) instead.
         '''
+        import folium # For building a Leaflet tile map
+        import symbology # For styling the markers
         self.metardb = metardb
         self.mapName = mapName
         self.restrict = restrict
         self.coastline = coastline
-        self.geoJSONbug = True # Disables the coastline overlay
+        self.geoJSONbug = True # Disables Folium's coastline overlay
+        self.classifications = dict(symbology.CLASSIFICATIONS) # Column: symbology.classification
         self.zoom_start = 6
         self.width = '100%'
         self.height = '100%'
@@ -481,8 +1815,13 @@ class foliumMap():
         popup -- The text to be used on popup. Note that it must escape special
                  characters with a double backslash, and uses in-line HTML
                  formatting (e.g. bold tags <b></b> and linebreaks <br>
-        point -- default True, use point markers (pins). If False, uses circle
-                 markers.'''
+        point -- default True, use point markers (pins). If False, uses
+                 triangle markers, or circle markers where the wind is calm.
+        rotation -- the rotation of the triangle marker, in degrees (see
+                    symbology.style())
+        fill_colour -- the fill colour of the triangle or circle marker
+        radius -- the radius of the triangle marker, in pixels; 0 makes a
+                  circle marker (see symbology.style())'''
         if point == True:
             # Add a point symbol
             self.map.simple_marker(location=[float(x),float(y)],
@@ -490,37 +1829,24 @@ class foliumMap():
                 popup_on=True
                 )
         elif point == False:
-            if radius == 0 and rotation == 0:
+            if radius == 0:
                 # If there's no wind, plot a circle marker
                 self.map.circle_marker(location=[x,y],popup=popup,radius=70000,line_color=fill_colour,fill_color=fill_colour)
             else:
                 # If there's some wind, plot a triangle, rotated in the appropriate direction
-                self.map.polygon_marker(location=[x,y],popup=popup,num_sides=3,rotation=rotation+30,radius=radius,fill_color=fill_colour)
+                self.map.polygon_marker(location=[x,y],popup=popup,num_sides=3,rotation=rotation,radius=radius,fill_color=fill_colour)
         return None
         
     def tempColour(self, temp):
         '''Returns a hex colour value, drawn from a hardcoded classification,
         to display the temperature information.
         The classification is made from colorbrewer2, diverging classification,
-        with 8 classes.
+        with 8 classes (see symbology.TEMPERATURE).
         
         Input:
-        temp -- The temperature value (integer)
+        temp -- The temperature value
         '''
-        if temp < 0:
-            return '#2166AC'
-        elif temp > 19:
-            return '#B2182B'
-        else:
-            colours = {'#4393C3': range(0,4),
-                       '#92C5DE': range(4,7),
-                       '#D1E5F0': range(7,10),
-                       '#FDDBC7': range(10,13),
-                       '#F4A582': range(13,16),
-                       '#D6604D': range(16,19)}
-            for k in colours:
-                if temp in colours[k]:
-                    return k
+        return self.classifications['temperature_c'].colour(temp)
                      
     def addOverlay(self):
         '''Adds a GeoJSON overlay to the Folium map.
@@ -534,7 +1860,7 @@ class foliumMap():
             )
         return None
         
-    def makeMap(self, point=True):
+    def makeMap(self, point=True, data=False, sidecar=False, levels=None, colourBy='temperature_c'):
         '''Makes the folium map, adding points and their popups, the overlay,
         and saving the map to disk as an HTML document, using parameters from
         self.__init__().
@@ -544,30 +1870,144 @@ class foliumMap():
                  information. If False, makes polygon markers that respond to
                  some of the weather attributes in their symbology (and still
                  have the same popups.
+        data -- default False. If True, the observations are written once as
+                a compact JSON payload, and the markers and popups are built
+                from it in the browser (see mapdata), rather than Folium
+                writing the JavaScript of every marker.
+        sidecar -- default False. If True (with data), the payload is written
+                   to a separate .js file beside the map (see
+                   mapdata.sidecarPath), rather than inline.
+        levels -- default None, a continuous range of zoom levels (e.g.
+                  range(0, 6)) at which the stations are shown as clusters
+                  (see cluster), each loaded only when needed. Implies data.
+        colourBy -- default 'temperature_c', the column whose classification
+                    (in self.classifications) colours the station markers,
+                    and the clusters (by their mean of it).
+                    A ValueError is raised if it is not a column of
+                    MOST_RECENT_SCHEMA with a classification.
+        
+        With data, the coastline (if any) is drawn from simplified levels
+        fitted to the zoom (see overlay), rather than by Folium.
+        
+        The query, styling (including clustering, and building the payload or
+        markers) and rendering (writing the files) are timed as map.query,
+        map.style and map.render in pipeline.METRICS.
         '''
-        for row in self.metardb.returnMostRecent(restrict=self.restrict, returnDict=True):
-            try:
-                popup = '%s, %s\nUTC %s\nWind speed: <b>%d mph</b>\nDirection: <b>%d degrees</b>\nTemperature: <b>%d C</b>' % (row['station'], row['label'], str(row['utc']), row['windspeed_mph'], row['winddirection'], row['temperature_c'])
-            except:
-                continue
-            # Handle jQuery special characters in the pop-up
-            for sc in [':',',','\n','-']:
-                if sc == '\n':
-                    replace = '<br>'
-                else:
-                    replace = '\\%s' % sc
-                popup = popup.replace(sc,replace)
-            self.addPoint(row['Y'],row['X'],str(popup),point=point,rotation=row['winddirection'],radius=row['windspeed_mph'],fill_colour=self.tempColour(row['temperature_c']))
+        colourable = sorted(column for column in self.classifications if column in dict(MOST_RECENT_SCHEMA))
+        if colourBy not in colourable:
+            raise ValueError('Cannot colour the map by {column}: it must be one of {columns}'.format(column=colourBy, columns=', '.join(colourable)))
+        import numpy as np
+        import symbology
+        import mapdata # For writing the map as a compact data payload
+        import cluster # For clustering the stations at low zoom levels
+        import overlay # For simplified coastline overlays
+        start = time.time()
+        columns = self.metardb.returnMostRecent(restrict=self.restrict, returnColumns=True)
+        pipeline.METRICS.time('map.query', time.time() - start)
+        start = time.time()
+        styles = symbology.style(columns, colourBy, self.classifications.get(colourBy))
+        if levels is not None:
+            data = True
+            clusters = cluster.levels(cluster.columns(columns, colourBy), self.classifications[colourBy], levels)
+        if data:
+            payload = mapdata.payload(columns, styles)
+        else:
+            popups = symbology.popups(columns, styles['known'])
+            for popup, i in zip(popups, np.flatnonzero(styles['known'])):
+                self.addPoint(columns['Y'][i],columns['X'][i],popup,point=point,rotation=int(styles['rotation'][i]),radius=int(styles['radius'][i]),fill_colour=styles['palette'][styles['colour'][i]])
         
         # Add the GeoJSON overlay
-        if self.geoJSONbug == False:
+        if self.geoJSONbug == False and not data:
             # If the Folium bug is repaired
             self.addOverlay()
+        pipeline.METRICS.time('map.style', time.time() - start)
         
         # Write the map HTML and JS
+        start = time.time()
         self.map.create_map(path=self.mapName)
+        if data:
+            if sidecar:
+                path = mapdata.sidecarPath(self.mapName)
+                mapdata.writeSidecar(payload, path)
+                html = mapdata.script(payload, point, sidecar=os.path.basename(path))
+            else:
+                html = mapdata.script(payload, point)
+            if levels is not None:
+                prefix = cluster.levelPrefix(self.mapName)
+                cluster.writeLevels(clusters, prefix)
+                html += cluster.script(levels, os.path.basename(prefix))
+            if self.coastline is not None:
+                coastline = overlay.coastlineLevels(self.coastline)
+                prefix = overlay.levelPrefix(self.mapName)
+                coastline.writeLevels(prefix)
+                html += overlay.script(coastline.zooms, os.path.basename(prefix))
+            mapdata.inject(self.mapName, html)
+        pipeline.METRICS.time('map.render', time.time() - start)
         return None
 
+def historySchema(measures=HISTORY_MEASURES):
+    '''Returns the columns of metarsqlite3db.returnHistory(returnColumns=True),
+    in order, with the NumPy dtype of each column's array: station, bucket
+    (the UNIX time of its start) and count, then the minimum, mean and
+    maximum of each measure (e.g. temperature_c_min, temperature_c_mean,
+    temperature_c_max).'''
+    schema = [('station', 'O'), ('bucket', 'i8'), ('count', 'i8')]
+    for measure in measures:
+        schema += [(measure + '_min', 'f8'), (measure + '_mean', 'f8'), (measure + '_max', 'f8')]
+    return schema
+
+def epochTime(when):
+    '''Returns a datetime.datetime (in UTC) or a number as integer UNIX time'''
+    if isinstance(when, dt.datetime):
+        return calendar.timegm(when.utctimetuple())
+    return int(when)
+
+def partitionKey(epoch, period):
+    '''Returns the key of the partition (e.g. '201410') of period (any of
+    PARTITIONS) that holds a UNIX time'''
+    return dt.datetime.utcfromtimestamp(epoch).strftime(PARTITIONS[period])
+
+def partitionBounds(key, period):
+    '''Returns the UNIX times that the partition of key starts at and ends
+    before'''
+    start = dt.datetime.strptime(key, PARTITIONS[period])
+    if period == 'month':
+        end = dt.datetime(start.year + start.month // 12, start.month % 12 + 1, 1)
+    else:
+        end = dt.datetime(start.year + 1, 1, 1)
+    return calendar.timegm(start.utctimetuple()), calendar.timegm(end.utctimetuple())
+
+def resultMode(returnDict=False, returnColumns=False):
+    '''Returns the form of result asked for by the returnDict and
+    returnColumns arguments of the metarsqlite3db query methods: 'columns',
+    'dict' or 'tuples'.'''
+    if returnColumns == True:
+        return 'columns'
+    return 'dict' if returnDict == True else 'tuples'
+
+def stationsKey(restrict):
+    '''Returns a hashable key of a list of stations (or None), for caching'''
+    return tuple(sorted(set(restrict))) if restrict != None else None
+
+def stationRestriction(restrict):
+    '''Returns an SQL condition limiting the latest observations (l) to a
+    list of stations, and its parameters. If restrict is None, the condition
+    is empty.'''
+    if restrict == None:
+        return '', ()
+    stations = tuple(restrict)
+    return 'AND l.station IN (%s)' % ','.join('?'*len(stations)), stations
+
+def columnArrays(rows, schema=MOST_RECENT_SCHEMA):
+    '''
+    Returns a dictionary of column name: NumPy array of rows (a list of
+    tuples, e.g. from cursor.fetchall()), with the names and dtypes of
+    schema. None becomes NaN in float columns.
+    '''
+    import numpy as np
+    columns = zip(*rows) if rows else [()]*len(schema)
+    return dict((name, np.array(values, dtype=dtype)) for (name, dtype), values in zip(schema, columns))
+
 def nDaysAgo(n):
     '''
     Returns a UNIX time stamp (integer seconds) of the time exactly n days ago
@@ -579,7 +2019,15 @@ def nDaysAgo(n):
     nago = calendar.timegm(nago.utctimetuple()) # Now, n days ago, as UNIX timestamp
     return nago
    
-def main(stations=['NZWN','NZAA','NZCH'], metardb='./data/metar.db', output='METAR-vis.html', coastline=r'./data/test.json', tiles='Mapbox Bright', show=False, verbose=True):
+def backoffDelay(failures, base=1800, maximum=7*86400):
+    '''
+    Returns the number of seconds to wait before trying a station again after
+    failures consecutive failures: base, doubling with each further failure,
+    up to maximum.
+    '''
+    return min(base*2**(max(failures, 1)-1), maximum)
+   
+def main(stations=['NZWN','NZAA','NZCH'], metardb='./data/metar.db', output='METAR-vis.html', coastline=r'./data/test.json', tiles='Mapbox Bright', show=False, verbose=True, concurrency=8, timeout=10, retries=2, cache='./data/httpcache', cycles=False, report=None, prometheus=None, profile=False, levels=None):
     '''If this is run as the primary program, it harvests the data once
     optionally making and then displaying the map. This could be scheudled to 
     run every 30 minutes using cron, if you want to harvest data from particular
@@ -593,46 +2041,84 @@ def main(stations=['NZWN','NZAA','NZCH'], metardb='./data/metar.db', output='MET
     metardb -- A path to the SQLite3 database. If it does not exist, it will be
                created.
     output -- Name and path of the output map
-    coastline -- A GeoJSON layer for overlay on the map (at present, ignored due
-                 to a bug in Folium)
+    coastline -- A GeoJSON layer for overlay on the map (ignored due to a bug
+                 in Folium, unless levels are given: then it is simplified
+                 for each zoom level; None for no overlay)
     tiles -- The Folium-prescribed tiles to use as a basemap
     show -- Boolean controlling whether the map is made or not (False is more
             useful when harvesting)
     verbose -- Boolean (default True), prints the stations retrieved to the terminal.
+    concurrency -- The maximum number of stations retrieved at the same time
+    timeout -- Seconds to wait for each station's request before giving up
+    retries -- Number of times a timed out or failed request is repeated
+    cache -- A directory for the cache of retrieved files, so that unchanged
+             stations are not parsed and stored again (None to disable)
+    cycles -- Boolean (default False), read the hourly cycle files of raw
+              reports (two requests) rather than each station's .TXT file.
+              Stations not yet in the database are still harvested from
+              their .TXT files, once, for their locations.
+    report -- A path to write a JSON report of the run to: the harvest's
+              statistics, and the timings and counts of pipeline.METRICS
+              (None for no report)
+    prometheus -- A path to write the report to in the Prometheus text
+                  format, e.g. in node_exporter's textfile directory (None
+                  for none)
+    profile -- Boolean (default False), profile the run with cProfile,
+               writing the profile next to the report (see
+               pipeline.instrumentedRun())
+    levels -- A continuous range of zoom levels (e.g. range(0, 6)) at which
+              the map shows clusters of stations, rather than every station
+              (see foliumMap.makeMap()). Default: None, no clusters.
     '''
-    # Create or connect to DB
-    metardb = metarsqlite3db(metardb, verbose=False)
-    '''
-    # Loop through stations we care about, adding their data to the DB if it
-    # has not already been collected
+    def run():
+        # Create or connect to DB
+        db = metarsqlite3db(metardb, verbose=False)
+        
+        # Retrieve the stations we care about, adding their data to the DB if it
+        # has not already been collected. If a previous harvest was interrupted,
+        # this finishes it instead.
+        httpCache = fetch.httpCache(cache, timeout=timeout) if cache is not None else None
+        harvester = metarHarvester(db, concurrency=concurrency, timeout=timeout, retries=retries, verbose=verbose, cache=httpCache)
+        if cycles:
+            harvester.harvestCycles(stations)
+        else:
+            harvester.harvest(stations)
+        if show == True:
+            # Instantiate the map object and plot the relevant points
+            fmap = foliumMap(db, output, tiles, stations, coastline)
+            fmap.makeMap(point=False, levels=levels)
+        return harvester.stats
     
-    for i, station in enumerate(stations):
-        if station == 'OMDI':
-            index = i
-            break
-            
-    for station in stations[index:]:
-        if verbose: print(station)
-        metar = METARTxtFile(station, metardb)
-    '''
+    pipeline.instrumentedRun('main', run, report, prometheus, profile)
     if show == True:
-        # Instantiate the map object and plot the relevant points
-        fmap = foliumMap(metardb, output, tiles, stations, coastline)
-        fmap.makeMap(point=False)
+        import webbrowser # To see output
         while 1:
             webbrowser.open_new_tab(output)
             time.sleep(2) # Allow time to open the map, then return control
             break
     return None
 
-def getStations():
+def getStations(cache=None, source=NOAA_SOURCE):
     '''
     Gets all of the available METAR stations, as a list of station code strings.
+    See also fetch.stationIndex, which keeps the list between runs.
+    
+    Input:
+    cache -- default None, a fetch.httpCache to retrieve the listing through.
+    source -- the directory URL listing the .TXT files.
     '''
-    response = urllib2.urlopen('http://weather.noaa.gov/pub/data/observations/metar/decoded/')
-    html = response.read()
-    soup = BeautifulSoup(html).find_all('a')
-    return [str(s.get('href')).split('.')[0] for s in soup if '.TXT' in str(s.get('href'))]
+    return fetch.listStations(source, cache)
         
 if __name__ == '__main__':
-    main(stations=getStations(),show=True)
+    import argparse
+    parser = argparse.ArgumentParser(description='Harvest every METAR station NOAA lists, then make and show the map.')
+    parser.add_argument('--levels', type=int, default=None, metavar='ZOOM', help='show clusters of stations at zoom levels 0 to ZOOM (e.g. 5), rather than every station')
+    parser.add_argument('--coastline', default=None, help='draw this GeoJSON coastline, simplified for each zoom level, e.g. the 1:250k New Zealand coastline ./data/nzcoastline-1-250k.json (needs --levels)')
+    args = parser.parse_args()
+    if args.coastline is not None and args.levels is None:
+        parser.error('--coastline needs --levels')
+    options = {}
+    if args.levels is not None:
+        # With levels the coastline is drawn, so only the one asked for
+        options = {'levels': range(0, args.levels + 1), 'coastline': args.coastline}
+    main(stations=fetch.stationIndex().stations(), show=True, **options)
@@ -0,0 +1,126 @@
+# /usr/bin/env python
+'''
+mapdata
+-------
+
+Data-driven output for the Leaflet map.
+
+Rather than Folium writing a block of JavaScript (with an escaped popup)
+for every station, the latest observations are serialised once, as a
+compact JSON payload of columns and rows, and a single client-side loop
+builds the markers and popups from it. The payload can be written inline,
+or to a sidecar .js file next to the HTML (and leaflet-dvf.markers.min.js),
+which also works when the map is opened from disk.
+
+'''
+
+import os
+import json
+
+# The columns of each row of the payload
+COLUMNS = ['lon', 'lat', 'station', 'label', 'utc', 'windspeed_mph',
+           'winddirection', 'temperature_c', 'colour', 'rotation', 'radius']
+
+# Builds the markers from metarData, in the same style as foliumMap.addPoint,
+# in a layer group (metarStations) that can be swapped for clusters (see cluster)
+MARKERS_JS = '''
+var metarStations = L.layerGroup();
+(function (data, point) {
+    var c = {};
+    for (var i = 0; i < data.columns.length; i++) { c[data.columns[i]] = i; }
+    function escape(s) {
+        return String(s).replace(/&/g, '&amp;').replace(/</g, '&lt;').replace(/>/g, '&gt;');
+    }
+    for (var i = 0; i < data.rows.length; i++) {
+        var r = data.rows[i], latlng = new L.LatLng(r[c.lat], r[c.lon]), marker;
+        var colour = data.colours[r[c.colour]];
+        var popup = escape(r[c.station]) + ', ' + escape(r[c.label]) +
+            '<br>UTC ' + escape(r[c.utc]) +
+            '<br>Wind speed: <b>' + r[c.windspeed_mph] + ' mph</b>' +
+            '<br>Direction: <b>' + r[c.winddirection] + ' degrees</b>' +
+            '<br>Temperature: <b>' + r[c.temperature_c] + ' C</b>';
+        if (point) {
+            marker = L.marker(latlng);
+        } else if (r[c.radius] === 0) {
+            // If there's no wind, plot a circle marker
+            marker = L.circle(latlng, 70000, {color: colour, fillColor: colour, fillOpacity: 0.6});
+        } else {
+            // If there's some wind, plot a triangle, rotated in the appropriate direction
+            marker = new L.RegularPolygonMarker(latlng, {color: 'black', opacity: 1,
+                weight: 2, fillColor: colour, fillOpacity: 1, numberOfSides: 3,
+                rotation: r[c.rotation], radius: r[c.radius]});
+            marker._latlng = marker._centerLatLng;
+        }
+        marker.bindPopup(popup);
+        metarStations.addLayer(marker);
+    }
+    map.addLayer(metarStations);
+})(metarData, %(point)s);
+'''
+
+def payload(data, styles):
+    '''
+    Returns the map payload of the latest observations, as a dictionary of
+    columns (COLUMNS), colours (the palette of the fill colours) and rows (a
+    list of lists of values, with the index of each row's colour in colours,
+    and the rotation and radius of its marker).
+    Stations without a wind speed, wind direction or temperature are left
+    out, as they cannot be symbolised.
+
+    Input:
+    data -- a dictionary of arrays, from metarsqlite3db.returnMostRecent(returnColumns=True)
+    styles -- the styles of the stations, from symbology.style()
+    '''
+    known = styles['known']
+    values = [data['X'][known].tolist(), data['Y'][known].tolist(),
+              data['station'][known].tolist(), data['label'][known].tolist(),
+              data['utc'][known].tolist()]
+    values += [data[key][known].astype(int).tolist() for key in ['windspeed_mph', 'winddirection', 'temperature_c']]
+    values += [styles[key][known].tolist() for key in ['colour', 'rotation', 'radius']]
+    return {'columns': COLUMNS, 'colours': styles['palette'], 'rows': [list(row) for row in zip(*values)]}
+
+def dumps(data):
+    '''Returns data as compact JSON, safe to write inside a <script> element:
+    every < is escaped (as \\u003c), so that no value (e.g. a label holding
+    </script>) can end the element early'''
+    return json.dumps(data, separators=(',', ':')).replace('<', '\\u003c')
+
+def script(data, point=True, sidecar=None):
+    '''
+    Returns the HTML to add to the end of the map's body: the payload (inline,
+    or a reference to sidecar) and the loop that builds the markers.
+
+    Input:
+    data -- the payload, from payload()
+    point -- Boolean, as for foliumMap.makeMap
+    sidecar -- default None, the file name (relative to the HTML) of a .js
+               file that the payload is written to by writeSidecar(). If None,
+               the payload is written inline.
+    '''
+    if sidecar is None:
+        source = '<script>\nvar metarData = %s;\n</script>\n' % dumps(data)
+    else:
+        source = '<script src="%s"></script>\n' % sidecar
+    return source + '<script>%s</script>\n' % (MARKERS_JS % {'point': 'true' if point else 'false'})
+
+def writeSidecar(data, path):
+    '''Writes the payload to path, as a script defining metarData'''
+    with open(path, 'w') as f:
+        f.write('var metarData = %s;\n' % dumps(data))
+    return None
+
+def sidecarPath(mapName):
+    '''Returns the path of the sidecar payload of the map at mapName:
+    beside it, with the extension .data.js'''
+    return os.path.splitext(mapName)[0] + '.data.js'
+
+def inject(mapName, html):
+    '''Adds html to the end of the body of the map written to mapName'''
+    with open(mapName) as f:
+        page = f.read()
+    at = page.rfind('</body>')
+    if at == -1:
+        at = len(page)
+    with open(mapName, 'w') as f:
+        f.write(page[:at] + html + page[at:])
+    return None
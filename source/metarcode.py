@@ -0,0 +1,266 @@
+# /usr/bin/env python
+'''
+metarcode
+-------
+
+Decodes raw METAR reports (the ob: line of a decoded .TXT file, or the
+reports in NOAA's hourly cycle files at
+http://weather.noaa.gov/pub/data/observations/metar/cycles/) into compact
+Report records.
+
+A cycle file (00Z.TXT to 23Z.TXT) holds every station's reports from one
+hour, so reading one replaces a request per station. Each report is preceded
+by its observation time:
+
+    2014/09/30 01:00
+    NZWN 300100Z 19007KT 9999 FEW025 14/08 Q1015
+
+Only the groups before the remarks are decoded (apart from the precise
+temperature and dewpoint group of North American remarks, T01390083), each
+with a precompiled pattern, in a single pass over the report's groups:
+    wind -- 19007KT, 24015G25KT, VRB03KT, 00000KT (calm), 05004MPS, in knots
+    visibility -- 9999, 0800, 10SM, 1 1/2SM, M1/4SM, CAVOK, in metres
+    sky cover -- FEW025, BKN100CB, OVC///, VV002, SKC, CLR, NSC, NCD
+    temperature/dewpoint -- 14/08, M01/M03, 14/, in degrees C
+    altimeter -- Q1015, A2983, in hPa
+
+The cycle files have no station locations, so stations that are new to the
+database still need their decoded .TXT file (see main.metarHarvester).
+
+'''
+
+import re
+import math
+import datetime as dt
+import calendar
+from collections import namedtuple
+
+# Wind: direction (or VRB), speed, gust, unit
+WIND = re.compile(r'^(\d{3}|VRB)(\d{2,3})(?:G(\d{2,3}))?(KT|MPS|KMH)$')
+# Visibility in metres (with an optional direction, or NDV)
+METRES = re.compile(r'^(\d{4})(?:[NSEW]{1,2}|NDV)?$')
+# Visibility in statute miles: 10SM, 1/2SM, M1/4SM, P6SM
+MILES = re.compile(r'^([MP])?(?:(\d+)/(\d+)|(\d+))SM$')
+# Sky cover, with the height of its base in hundreds of feet
+SKY = re.compile(r'^(FEW|SCT|BKN|OVC|VV)(\d{3}|///)(?:CB|TCU|///)?$')
+CLEAR = ('SKC', 'CLR', 'NSC', 'NCD')
+TEMPERATURE = re.compile(r'^(M?\d{2})/(M?\d{2})?$')
+ALTIMETER = re.compile(r'^([QA])(\d{4})$')
+# The temperature and dewpoint to tenths of a degree, in North American remarks
+PRECISE = re.compile(r'^T([01])(\d{3})(?:([01])(\d{3}))?$')
+# The groups that end the observation: remarks and forecasts
+END = ('RMK', 'TEMPO', 'BECMG', 'NOSIG')
+# A report's time in a cycle file
+WHEN = re.compile(r'^(\d{4})/(\d\d)/(\d\d) (\d\d):(\d\d)$')
+
+KNOTS = {'KT': 1., 'MPS': 1.943844, 'KMH': 0.539957}
+MPH_PER_KNOT = 1.150779
+METRES_PER_MILE = 1609.344
+HPA_PER_INHG = 33.8639
+# The Magnus formula's coefficients, over water (Alduchov and Eskridge, 1996)
+MAGNUS_B, MAGNUS_C = 17.625, 243.04
+
+# Not all of these are constrained to exist. None indicates that the value does not exist
+Report = namedtuple('Report', ['station', 'day', 'hour', 'minute',
+    'windspeed_kts', 'windgust_kts', 'winddirection', 'visibility_m', 'sky',
+    'temperature_c', 'dewpoint_c', 'temperature_precise', 'dewpoint_precise',
+    'altimeter_hpa', 'code'])
+
+def celsius(text):
+    '''Returns the integer degrees C of a temperature group, e.g. 'M05' -> -5'''
+    if text.startswith('M'):
+        return -int(text[1:])
+    return int(text)
+
+def tenths(sign, digits):
+    '''Returns the degrees C of a precise temperature, e.g. ('1', '050') -> -5.0'''
+    return int(digits)/10.*(-1 if sign == '1' else 1)
+
+def relativeHumidity(temperature, dewpoint):
+    '''Returns the relative humidity (an integer percentage, at most 100) of
+    a temperature and dewpoint in degrees C, by the Magnus formula, or None
+    if either is missing'''
+    if temperature is None or dewpoint is None:
+        return None
+    ratio = math.exp(MAGNUS_B*dewpoint/(MAGNUS_C + dewpoint) - MAGNUS_B*temperature/(MAGNUS_C + temperature))
+    return min(100, int(round(100*ratio)))
+
+def decode(code):
+    '''
+    Decodes a raw METAR report, returning a Report. Values that are not
+    reported (or cannot be decoded) are None; sky is a list of (cover,
+    height in feet) tuples, height None for clear skies.
+    Raises a ValueError if the report has no station and time, or is NIL
+    (a report that was expected, but not made).
+
+    Input:
+    code -- the report, e.g. 'NZWN 300100Z 19007KT 9999 FEW025 14/08 Q1015'
+    '''
+    groups = code.split()
+    if groups and groups[0] in ('METAR', 'SPECI'):
+        groups = groups[1:]
+    if len(groups) < 2 or len(groups[1]) != 7 or not groups[1].endswith('Z') or not groups[1][:6].isdigit():
+        raise ValueError('Cannot decode METAR report: {code}'.format(code=code))
+    station, when = groups[0], groups[1]
+    if len(groups) > 2 and groups[2] == 'NIL':
+        raise ValueError('Station {station}: NIL report'.format(station=station))
+    speed = gust = direction = visibility = temperature = dewpoint = precise = precisedew = altimeter = None
+    sky = []
+    remarks = False
+    i = 2
+    while i < len(groups):
+        group = groups[i]
+        i += 1
+        if remarks:
+            m = PRECISE.match(group)
+            if m is not None:
+                precise = tenths(m.group(1), m.group(2))
+                if m.group(3) is not None:
+                    precisedew = tenths(m.group(3), m.group(4))
+            continue
+        if group in END:
+            remarks = group == 'RMK'
+            if not remarks:
+                break
+            continue
+        if speed is None:
+            m = WIND.match(group)
+            if m is not None:
+                knots = KNOTS[m.group(4)]
+                speed = int(round(int(m.group(2))*knots))
+                gust = int(round(int(m.group(3))*knots)) if m.group(3) else None
+                direction = None if m.group(1) == 'VRB' else int(m.group(1))
+                continue
+        if visibility is None:
+            if group == 'CAVOK':
+                visibility = 10000
+                continue
+            m = METRES.match(group)
+            if m is not None:
+                visibility = 10000 if m.group(1) == '9999' else int(m.group(1))
+                continue
+            whole = 0
+            if group.isdigit() and i < len(groups) and groups[i].endswith('SM'):
+                # Whole and fractional miles, e.g. 1 1/2SM
+                whole, group = int(group), groups[i]
+                i += 1
+            m = MILES.match(group)
+            if m is not None:
+                miles = whole + (int(m.group(2))/float(m.group(3)) if m.group(2) else int(m.group(4)))
+                visibility = int(round(miles*METRES_PER_MILE))
+                continue
+        m = SKY.match(group)
+        if m is not None:
+            sky.append((m.group(1), int(m.group(2))*100 if m.group(2) != '///' else None))
+            continue
+        if group in CLEAR:
+            sky.append(('CLR', None))
+            continue
+        if temperature is None:
+            m = TEMPERATURE.match(group)
+            if m is not None:
+                temperature = celsius(m.group(1))
+                dewpoint = celsius(m.group(2)) if m.group(2) else None
+                continue
+        if altimeter is None:
+            m = ALTIMETER.match(group)
+            if m is not None:
+                if m.group(1) == 'Q':
+                    altimeter = float(m.group(2))
+                else:
+                    altimeter = round(int(m.group(2))/100.*HPA_PER_INHG, 1)
+                continue
+        # Anything else (AUTO, COR, variable wind direction, runway visual
+        # range, present weather, wind shear) is not kept
+    return Report(station, int(when[:2]), int(when[2:4]), int(when[4:6]),
+        speed, gust, direction, visibility, sky, temperature, dewpoint,
+        precise, precisedew, altimeter, code)
+
+def observationValues(report, utc):
+    '''
+    Returns a tuple of the values stored in the database for a report, in
+    the order expected by metarsqlite3db.addObservations (as from
+    METARTxtFile.observationValues()):
+    (station, utc, obs_epoch, windspeed_mph, windspeed_kts, winddirection,
+    temperature_c, temperature_f, relativehumidity)
+    As in the decoded .TXT files, a calm wind has a direction of 0, and a
+    variable one none. The temperature in F is from the precise temperature,
+    if the report has it, and the relative humidity from the (precise, if
+    given) temperature and dewpoint.
+
+    Input:
+    report -- a Report, from decode()
+    utc -- a datetime.datetime of the time of the observation
+    '''
+    speed, direction = report.windspeed_kts, report.winddirection
+    mph = int(round(speed*MPH_PER_KNOT)) if speed is not None else None
+    if speed == 0:
+        direction = 0
+    temperature = report.temperature_precise if report.temperature_precise is not None else report.temperature_c
+    fahrenheit = int(round(temperature*9/5. + 32)) if temperature is not None else None
+    dewpoint = report.dewpoint_precise if report.dewpoint_precise is not None else report.dewpoint_c
+    return (report.station, str(utc), calendar.timegm(utc.utctimetuple()), mph,
+            speed, direction, report.temperature_c, fahrenheit,
+            relativeHumidity(temperature, dewpoint))
+
+def reportTime(report, cycle):
+    '''Returns a datetime.datetime of the time of a report: its day, hour and
+    minute, in the month of cycle (a datetime.datetime near it, e.g. the
+    time of the cycle file), or the month before if the day is later than
+    cycle's.'''
+    year, month = cycle.year, cycle.month
+    if report.day > cycle.day:
+        year, month = (year, month - 1) if month > 1 else (year - 1, 12)
+    return dt.datetime(year, month, report.day, report.hour, report.minute)
+
+def readCycle(text):
+    '''
+    Returns a list of (time, report) tuples of the reports in the text of a
+    cycle file: a datetime.datetime of the line before each report (None if
+    there is none), and the report's text. A report that wraps over several
+    lines is joined into one.
+    '''
+    reports, when, lines = [], None, []
+    for line in text.splitlines() + ['']:
+        line = line.strip()
+        m = WHEN.match(line)
+        if m is not None or not line:
+            if lines:
+                reports.append((when, ' '.join(lines)))
+                lines = []
+            if m is not None:
+                when = dt.datetime(*[int(g) for g in m.groups()])
+            continue
+        lines.append(line)
+    return reports
+
+def cycleObservations(text, stations=None, cycle=None):
+    '''
+    Returns the observations of a cycle file, as a list of observation value
+    tuples (see observationValues()), and a dictionary of the reports that
+    cannot be decoded (station, or the report: error string).
+
+    Input:
+    text -- the text of a cycle file
+    stations -- default None, a set of the station codes to keep; None keeps
+                every station
+    cycle -- default None, a datetime.datetime near the cycle's time, for
+             reports without a time line (see reportTime()). If None, now.
+    '''
+    cycle = cycle or dt.datetime.utcnow()
+    observations, failed = [], {}
+    for when, code in readCycle(text):
+        groups = code.split(None, 2)
+        station = groups[1] if groups[0] in ('METAR', 'SPECI') and len(groups) > 1 else groups[0]
+        if stations is not None and station not in stations:
+            continue # Not decoded at all
+        try:
+            report = decode(code)
+            observations.append(observationValues(report, when or reportTime(report, cycle)))
+        except ValueError, e:
+            failed[station] = str(e)
+    return observations, failed
+
+def cycleName(hour):
+    '''Returns the file name of the cycle file of an hour (UTC), e.g. '01Z.TXT' '''
+    return '%02dZ.TXT' % hour
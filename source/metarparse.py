@@ -0,0 +1,177 @@
+# /usr/bin/env python
+'''
+metarparse
+-------
+
+Parses decoded METAR .TXT files (as published by NOAA at
+http://weather.noaa.gov/pub/data/observations/metar/decoded/) into compact
+Observation records.
+
+Each file is split into lines once, and each value is extracted once with a
+precompiled pattern, so that the record can be stored or displayed without
+searching the text again.
+
+Example file:
+    Wellington Airport, New Zealand (NZWN) 41-20S 174-48E 13M
+    Sep 29, 2014 - 09:00 PM EDT / 2014.09.30 0100 UTC
+    Wind: from the S (190 degrees) at 8 MPH (7 KT):0
+    Temperature: 57 F (14 C)
+    ob: NZWN 300100Z 19007KT 9999 FEW025 14/08 Q1015
+    cycle: 1
+
+'''
+
+import re
+import datetime as dt
+import calendar
+from collections import namedtuple
+
+NO_LOCALE = 'Station name not available'
+
+# Locale line (line 0)
+LABEL = re.compile(r'[\w,\s]+,') # Must match at the start of the line
+COUNTRY = re.compile(r',\s(\w+)\s\(')
+LATITUDE = re.compile(r'\)\s(\d+)-(\d+)([SN])')
+LONGITUDE = re.compile(r'\s(\d+)-(\d+)([EW])')
+ELEVATION = re.compile(r'[EW]\s(\d+)M')
+# Date line (line 1)
+WHEN = re.compile(r'(\d\d\d\d).(\d\d).(\d\d) (\d\d)(\d\d) UTC')
+# Attribute lines (lines 2+)
+MPH = re.compile(r'(\d+)\sMPH')
+KT = re.compile(r'(\d+)\sKT')
+DEGREES = re.compile(r'(\d+)\sdegrees')
+# Temperatures can be negative, and are given in tenths at some stations
+CELSIUS = re.compile(r'(-?\d+(?:\.\d+)?)\sC')
+FAHRENHEIT = re.compile(r'(-?\d+(?:\.\d+)?)\sF')
+PERCENT = re.compile(r'(\d+)%')
+
+# The attribute lines kept on each record, and the field each is kept in
+ATTRIBUTES = (('Wind', 'wind'), ('Visibility', 'visibility'),
+              ('Sky conditions', 'skyconditions'), ('Temperature', 'temperature'),
+              ('Dew Point', 'dewpoint'), ('Relative Humidity', 'relativehumidity'),
+              ('Pressure (altimeter)', 'pressure'), ('ob', 'ob'), ('cycle', 'cycle'))
+
+# Not all of these are constrained to exist. None indicates that the value does not exist
+Observation = namedtuple('Observation', ['station', 'locale', 'label', 'country',
+    'lat', 'lon', 'elevation', 'when', 'utc', 'epoch', 'windspeed_mph',
+    'windspeed_kts', 'winddirection', 'temperature_c', 'temperature_f',
+    'relativehumidity_pct'] +
+    [field for key, field in ATTRIBUTES])
+
+def dataDict(lines):
+    '''Returns a dictionary of the "key: value" attribute lines (lines 2 and
+    onwards) of a decoded METAR file. Lines without a colon are ignored.'''
+    data = {}
+    for line in lines[2:]:
+        k, sep, v = line.partition(':')
+        if sep:
+            data[k.strip()] = v.strip()
+    return data
+
+def coordinate(m):
+    '''Returns a signed float from a match of LATITUDE or LONGITUDE, treating
+    the degrees and minutes as the integer and fractional parts, as in
+    '41-20S' -> -41.2'''
+    coord = float(m.group(1) + '.' + m.group(2))
+    if m.group(3) in 'SW':
+        coord = coord*-1
+    return coord
+
+def localeValues(locale):
+    '''Returns a (label, country, lat, lon, elevation) tuple from the locale
+    line of a decoded METAR file, any of which may be None.
+    Example:
+        input: 'Wellington Airport, New Zealand (NZWN) 41-20S 174-48E 13M'
+        output: ('Wellington Airport', ..., -41.2, 174.48, 13)'''
+    if locale is None:
+        return None, None, None, None, None
+    m = LABEL.match(locale)
+    label = m.group().replace(',','').strip() if m is not None else None
+    m = COUNTRY.search(locale)
+    country = m.group(1) if m is not None else None
+    lat, lon = LATITUDE.search(locale), LONGITUDE.search(locale)
+    if lat is None or lon is None:
+        lat, lon = None, None
+    else:
+        lat, lon = coordinate(lat), coordinate(lon)
+    m = ELEVATION.search(locale)
+    elevation = int(m.group(1)) if m is not None else None
+    return label, country, lat, lon, elevation
+
+def utcDatetime(when, station=None):
+    '''Returns a datetime.datetime object of the UTC time in the date line of
+    a decoded METAR file, or None if it cannot be found or parsed.
+    A time of 2400 is taken as midnight at the end of the given day.'''
+    m = WHEN.search(when)
+    if m is None:
+        return None
+    year, month, day, hour, minute = [int(g) for g in m.groups()]
+    try:
+        return dt.datetime(year, month, day, hour, minute)
+    except ValueError:
+        if hour == 24 and minute == 0:
+            # Ugh, 2400 is not a time!
+            try:
+                return dt.datetime(year, month, day) + dt.timedelta(days=1)
+            except ValueError:
+                pass
+        print "Station {station}: cannot parse date/time {date}".format(station=station,date=when)
+        return None
+
+def lineEpoch(when):
+    '''Returns the UNIX time of the date line of a decoded METAR file, or None
+    if it has none; a cheaper check than parsing the file (or even
+    utcDatetime()). A time of 2400 is midnight at the end of the day.'''
+    m = WHEN.search(when)
+    if m is None:
+        return None
+    year, month, day, hour, minute = [int(g) for g in m.groups()]
+    return calendar.timegm((year, month, day, hour, minute, 0))
+
+def firstInt(pattern, text):
+    '''Returns the first group of pattern in text as an integer (rounded), or None'''
+    m = pattern.search(text)
+    if m is None:
+        return None
+    return int(round(float(m.group(1))))
+
+def windValue(pattern, wind):
+    '''Returns the first group of pattern in the wind text as an integer, 0 if
+    the wind is calm, or None if the wind is not given.'''
+    if wind is None:
+        return None
+    value = firstInt(pattern, wind)
+    if value is None and 'calm' in wind.lower():
+        return 0
+    return value
+
+def parse(station, lines):
+    '''
+    Parses a decoded METAR file, returning an Observation.
+
+    Input:
+    station -- The four-character station code of the station.
+    lines -- The text of the file, either as a string or as a list of lines
+             (e.g. from urllib2.urlopen(url).readlines())
+    '''
+    if isinstance(lines, basestring):
+        lines = lines.splitlines()
+    lines = [line.strip() for line in lines]
+    if len(lines) < 2:
+        raise ValueError('Station {station}: expected a locale and a date line'.format(station=station))
+    locale = lines[0] if lines[0] != NO_LOCALE else None
+    label, country, lat, lon, elevation = localeValues(locale)
+    when = lines[1]
+    utc = utcDatetime(when, station)
+    epoch = calendar.timegm(utc.utctimetuple()) if utc is not None else None
+    data = dataDict(lines)
+    attributes = [data.get(key) for key, field in ATTRIBUTES]
+    wind, temperature = data.get('Wind'), data.get('Temperature')
+    humidity = data.get('Relative Humidity')
+    return Observation(station, locale, label, country, lat, lon, elevation,
+        when, utc, epoch,
+        windValue(MPH, wind), windValue(KT, wind), windValue(DEGREES, wind),
+        firstInt(CELSIUS, temperature) if temperature is not None else None,
+        firstInt(FAHRENHEIT, temperature) if temperature is not None else None,
+        firstInt(PERCENT, humidity) if humidity is not None else None,
+        *attributes)
@@ -9,6 +9,7 @@ import shutil
 
 import easygui as eg # Import the GUI library, based on Qt
 import main as m # Import main.py, the workhorse
+import fetch # For the cache of retrieved files and the index of stations
 
 
 # Parameters (all of these need defaults, and type constraints)
@@ -16,7 +17,7 @@ import main as m # Import main.py, the workhorse
 # Coastline JSON (if I can get this to work...)
 # Then open output in browser, and tell user
 
-def getMetarStations(metarValues):
+def getMetarStations(metarValues, index=None):
     '''
     Takes the user-supplied and (hopefully) comma-delimited string of METAR
     stations that they're interested in, and returns a list of strings of possible
@@ -24,7 +25,17 @@ def getMetarStations(metarValues):
     upper case, and checked to only contain alphanumeric characters. If an error
     is raised during the process, False is returned, along with a (possibly
     blank) additional error message.
+    Stations are checked against index (by default the fetch.stationIndex
+    kept in ./data), falling back to a request per station only if the index
+    cannot be loaded.
     '''
+    if index is None:
+        index = fetch.stationIndex(source=fetch.NOAA_SOURCE)
+    try:
+        index.load()
+        exists = lambda station: station in index
+    except (urllib2.URLError, IOError):
+        exists = checkMetarExists
     metars = metarValues.strip().upper().split(',')
     for m in metars:
         m = m.strip()
@@ -33,7 +44,7 @@ def getMetarStations(metarValues):
         if len(m) != 4:
             return False, '' # The string is not four letters long
         # Check if they are actually stations
-        if checkMetarExists(m) == False:
+        if exists(m) == False:
             return False, 'ERROR: Station %s does not exist' % m
     return metars
 
@@ -42,8 +53,7 @@ def checkMetarExists(metarstation):
     Checks that a user-suppled METAR station exists before processing it.
     Returns True if it does, False if it does not.
     '''
-    source = 'http://weather.noaa.gov/pub/data/observations/metar/decoded/'
-    station = source + metarstation + '.TXT'
+    station = m.NOAA_SOURCE + metarstation + '.TXT'
     try:
         urllib2.urlopen(station)
         return True
@@ -161,7 +171,7 @@ def cancel():
     '''What happens whena user presses cancel: the program exits'''
     sys.exit(0)
     
-def run(stations,output,tiles,verbose=False):
+def run(stations,output,tiles,verbose=False,concurrency=8):
     '''
     Once the GUI has gathered the required parameters, this function runs main.py
     with them, which scrapes the information from NOAA, adds it to the bundled
@@ -171,18 +181,21 @@ def run(stations,output,tiles,verbose=False):
     stations -- A list of METAR stations
     outpath -- A string representing the path for the output and the name of the output file
     tiles -- A string (from a constrained list) of tiles that the map can be made with
+    concurrency -- The maximum number of stations retrieved at the same time
     '''
-    # Create MetarTxtFile objects from the stations, which also adds to the database
+    # Retrieve the stations concurrently, adding their data to the database.
+    # Every station asked for is tried, even those that have failed recently
     metardb = m.metarsqlite3db('./data/metar.db')
-    for station in stations:
-        metar = m.METARTxtFile(station, metardb)
-        if verbose: print(station)
+    harvester = m.metarHarvester(metardb, concurrency=concurrency, verbose=verbose, cache=fetch.httpCache('./data/httpcache'), backoff=False, resume=False)
+    harvester.harvest(stations)
     
     # Instantiate the map object, and make the map (loops through adding collected points)
     fmap = m.foliumMap(metardb,output,tiles,restrict=stations,coastline=None)
     
     # Make the map
     fmap.makeMap(point=False)
+    if verbose:
+        print 'Query cache: {hits} hits, {misses} misses'.format(**metardb.cacheStats)
     while 1:
         webbrowser.open_new_tab(output)
         time.sleep(2) # Allow time to open the map, then return control
@@ -0,0 +1,275 @@
+# /usr/bin/env python
+'''
+overlay
+-------
+
+Multi-resolution coastline overlays for the Leaflet map.
+
+The coastline (e.g. ./data/nzcoastline-1-250k.json, 4 MB of GeoJSON) is far
+more detailed than a map can show at most zoom levels. For each zoom level,
+each ring is simplified (Douglas-Peucker, to a tolerance of about a screen
+pixel at that zoom), quantized to an integer grid finer than the tolerance,
+and delta-encoded, TopoJSON style. Rings that simplify away are dropped.
+
+Encoding every level takes a few seconds, so the levels are cached on disk,
+keyed by the SHA-1 of the source file (and the encoding parameters), and
+only encoded again when the file changes.
+
+Each level is written to its own sidecar .js file, which the map loads only
+when it is zoomed to that level.
+
+'''
+
+import os
+import json
+import time
+import hashlib
+import threading
+import numpy as np
+
+import mapdata
+
+# Draws the coastline level fitted to the map's zoom, loading each level's
+# sidecar file the first time it is needed
+OVERLAY_JS = '''
+(function (minZoom, maxZoom, prefix) {
+    var coastline = L.featureGroup(), levels = {}, requested = {}, shown;
+    function decode(topology) {
+        var scale = topology.transform.scale, translate = topology.transform.translate;
+        var arcs = topology.arcs.map(function (arc) {
+            var x = 0, y = 0;
+            return arc.map(function (p) {
+                x += p[0];
+                y += p[1];
+                return new L.LatLng(y*scale[1] + translate[1], x*scale[0] + translate[0]);
+            });
+        });
+        return topology.objects.coastline.geometries.map(function (geometry) {
+            return geometry.arcs.map(function (ring) { return arcs[ring[0]]; });
+        });
+    }
+    function draw() {
+        var level = Math.min(Math.max(map.getZoom(), minZoom), maxZoom);
+        if (level === shown) { return; }
+        if (!(level in levels)) {
+            if (!requested[level]) {
+                requested[level] = true;
+                var script = document.createElement('script');
+                script.src = prefix + level + '.js';
+                document.body.appendChild(script);
+            }
+            return; // Drawn when it has loaded
+        }
+        coastline.clearLayers();
+        var polygons = levels[level];
+        for (var i = 0; i < polygons.length; i++) {
+            coastline.addLayer(L.polygon(polygons[i], {color: 'black', weight: 1, fill: false}));
+        }
+        map.addLayer(coastline);
+        coastline.bringToBack();
+        shown = level;
+    }
+    window.metarCoastline = function (level, topology) {
+        levels[level] = decode(topology);
+        shown = undefined;
+        draw();
+    };
+    map.on('zoomend', draw);
+    draw();
+})(%(minZoom)d, %(maxZoom)d, '%(prefix)s');
+'''
+
+def degreesPerPixel(zoom):
+    '''Returns the degrees of longitude across a screen pixel at a zoom level'''
+    return 360./(256*2**zoom)
+
+def douglasPeucker(points, tolerance):
+    '''
+    Returns the points (an n x 2 array) of a line or ring simplified with
+    the Douglas-Peucker algorithm: only the points that are further than
+    tolerance from the simplified line are kept. The first and last points
+    are always kept.
+    '''
+    n = len(points)
+    if n < 3:
+        return points
+    keep = np.zeros(n, dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, n - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        start, d = points[first], points[last] - points[first]
+        between = points[first + 1:last] - start
+        length = np.hypot(d[0], d[1])
+        if length == 0:
+            # A closed ring: measure from the start point
+            distance = np.hypot(between[:, 0], between[:, 1])
+        else:
+            distance = np.abs(d[0]*between[:, 1] - d[1]*between[:, 0])/length
+        furthest = np.argmax(distance)
+        if distance[furthest] > tolerance:
+            split = first + 1 + furthest
+            keep[split] = True
+            stack.extend([(first, split), (split, last)])
+    return points[keep]
+
+def quantize(points, translate, scale):
+    '''Returns the points of a ring as integers on a grid (of cells scale
+    across, with its origin at translate), delta-encoded: the first point is
+    absolute and each other is the difference from the previous one. Points
+    that fall in the same cell as the previous one are dropped.'''
+    grid = np.round((points - translate)/scale).astype(np.int64)
+    deltas = np.vstack([grid[:1], np.diff(grid, axis=0)])
+    moved = np.any(deltas != 0, axis=1)
+    moved[0] = True
+    return deltas[moved]
+
+def encode(rings, tolerance, precision=0.5):
+    '''
+    Returns a TopoJSON topology (a dictionary) of simplified, quantized
+    polygons, and the number of points it holds.
+
+    Input:
+    rings -- a list of polygons, each a list of rings (n x 2 arrays of lon, lat)
+    tolerance -- the Douglas-Peucker tolerance, in degrees
+    precision -- default 0.5, the size of the quantization grid, as a
+                 fraction of tolerance
+    '''
+    scale = tolerance*precision
+    translate = np.min([ring.min(axis=0) for polygon in rings for ring in polygon], axis=0)
+    arcs, geometries, points = [], [], 0
+    for polygon in rings:
+        polygonArcs = []
+        for ring in polygon:
+            if np.ptp(ring, axis=0).max() < tolerance:
+                simplified = ring[:0] # Smaller than a pixel
+            else:
+                simplified = douglasPeucker(ring, tolerance)
+            if len(simplified) < 4:
+                if not polygonArcs:
+                    break # Without its outer ring, the holes go too
+                continue
+            arc = quantize(simplified, translate, scale)
+            polygonArcs.append([len(arcs)])
+            arcs.append(arc.tolist())
+            points += len(arc)
+        if polygonArcs:
+            geometries.append({'type': 'Polygon', 'arcs': polygonArcs})
+    topology = {'type': 'Topology',
+                'transform': {'scale': [scale, scale], 'translate': translate.tolist()},
+                'objects': {'coastline': {'type': 'GeometryCollection', 'geometries': geometries}},
+                'arcs': arcs}
+    return topology, points
+
+def readRings(path):
+    '''Returns the polygons of a GeoJSON file of Polygon and MultiPolygon
+    features, as a list of lists of rings (n x 2 arrays of lon, lat).'''
+    with open(path) as f:
+        features = json.load(f)['features']
+    rings = []
+    for feature in features:
+        geometry = feature['geometry']
+        if geometry is None:
+            continue
+        if geometry['type'] == 'Polygon':
+            polygons = [geometry['coordinates']]
+        elif geometry['type'] == 'MultiPolygon':
+            polygons = geometry['coordinates']
+        else:
+            continue
+        for polygon in polygons:
+            rings.append([np.array(ring, dtype=float)[:, :2] for ring in polygon])
+    return rings
+
+class coastlineLevels:
+    '''
+    The levels of a coastline overlay, one per zoom level, encoded when they
+    are first needed and cached on disk by the SHA-1 of the source file.
+    '''
+    def __init__(self, path, directory='./data/overlaycache', zooms=range(0, 11), pixels=1, precision=0.5):
+        '''
+        Input:
+        path -- the GeoJSON file of the coastline
+        directory -- default './data/overlaycache', where the encoded levels
+                     are kept. It is created if it does not exist.
+        zooms -- default 0 to 10, the zoom levels to encode. Below it, the
+                 lowest level is shown; above it, the highest.
+        pixels -- default 1, the simplification tolerance, in screen pixels
+        precision -- default 0.5, the quantization grid, as a fraction of the
+                     tolerance
+        '''
+        self.path = path
+        self.directory = directory
+        self.zooms = zooms
+        self.pixels = pixels
+        self.precision = precision
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self.rings = None # Read when first needed
+        self.sha1 = None
+        self.stats = {} # zoom: dictionary of points, bytes, seconds and cached
+
+    def key(self):
+        '''Returns the SHA-1 of the source file'''
+        if self.sha1 is None:
+            with open(self.path, 'rb') as f:
+                self.sha1 = hashlib.sha1(f.read()).hexdigest()
+        return self.sha1
+
+    def cachePath(self, zoom):
+        '''Returns the path of the cached encoding of a zoom level'''
+        return os.path.join(self.directory, '%s.%d.%s.%s.topojson' % (self.key(), zoom, self.pixels, self.precision))
+
+    def level(self, zoom):
+        '''Returns the TopoJSON text of a zoom level, from the cache if it has
+        been encoded before'''
+        path = self.cachePath(zoom)
+        start = time.time()
+        try:
+            with open(path) as f:
+                text = f.read()
+            self.stats[zoom] = {'points': None, 'bytes': len(text), 'cached': True,
+                                'seconds': time.time() - start}
+            return text
+        except IOError:
+            pass
+        if self.rings is None:
+            self.rings = readRings(self.path)
+        topology, points = encode(self.rings, degreesPerPixel(zoom)*self.pixels, self.precision)
+        text = mapdata.dumps(topology)
+        tmp = '%s.%s.tmp' % (path, threading.current_thread().ident)
+        with open(tmp, 'w') as f:
+            f.write(text)
+        os.rename(tmp, path)
+        self.stats[zoom] = {'points': points, 'bytes': len(text), 'cached': False,
+                            'seconds': time.time() - start}
+        return text
+
+    def writeLevels(self, prefix):
+        '''Writes each zoom level to prefix + zoom + '.js', as a script handing
+        it to the map'''
+        for zoom in self.zooms:
+            with open('%s%d.js' % (prefix, zoom), 'w') as f:
+                f.write('metarCoastline(%d, %s);\n' % (zoom, self.level(zoom)))
+        return None
+
+def levelPrefix(mapName):
+    '''Returns the path, less the zoom level and extension, of the sidecar
+    files of the coastline levels of the map at mapName'''
+    return os.path.splitext(mapName)[0] + '.coastline'
+
+def script(zooms, prefix):
+    '''
+    Returns the HTML to add to the end of the map's body to show the
+    coastline levels.
+
+    Input:
+    zooms -- the zoom levels that have been encoded, which must be a
+             continuous range
+    prefix -- the path, relative to the HTML, of the levels' sidecar files
+              (as written by coastlineLevels.writeLevels)
+    '''
+    return '<script>%s</script>\n' % (OVERLAY_JS % {'minZoom': min(zooms),
+        'maxZoom': max(zooms), 'prefix': prefix})
@@ -0,0 +1,375 @@
+# /usr/bin/env python
+'''
+pipeline
+-------
+
+Instrumentation for the stages of the harvest (see main.metarHarvester):
+fetch -> parse -> dedupe -> write. The fetch threads hand their files to
+the parse thread, and it hands its observations to the writer, through
+bounded queues, so that a slow stage holds the ones before it back
+(backpressure) rather than letting work pile up in memory. Dedupe (a lookup
+of each station's latest stored observation) is too cheap to be worth a
+thread and a queue of its own: the writer does it as it takes each
+observation off its queue, but it is still counted as a stage of its own.
+
+If a stage fails, the pipeline is stopped (see stop()): the queues share an
+event that wakes the stages waiting on them, and are emptied, so that every
+thread exits before the error is raised.
+
+Each stage counts the items it has handled and the seconds it has spent on
+them, and each queue samples its depth as items are put on it, and the
+seconds that putters spent waiting for room, so that a run can show which
+stage is the bottleneck: its queue in is full, and its queue out is empty.
+
+Alongside the stages, METRICS collects the timings and counts of the layers
+beneath them: the retrieval and parsing of each file (main.METARTxtFile and
+main.metarHarvester), the inserts and queries of the database
+(main.metarsqlite3db) and the making of the map (main.foliumMap). A run
+(see instrumentedRun()) resets them, and can write them, with its own
+statistics, as a JSON report, as a Prometheus text file for node_exporter's
+textfile collector, and with a cProfile profile of the whole run.
+
+'''
+
+import os
+import json
+import time
+import datetime as dt
+import threading
+import Queue
+import cProfile
+import pstats
+
+class stage:
+    '''
+    The counts of a stage of a pipeline: the items it has handled, and the
+    seconds it has spent handling them. Safe to share between the threads
+    of a stage.
+    '''
+    def __init__(self, name, workers=1):
+        '''
+        Input:
+        name -- the name of the stage, e.g. 'fetch'
+        workers -- default 1, the number of threads running the stage
+        '''
+        self.name = name
+        self.workers = workers
+        self.items = 0
+        self.seconds = 0.
+        self.lock = threading.Lock()
+
+    def record(self, seconds, items=1):
+        '''Counts items handled in seconds'''
+        with self.lock:
+            self.items += items
+            self.seconds += seconds
+        return None
+
+    def summary(self, elapsed):
+        '''
+        Returns a dictionary of the stage's items, workers, busy (the seconds
+        spent by its threads, together), rate (items per busy second of a
+        thread: times workers, how fast the stage could go) and throughput
+        (items per second of the run, elapsed: how fast it went).
+        '''
+        return {'items': self.items, 'workers': self.workers,
+                'busy': self.seconds,
+                'rate': self.items/self.seconds if self.seconds > 0 else 0.,
+                'throughput': self.items/elapsed if elapsed > 0 else 0.}
+
+# Seconds between the checks of a queue's stop event by a blocked put or get
+POLL = 0.1
+
+class stopped(Exception):
+    '''Raised by a put or get of a boundedQueue that is waiting when (or is
+    called after) its pipeline is stopped'''
+
+class boundedQueue(Queue.Queue):
+    '''
+    A Queue.Queue of at most maxsize items that samples its depth as items
+    are put on it, and times how long putters wait for room.
+    '''
+    def __init__(self, maxsize, stopping=None):
+        '''
+        Input:
+        maxsize -- the most items the queue holds
+        stopping -- default None, a threading.Event set when the pipeline is
+                    stopped. A blocking put or get then raises stopped,
+                    rather than waiting for ever on a stage that has gone.
+        '''
+        Queue.Queue.__init__(self, maxsize)
+        self.stopping = stopping
+        self.puts = 0
+        self.depthTotal = 0
+        self.depthMax = 0
+        self.blocked = 0. # Seconds putters waited for room
+
+    def put(self, item, block=True, timeout=None):
+        start = time.time()
+        self.wait(Queue.Queue.put, Queue.Full, block, timeout, item)
+        waited = time.time() - start
+        depth = self.qsize()
+        with self.mutex:
+            self.puts += 1
+            self.depthTotal += depth
+            self.depthMax = max(self.depthMax, depth)
+            self.blocked += waited
+        return None
+
+    def get(self, block=True, timeout=None):
+        return self.wait(Queue.Queue.get, Queue.Empty, block, timeout)
+
+    def wait(self, method, timedOut, block, timeout, *args):
+        '''Calls the put or get method (with args), which raises timedOut when
+        it cannot finish in time. If the queue has a stopping event, a
+        blocking call checks it every POLL seconds, raising stopped once it
+        is set.'''
+        if self.stopping is None or not block:
+            return method(self, *args, block=block, timeout=timeout)
+        end = time.time() + timeout if timeout is not None else None
+        while True:
+            if self.stopping.is_set():
+                raise stopped()
+            wait = POLL if end is None else min(POLL, end - time.time())
+            try:
+                return method(self, *args, block=True, timeout=max(wait, 0.))
+            except timedOut:
+                if end is not None and time.time() >= end:
+                    raise
+
+    def drain(self):
+        '''Empties the queue, returning the number of items that were on it'''
+        items = 0
+        while True:
+            try:
+                Queue.Queue.get(self, block=False)
+            except Queue.Empty:
+                return items
+            items += 1
+
+    def summary(self):
+        '''Returns a dictionary of the queue's maxsize, and the max and mean
+        depth seen as items were put on it, and the seconds putters were
+        blocked (waiting for room)'''
+        return {'maxsize': self.maxsize, 'max': self.depthMax,
+                'mean': self.depthTotal/float(self.puts) if self.puts else 0.,
+                'blocked': self.blocked}
+
+def stop(stopping, queues, threads):
+    '''
+    Stops a pipeline that has failed: sets stopping, so that its stages stop
+    at their next item (or when they next wait on a queue), and empties its
+    queues until all of its threads have exited. Returns the number of items
+    that were left on the queues.
+
+    Input:
+    stopping -- the threading.Event shared by the queues (see boundedQueue)
+    queues -- a list of the pipeline's queues
+    threads -- a list of the threads running its stages
+    '''
+    stopping.set()
+    left, alive = 0, list(threads)
+    while True:
+        # Give the stages waiting on the queues time to see stopping, then
+        # make room for any that were busy, and are still to put an item
+        for thread in alive:
+            thread.join(POLL)
+        left += sum(queue.drain() for queue in queues)
+        alive = [thread for thread in alive if thread.is_alive()]
+        if not alive:
+            return left
+
+def report(stages, queues):
+    '''
+    Returns lines of text summarising a run: each stage's items, throughput
+    and rate, and each queue's depth.
+
+    Input:
+    stages -- a list of (name, summary) tuples of the stages, in the order
+              of the pipeline, where summary is from stage.summary()
+    queues -- a list of (name, summary) tuples of the queues, in the order
+              of the pipeline, where summary is from boundedQueue.summary()
+    '''
+    lines = []
+    for name, summary in stages:
+        lines.append('{name}: {items} items, {throughput:.1f}/s ({workers} x {rate:.1f}/s busy)'.format(name=name, **summary))
+    for name, summary in queues:
+        lines.append('{name} queue: depth {mean:.1f} mean, {max} max of {maxsize}, {blocked:.2f} s blocked'.format(name=name, **summary))
+    return lines
+
+class metrics:
+    '''
+    Named timings (how many times something was done, and the seconds it
+    took) and counts (e.g. bytes retrieved, rows written), accumulated over
+    a run. Safe to share between threads. Names are dotted by layer, e.g.
+    'db.insert'.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        '''Forgets every timing and count'''
+        with self.lock:
+            self.timings = {} # Name: [count, seconds]
+            self.counts = {} # Name: total
+        return None
+
+    def time(self, name, seconds, n=1):
+        '''Records that name was done n times, taking seconds in all'''
+        with self.lock:
+            timing = self.timings.setdefault(name, [0, 0.])
+            timing[0] += n
+            timing[1] += seconds
+        return None
+
+    def count(self, name, n=1):
+        '''Adds n to the count of name'''
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + n
+        return None
+
+    def summary(self):
+        '''Returns a dictionary of timings (name: a dictionary of its count,
+        seconds and mean seconds) and counts (name: total)'''
+        with self.lock:
+            timings = dict((name, {'count': n, 'seconds': seconds, 'mean': seconds/n if n else 0.})
+                           for name, (n, seconds) in self.timings.items())
+            return {'timings': timings, 'counts': dict(self.counts)}
+
+# The metrics of the current run, recorded by the modules of METAR-vis
+METRICS = metrics()
+
+def runReport(name, started, elapsed, stats=None, metrics=METRICS):
+    '''
+    Returns the report of a run, as a dictionary that can be written as JSON:
+    its name, started (ISO 8601, UTC) and started_seconds (the same, as UNIX
+    time), elapsed (seconds), stats (e.g. from main.metarHarvester.harvest(),
+    with its stages and queues) and the timings and counts of metrics (see
+    metrics.summary()).
+    '''
+    return {'name': name, 'started': dt.datetime.utcfromtimestamp(started).isoformat() + 'Z',
+            'started_seconds': started, 'elapsed': elapsed, 'stats': stats or {},
+            'metrics': metrics.summary()}
+
+def replaceFile(path, text):
+    '''Writes text to path through a temporary file in the same directory,
+    so that readers (e.g. node_exporter) never see a partly written file'''
+    temporary = '{path}.{pid}.tmp'.format(path=path, pid=os.getpid())
+    with open(temporary, 'w') as f:
+        f.write(text)
+    os.rename(temporary, path)
+    return None
+
+def writeReport(report, path):
+    '''Writes report (from runReport()) to path as JSON'''
+    replaceFile(path, json.dumps(report, indent=2, sort_keys=True, default=str) + '\n')
+    return None
+
+def prometheusLabel(value):
+    '''Returns value escaped for a Prometheus label'''
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def prometheusValue(value):
+    '''Returns a number as a Prometheus sample value: NaN, +Inf and -Inf as
+    Prometheus writes them, rather than as Python does (nan, inf)'''
+    value = float(value)
+    if value != value:
+        return 'NaN'
+    if value in (float('inf'), float('-inf')):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(value)
+
+def prometheusText(report, prefix='metarvis'):
+    '''
+    Returns the Prometheus text exposition format of report (from
+    runReport()): gauges of the run's time, elapsed seconds and numeric
+    statistics, the items and busy seconds of its stages, and its timings
+    and counts, each labelled with the run's name.
+    '''
+    run = prometheusLabel(report['name'])
+    samples = [('last_run_timestamp_seconds', 'The time the last run started', {},
+                report['started_seconds']),
+               ('last_run_elapsed_seconds', 'The seconds the last run took', {}, report['elapsed'])]
+    stats = report['stats']
+    for key in sorted(stats):
+        if key == 'run':
+            continue # An identifier, not a measure
+        if isinstance(stats[key], (int, long, float)) and not isinstance(stats[key], bool):
+            samples.append(('last_run_stat', 'The statistics of the last run', {'stat': key}, stats[key]))
+        elif isinstance(stats[key], dict) and key == 'failed':
+            samples.append(('last_run_stat', 'The statistics of the last run', {'stat': key}, len(stats[key])))
+    for name, summary in sorted(stats.get('stages', {}).items()):
+        samples.append(('last_run_stage_items', 'The items handled by each stage of the last run', {'stage': name}, summary['items']))
+        samples.append(('last_run_stage_busy_seconds', 'The seconds spent by each stage of the last run', {'stage': name}, summary['busy']))
+    for name, timing in sorted(report['metrics']['timings'].items()):
+        samples.append(('last_run_operations', 'The times each operation was done in the last run', {'operation': name}, timing['count']))
+        samples.append(('last_run_operation_seconds', 'The seconds each operation took in the last run', {'operation': name}, timing['seconds']))
+    for name, total in sorted(report['metrics']['counts'].items()):
+        samples.append(('last_run_count', 'The counts of the last run', {'count': name}, total))
+    lines, described = [], set()
+    for metric, description, labels, value in samples:
+        metric = '{prefix}_{metric}'.format(prefix=prefix, metric=metric)
+        if metric not in described:
+            described.add(metric)
+            lines.append('# HELP {metric} {description}'.format(metric=metric, description=description))
+            lines.append('# TYPE {metric} gauge'.format(metric=metric))
+        labels = dict(labels, run=run)
+        lines.append('{metric}{{{labels}}} {value}'.format(metric=metric, value=prometheusValue(value),
+            labels=','.join('{key}="{value}"'.format(key=key, value=prometheusLabel(labels[key])) for key in sorted(labels))))
+    return '\n'.join(lines) + '\n'
+
+def writePrometheus(report, path, prefix='metarvis'):
+    '''Writes report (from runReport()) to path in the Prometheus text format
+    (see prometheusText()), e.g. into node_exporter's textfile directory,
+    as a .prom file'''
+    replaceFile(path, prometheusText(report, prefix))
+    return None
+
+def profilePath(report):
+    '''Returns the path of the profile written next to a report at report
+    (e.g. './data/run.json' -> './data/run.prof')'''
+    return os.path.splitext(report)[0] + '.prof'
+
+def instrumentedRun(name, function, report=None, prometheus=None, profile=False):
+    '''
+    Calls function(), a whole run (e.g. a harvest), with METRICS reset, and
+    returns its result. If function returns a dictionary, it is the run's
+    statistics in its report.
+
+    Input:
+    name -- the name of the run, e.g. 'harvest'
+    function -- the run, called without arguments
+    report -- default None, a path to write the JSON report of the run to
+              (see runReport())
+    prometheus -- default None, a path to write the report to in the
+                  Prometheus text format (see writePrometheus())
+    profile -- Boolean (default False), profile the run with cProfile,
+               writing the profile next to the report (see profilePath(); it
+               can be read with pstats), and the 30 functions that took
+               longest to the same path with
+               a .txt suffix. Only the calling thread is profiled: the
+               harvest's fetch and parse threads are seen as the writer's
+               waits on their queues, and timed by the stages and METRICS.
+    '''
+    METRICS.reset()
+    started = time.time()
+    if profile:
+        profiler = cProfile.Profile()
+        result = profiler.runcall(function)
+    else:
+        result = function()
+    elapsed = time.time() - started
+    if profile:
+        path = profilePath(report or './data/run.json')
+        profiler.dump_stats(path)
+        with open(path + '.txt', 'w') as f:
+            pstats.Stats(path, stream=f).sort_stats('cumulative').print_stats(30)
+    if report is not None or prometheus is not None:
+        runStats = result if isinstance(result, dict) else None
+        summary = runReport(name, started, elapsed, runStats)
+        if report is not None:
+            writeReport(summary, report)
+        if prometheus is not None:
+            writePrometheus(summary, prometheus)
+    return result
@@ -0,0 +1,211 @@
+# /usr/bin/env python
+'''
+standin
+-------
+
+A local stand-in for the NOAA decoded METAR directory
+(http://weather.noaa.gov/pub/data/observations/metar/decoded/), and its
+hourly cycle files (.../metar/cycles/), so that harvesting can be tested
+and measured without the network, with synthetic decoded .TXT files (see
+syntheticTxt() and syntheticNetwork()).
+
+It serves a directory listing and one .TXT file per station, with
+Last-Modified and ETag headers, answering conditional requests with 304 Not
+Modified. Stations can be made to answer 403 Forbidden, and every response
+is counted.
+
+Usage:
+    server = standinServer({'NZWN': text, ...})
+    server.start()
+    main.getStations(source=server.source)
+    server.stop()
+
+'''
+
+import time
+import datetime as dt
+import hashlib
+import threading
+import BaseHTTPServer
+import SocketServer
+import email.utils
+
+import metarparse
+
+SAMPLE_TXT = '''{label}, {country} ({station}) {lat} {lon} {elevation}M
+{local} / {utc} UTC
+Wind: {wind}
+Visibility: greater than 7 mile(s):0
+Sky conditions: partly cloudy
+Temperature: {temperature}
+Dew Point: 46 F (8 C)
+Relative Humidity: {humidity}
+Pressure (altimeter): 29.83 in. Hg (1010 hPa)
+ob: {station} 300100Z 19007KT 9999 FEW025 14/08 Q1015
+cycle: 1
+'''
+
+LISTING = '''<html><head><title>Index of /pub/data/observations/metar/decoded</title></head>
+<body><h1>Index of /pub/data/observations/metar/decoded</h1>
+<pre>%s</pre>
+</body></html>
+'''
+
+class standinHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''Serves the files of self.server (a standinServer)'''
+    protocol_version = 'HTTP/1.0'
+
+    def log_message(self, *args):
+        '''Quiet: the server counts responses instead'''
+        return None
+
+    def do_GET(self):
+        server = self.server.standin
+        if server.latency:
+            time.sleep(server.latency)
+        name = self.path.split('?')[0].rstrip('/').split('/')[-1]
+        if self.path.rstrip('/').endswith('decoded'):
+            body = server.listing()
+        elif '/cycles/' in self.path and name.endswith('.TXT') and name[:-4] in server.cycles:
+            body = server.cycles[name[:-4]]
+        elif name.endswith('.TXT') and name[:-4] in server.forbidden:
+            server.count(403)
+            self.send_error(403, 'Forbidden')
+            return None
+        elif name.endswith('.TXT') and name[:-4] in server.files:
+            body = server.files[name[:-4]]
+        else:
+            server.count(404)
+            self.send_error(404, 'Not Found')
+            return None
+        etag = '"%s"' % hashlib.sha1(body).hexdigest()
+        lastModified = email.utils.formatdate(server.modified.get(name[:-4], server.started), usegmt=True)
+        if self.headers.get('If-None-Match') == etag or (self.headers.get('If-None-Match') is None and self.headers.get('If-Modified-Since') == lastModified):
+            server.count(304)
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return None
+        server.count(200)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain' if name.endswith('.TXT') else 'text/html')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', lastModified)
+        self.end_headers()
+        self.wfile.write(body)
+        return None
+
+class threadedServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    '''An HTTP server handling each request in its own thread'''
+    daemon_threads = True
+    request_queue_size = 128
+
+class standinServer:
+    '''
+    A local HTTP server standing in for the NOAA decoded METAR directory.
+    '''
+    def __init__(self, files, forbidden=(), latency=0., port=0, cycles=None):
+        '''
+        Input:
+        files -- a dictionary of station code: text of its decoded .TXT file
+        forbidden -- station codes that are listed, but answer 403 Forbidden
+        latency -- default 0, seconds to wait before answering each request
+        port -- default 0, the port to listen on (0 picks a free one)
+        cycles -- default None, a dictionary of cycle (e.g. '01Z'): text of
+                  its cycle file
+        '''
+        self.files = dict(files)
+        self.cycles = dict(cycles or {})
+        self.forbidden = set(forbidden)
+        self.latency = latency
+        self.started = time.time()
+        self.modified = {} # station: time its file last changed
+        self.counts = {200: 0, 304: 0, 403: 0, 404: 0}
+        self.lock = threading.Lock()
+        self.httpd = threadedServer(('127.0.0.1', port), standinHandler)
+        self.httpd.standin = self
+        self.source = 'http://127.0.0.1:%d/pub/data/observations/metar/decoded/' % self.httpd.server_address[1]
+        self.cyclesSource = 'http://127.0.0.1:%d/pub/data/observations/metar/cycles/' % self.httpd.server_address[1]
+        self.thread = None
+
+    def listing(self):
+        '''Returns an HTML directory listing of every station's .TXT file'''
+        names = sorted(set(self.files) | self.forbidden)
+        return LISTING % '\n'.join('<a href="%s.TXT">%s.TXT</a>' % (name, name) for name in names)
+
+    def update(self, station, text):
+        '''Replaces the file of station, as NOAA does with each new report'''
+        with self.lock:
+            self.files[station] = text
+            self.modified[station] = time.time()
+        return None
+
+    def count(self, status):
+        '''Counts a response with the given status code'''
+        with self.lock:
+            self.counts[status] = self.counts.get(status, 0) + 1
+        return None
+
+    def start(self):
+        '''Serves requests on a background thread'''
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return None
+
+    def stop(self):
+        '''Stops serving and closes the socket'''
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        return None
+
+def syntheticTxt(i, stations=1000, start=None):
+    '''
+    Returns the station code and the text of a synthetic decoded METAR .TXT
+    file, of one of a number of stations. Every tenth station is calm, every
+    twelfth reports a time of 2400, and every fifteenth has no locale; the
+    relative humidity runs from 20% to 100%.
+    Observations are from September 2014, or if start (a datetime.datetime)
+    is given, from the 20 hours before it; then a time of 2400 is the
+    midnight before start.
+    '''
+    station = 'S%03d' % (i % stations)
+    if start is None:
+        utc = '2014.09.%02d %02d%02d' % (1 + i % 28, i % 24, (i % 2)*30)
+        if i % 12 == 0:
+            utc = utc[:-4] + '2400'
+    else:
+        utc = (start - dt.timedelta(minutes=30*(i % 40))).strftime('%Y.%m.%d %H%M')
+        if i % 12 == 0:
+            utc = (start - dt.timedelta(days=1)).strftime('%Y.%m.%d') + ' 2400'
+    if i % 10 == 0:
+        wind = 'Calm:0'
+    else:
+        wind = 'from the S (%d degrees) at %d MPH (%d KT):0' % ((i*10) % 360, i % 40, i % 35)
+    text = SAMPLE_TXT.format(label='Station %s' % station, country='Nowhere',
+        station=station, lat='%d-%02dS' % (i % 90, i % 60),
+        lon='%d-%02dE' % (i % 180, i % 60), elevation=i % 500,
+        local='Sep 29, 2014 - 09:00 PM EDT', utc=utc, wind=wind,
+        temperature='%d F (%d C)' % (50 + i % 30, 10 + i % 16),
+        humidity='%d%%' % (20 + (i*7) % 81))
+    if i % 15 == 0:
+        text = metarparse.NO_LOCALE + text[text.index('\n'):]
+    return station, text
+
+def syntheticNetwork(n, start=None, forbidden=50):
+    '''
+    Returns a dictionary of station code: text of the decoded .TXT files of
+    n synthetic stations (see syntheticTxt()), and a list of the codes of
+    the stations that answer 403 Forbidden instead: every forbidden'th, as
+    for a restricted site, which the listing still shows. The stations are
+    the same for every run with the same n and start.
+    '''
+    files, refused = {}, []
+    for i in range(n):
+        station, text = syntheticTxt(i, n, start)
+        if forbidden and i % forbidden == forbidden - 1:
+            refused.append(station)
+        else:
+            files[station] = text
+    return files, refused
@@ -0,0 +1,140 @@
+# /usr/bin/env python
+'''
+symbology
+-------
+
+Styles the map's markers: their fill colour (from a classification of one
+of the observed values) and popup text.
+
+The styles of every station are computed at once, from the columns of the
+latest observations (from metarsqlite3db.returnMostRecent(returnColumns=True)),
+with NumPy, rather than row by row.
+Each value is classified by a binary search of its classification's breaks
+(numpy.digitize), so any value, integer or not, falls in exactly one class.
+
+'''
+
+import bisect
+import numpy as np
+
+class classification:
+    '''
+    Class breaks, and the colour of each class. A value v is in class i when
+    breaks[i-1] <= v < breaks[i]; values below the first break are in class
+    0, and missing values are given the missing colour.
+    '''
+    def __init__(self, breaks, colours, missing='#999999'):
+        '''
+        Input:
+        breaks -- an increasing list of the lower bounds of all but the first
+                  class
+        colours -- a list of the colour of each class, one more than breaks
+        missing -- default '#999999', the colour of missing values
+        '''
+        if len(colours) != len(breaks) + 1:
+            raise ValueError('Expected {n} colours for {breaks} breaks'.format(n=len(breaks) + 1, breaks=len(breaks)))
+        self.breaks = list(breaks)
+        self.palette = list(colours) + [missing] # The last is for missing values
+
+    def classify(self, values):
+        '''Returns an integer array of the class (an index into self.palette)
+        of each of an array of values. NaN marks a missing value.'''
+        values = np.asarray(values, dtype=float)
+        classes = np.digitize(values, self.breaks)
+        classes[np.isnan(values)] = len(self.palette) - 1
+        return classes
+
+    def colour(self, value):
+        '''Returns the colour of a single value (None if it is missing)'''
+        if value is None or value != value:
+            return self.palette[-1]
+        return self.palette[bisect.bisect_right(self.breaks, value)]
+
+# Temperature (C): colorbrewer2, diverging, 8 classes (as foliumMap.tempColour was)
+TEMPERATURE = classification([0, 4, 7, 10, 13, 16, 19],
+    ['#2166AC', '#4393C3', '#92C5DE', '#D1E5F0', '#FDDBC7', '#F4A582', '#D6604D', '#B2182B'])
+# Wind speed (mph): colorbrewer2, sequential (YlGnBu), by Beaufort force
+WINDSPEED = classification([1, 4, 8, 13, 19, 25, 32],
+    ['#FFFFD9', '#EDF8B1', '#C7E9B4', '#7FCDBB', '#41B6C4', '#1D91C0', '#225EA8', '#0C2C84'])
+# Relative humidity (%): colorbrewer2, sequential (BuGn)
+HUMIDITY = classification([20, 30, 40, 50, 60, 70, 80],
+    ['#F7FCFD', '#E5F5F9', '#CCECE6', '#99D8C9', '#66C2A4', '#41AE76', '#238B45', '#005824'])
+
+# The classification of each column that can colour the map
+CLASSIFICATIONS = {'temperature_c': TEMPERATURE, 'windspeed_mph': WINDSPEED,
+                   'relativehumidity': HUMIDITY}
+
+# The triangle markers are turned by the wind direction plus this many degrees
+TRIANGLE_ROTATION = 30
+
+def style(data, colourBy='temperature_c', classification=None):
+    '''
+    Returns a dictionary of the style of each station:
+    known -- a boolean array, True where the station has a wind speed, wind
+             direction and temperature, and so can be symbolised
+    colour -- an integer array of the index of the fill colour in palette
+    palette -- a list of colours
+    rotation -- an integer array of the rotation of each triangle marker, in
+                degrees: the wind direction plus TRIANGLE_ROTATION (0 where
+                the station is not known)
+    radius -- an integer array of the radius of each triangle marker, in
+              pixels: the wind speed in mph. A radius of 0 (a calm wind, or
+              a station that is not known) is drawn as a circle instead.
+
+    Input:
+    data -- a dictionary of arrays, from metarsqlite3db.returnMostRecent(returnColumns=True)
+    colourBy -- default 'temperature_c', the column that the fill colour shows
+    classification -- default None, the classification of colourBy; if None,
+                      the one in CLASSIFICATIONS
+    Raises a ValueError if colourBy is not a column of data, or has no
+    classification.
+    '''
+    if colourBy not in data:
+        raise ValueError('Cannot colour by {column}: it is not one of the columns {columns}'.format(column=colourBy, columns=', '.join(sorted(data))))
+    if classification is None:
+        if colourBy not in CLASSIFICATIONS:
+            raise ValueError('Cannot colour by {column}: it has no classification (one of {columns})'.format(column=colourBy, columns=', '.join(sorted(CLASSIFICATIONS))))
+        classification = CLASSIFICATIONS[colourBy]
+    speed, direction = data['windspeed_mph'], data['winddirection']
+    known = ~(np.isnan(speed) | np.isnan(direction) | np.isnan(data['temperature_c']))
+    return {'known': known,
+            'colour': classification.classify(data[colourBy]),
+            'palette': classification.palette,
+            'rotation': np.where(known, direction + TRIANGLE_ROTATION, 0).astype(int),
+            'radius': np.where(known, speed, 0).astype(int)}
+
+# The jQuery special characters in Folium's popups, and their escapes
+ESCAPES = [(':', '\\:'), (',', '\\,'), ('\n', '<br>'), ('-', '\\-')]
+
+def escape(text):
+    '''Returns text with the jQuery special characters escaped'''
+    for sc, replace in ESCAPES:
+        text = text.replace(sc, replace)
+    return text
+
+# Escaped once, here, rather than for every popup
+POPUP = escape(u'%s, %s\nUTC %s\nWind speed: <b>%s mph</b>\nDirection: <b>%s degrees</b>\nTemperature: <b>%s C</b>')
+
+def escapeColumn(values):
+    '''Returns a list of values (an array) as escaped text. Text values are
+    escaped together, as one string, rather than one by one; numbers are
+    escaped once for each distinct value.'''
+    if values.dtype != object:
+        values = values.astype(int).tolist()
+        escaped = dict((value, escape(unicode(value))) for value in set(values))
+        return [escaped[value] for value in values]
+    text = u'\x00'.join([unicode(value) for value in values.tolist()])
+    return escape(text).split(u'\x00') if len(values) else []
+
+def popups(data, known):
+    '''
+    Returns a list of the popup text of each known station (see style()),
+    with the jQuery special characters that Folium's popups need escaped.
+
+    Input:
+    data -- a dictionary of arrays, from metarsqlite3db.returnMostRecent(returnColumns=True)
+    known -- a boolean array of the stations to make popups for
+    '''
+    values = [escapeColumn(data[key][known]) for key in ['station', 'label',
+              'utc', 'windspeed_mph', 'winddirection', 'temperature_c']]
+    return [POPUP % popup for popup in zip(*values)]
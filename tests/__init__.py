@@ -0,0 +1,12 @@
+'''
+Tests of METAR-vis, run from the top of the repository with
+`python -m unittest discover tests` (or pytest). The modules under test are
+imported from source/, as the scripts there import each other.
+'''
+
+import os
+import sys
+
+SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'source')
+if SOURCE not in sys.path:
+    sys.path.insert(0, SOURCE)
@@ -0,0 +1,136 @@
+'''
+Tests of the cache of query results (main.metarsqlite3db.cachedQuery): that
+it is invalidated by this connection's writes of observations and stations,
+and by another connection's commits, and that results expire after
+cacheAge.
+'''
+
+import os
+import shutil
+import tempfile
+import time
+import datetime as dt
+import unittest
+
+import main as m
+import standin
+
+STATIONS = 10
+
+def values(i, start):
+    '''Returns the station and observation values of synthetic station i's
+    file (see standin.syntheticTxt()) from the 20 hours before start'''
+    station, text = standin.syntheticTxt(i, STATIONS, start)
+    metar = m.METARTxtFile(station, dataList=text.splitlines(True))
+    return metar.stationValues(), metar.observationValues()
+
+class queryCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'metar.db')
+        self.start = dt.datetime.utcnow().replace(second=0, microsecond=0) - dt.timedelta(hours=2)
+        self.metardb = m.metarsqlite3db(self.path)
+        # S000's file is from the midnight before, and has no locale; S009 is
+        # left out, to be added later
+        self.stations = [values(i, self.start) for i in range(1, STATIONS - 1)]
+        self.metardb.addStations([stationValues for stationValues, observation in self.stations])
+        self.metardb.addObservations([observation for stationValues, observation in self.stations])
+        self.others = []
+
+    def tearDown(self):
+        for metardb in [self.metardb] + self.others:
+            metardb.conn.close()
+        shutil.rmtree(self.tmpdir)
+
+    def connect(self, **kwargs):
+        '''Returns another connection to the database'''
+        metardb = m.metarsqlite3db(self.path, **kwargs)
+        self.others.append(metardb)
+        return metardb
+
+    def mostRecent(self, metardb=None):
+        return dict((row['station'], row['utc']) for row in (metardb or self.metardb).returnMostRecent(returnDict=True))
+
+    def stats(self, metardb=None):
+        stats = (metardb or self.metardb).cacheStats
+        return stats['hits'], stats['misses'], stats['invalidations']
+
+    def testHits(self):
+        first = self.metardb.returnMostRecent()
+        self.assertEqual(len(first), len(self.stations))
+        self.assertTrue(self.metardb.returnMostRecent() is first)
+        self.assertEqual(self.stats(), (1, 1, 0))
+        # A different query is cached separately
+        self.metardb.returnMostRecent(returnDict=True)
+        self.assertEqual(self.stats(), (1, 2, 0))
+
+    def testWriteChunkInvalidates(self):
+        before = self.mostRecent()
+        stationValues, observation = values(1, self.start + dt.timedelta(hours=1))
+        self.assertEqual(self.metardb.addObservations([observation]), 1)
+        self.assertEqual(self.stats(), (0, 1, 1))
+        after = self.mostRecent()
+        self.assertEqual(self.stats(), (0, 2, 1))
+        self.assertNotEqual(after['S001'], before['S001'])
+        self.assertEqual(after['S001'], observation[1])
+
+    def testNothingWrittenKeepsCache(self):
+        self.mostRecent()
+        self.assertEqual(self.metardb.addObservations([observation for stationValues, observation in self.stations]), 0)
+        self.mostRecent()
+        self.assertEqual(self.stats(), (1, 1, 0))
+
+    def testAddStationsInvalidates(self):
+        stationValues, observation = values(9, self.start)
+        # Observations of a station without a location are not mapped
+        self.metardb.addObservations([observation])
+        self.assertNotIn('S009', self.mostRecent())
+        self.metardb.addStations([stationValues])
+        self.assertEqual(self.stats(), (0, 1, 1))
+        self.assertIn('S009', self.mostRecent())
+        # Stations that have not changed leave the cache alone
+        self.metardb.addStations([stationValues])
+        self.mostRecent()
+        self.assertEqual(self.stats(), (1, 2, 1))
+
+    def testOtherConnectionInvalidates(self):
+        '''A commit by another connection (e.g. a harvest, while the map is
+        made) changes the data_version the results were cached with'''
+        if self.metardb.dataVersion() is None:
+            self.skipTest('SQLite before 3.12.0 has no data_version')
+        before = self.mostRecent()
+        self.mostRecent()
+        stationValues, observation = values(2, self.start + dt.timedelta(hours=1))
+        self.assertEqual(self.connect().addObservations([observation]), 1)
+        after = self.mostRecent()
+        self.assertEqual(self.stats(), (1, 2, 0))
+        self.assertNotEqual(after['S002'], before['S002'])
+        self.assertEqual(after['S002'], observation[1])
+        self.mostRecent()
+        self.assertEqual(self.stats(), (2, 2, 0))
+
+    def testCacheAge(self):
+        metardb = self.connect(cacheAge=0.2)
+        first = metardb.returnMostRecent()
+        self.assertTrue(metardb.returnMostRecent() is first)
+        time.sleep(0.3)
+        self.assertFalse(metardb.returnMostRecent() is first)
+        self.assertEqual(self.stats(metardb), (1, 2, 0))
+
+    def testCacheSize(self):
+        metardb = self.connect(cacheSize=2)
+        restrictions = [['S001'], ['S002'], ['S003']]
+        for restrict in restrictions + restrictions[-1:]:
+            metardb.returnMostRecent(restrict)
+        self.assertEqual(len(metardb.queryCache), 2)
+        self.assertEqual(self.stats(metardb), (1, 3, 0))
+        # The least recently used was dropped
+        metardb.returnMostRecent(['S001'])
+        self.assertEqual(self.stats(metardb), (1, 4, 0))
+        metardb = self.connect(cacheSize=0)
+        metardb.returnMostRecent()
+        metardb.returnMostRecent()
+        self.assertEqual(self.stats(metardb), (0, 0, 0))
+
+if __name__ == '__main__':
+    unittest.main()
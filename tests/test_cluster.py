@@ -0,0 +1,67 @@
+'''
+Tests of the clustering of stations into a grid of cells at each zoom
+level (cluster.clusterLevel).
+'''
+
+import unittest
+
+import numpy as np
+
+import cluster
+import symbology
+
+def clusters(lon, lat, zoom=0, temperature=None, y=None):
+    '''Returns the clusters of stations at lon, lat at zoom, with their
+    Web Mercator y if given, rather than from their latitude'''
+    lon, lat = np.array(lon, dtype=float), np.array(lat, dtype=float)
+    if temperature is None:
+        temperature = np.zeros(len(lon))
+    x, mercatorY = cluster.mercator(lon, lat)
+    if y is None:
+        y = mercatorY
+    nan = np.repeat(np.nan, len(lon))
+    return cluster.clusterLevel(x, np.array(y, dtype=float), lon, lat, np.array(temperature, dtype=float), nan, nan, zoom)
+
+class clusterLevelTest(unittest.TestCase):
+    def testCells(self):
+        # Four cells across at zoom 0
+        level = clusters([-170, -160, 10, 10], [60, 50, 60, -60], temperature=[1, 3, 5, 7])
+        self.assertEqual(sorted(level['count']), [1, 1, 2])
+        self.assertEqual(sorted(level['temperature_mean']), [2, 5, 7])
+
+    def testSouthernEdge(self):
+        '''A station at the southern edge of the map (y of 1.0) is in the
+        last row of its column, not the first row of the next'''
+        for zoom in range(0, 4):
+            level = clusters([-170, -80, -80], [-85.0511, 85.0, -84.0], zoom, [1, 2, 3], y=[1.0, 0.0, 0.9])
+            self.assertEqual(len(level['count']), 3)
+            self.assertEqual(sorted(level['temperature_mean']), [1, 2, 3])
+        # With another station in its cell
+        level = clusters([-170, -170, -80], [-85.0511, -84.0, 85.0], temperature=[1, 3, 2], y=[1.0, 0.9, 0.0])
+        self.assertEqual(sorted(level['count']), [1, 2])
+        self.assertEqual(sorted(level['temperature_mean']), [2, 2])
+
+    def testAntimeridian(self):
+        '''A station at 180 degrees is in the last column'''
+        for zoom in range(0, 4):
+            level = clusters([180, 179.9, -180], [0, 0, -85.06], zoom)
+            self.assertEqual(sorted(level['count']), [1, 2])
+
+class levelsTest(unittest.TestCase):
+    def testColourBy(self):
+        '''Clusters are coloured by the mean of the column the map is
+        coloured by, with its classification'''
+        data = {'X': np.array([-170., -160, 10, 10]), 'Y': np.array([60., 50, 60, -60]),
+                'temperature_c': np.array([1., 3, 25, 7]),
+                'windspeed_mph': np.array([2., 10, 40, np.nan]),
+                'winddirection': np.array([90., 90, 180, 0])}
+        for colourBy, classification, means in [('temperature_c', symbology.TEMPERATURE, [2, 7, 25]),
+                                                ('windspeed_mph', symbology.WINDSPEED, [6, np.nan, 40])]:
+            level = cluster.levels(cluster.columns(data, colourBy), classification, [0])[0]
+            self.assertEqual(level['colours'], classification.palette)
+            rows = sorted(level['rows'], key=lambda row: (row[0], row[1]))
+            self.assertEqual([level['colours'][row[-1]] for row in rows],
+                             [classification.colour(mean) for mean in means])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+'''
+Tests of the conditional, cached retrieval of the harvest (fetch.httpCache
+and main.metarHarvester), against the local stand-in for NOAA.
+'''
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import main as m
+import standin
+import fetch
+import pipeline
+
+STATIONS = 20
+
+class cacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        files, forbidden = standin.syntheticNetwork(STATIONS, forbidden=0)
+        self.stations = sorted(files)
+        self.server = standin.standinServer(files)
+        self.server.start()
+        self.metardb = m.metarsqlite3db(os.path.join(self.tmpdir, 'metar.db'))
+        self.cache = fetch.httpCache(os.path.join(self.tmpdir, 'httpcache'))
+
+    def tearDown(self):
+        self.server.stop()
+        self.metardb.conn.close()
+        shutil.rmtree(self.tmpdir)
+
+    def harvest(self):
+        '''Harvests every station through the cache, returning the harvest's
+        statistics and the responses of the stand-in, by status code'''
+        before = dict(self.server.counts)
+        harvester = m.metarHarvester(self.metardb, concurrency=4, source=self.server.source, cache=self.cache)
+        pipeline.METRICS.reset()
+        stats = harvester.harvest(self.stations)
+        responses = dict((status, count - before.get(status, 0)) for status, count in self.server.counts.items())
+        return stats, responses
+
+    def rows(self):
+        return self.metardb.cur.execute('SELECT COUNT(*) FROM metarvals;').fetchone()[0]
+
+    def testColdCache(self):
+        stats, responses = self.harvest()
+        self.assertEqual(responses[200], STATIONS)
+        self.assertEqual(responses[304], 0)
+        self.assertEqual(self.cache.stats['fetched'], STATIONS)
+        self.assertEqual(stats['parsed'], STATIONS)
+        self.assertEqual(stats['added'], STATIONS)
+        self.assertEqual(self.rows(), STATIONS)
+
+    def testWarmCache(self):
+        self.harvest()
+        stats, responses = self.harvest()
+        self.assertEqual(responses[200], 0)
+        self.assertEqual(responses[304], STATIONS)
+        self.assertEqual(stats['unchanged'], STATIONS)
+        # Unchanged files are neither parsed nor written
+        self.assertEqual(stats['parsed'], 0)
+        self.assertEqual(stats['added'], 0)
+        timings = pipeline.METRICS.summary()['timings']
+        self.assertNotIn('parse', timings)
+        self.assertNotIn('db.insert', timings)
+        self.assertEqual(self.rows(), STATIONS)
+
+    def testSomeChanged(self):
+        self.harvest()
+        changed = STATIONS//10
+        for i in range(changed):
+            station, text = standin.syntheticTxt(i + 1 + STATIONS, STATIONS)
+            self.server.update(station, text)
+        stats, responses = self.harvest()
+        self.assertEqual(responses[200], changed)
+        self.assertEqual(responses[304], STATIONS - changed)
+        self.assertEqual(stats['unchanged'], STATIONS - changed)
+        self.assertEqual(stats['parsed'], changed)
+        self.assertEqual(stats['added'], changed)
+        self.assertEqual(self.rows(), STATIONS + changed)
+
+    def testInterruptedWrite(self):
+        '''A file is not seen as unchanged until its observation is stored'''
+        addObservations = self.metardb.addObservations
+        def interrupted(*args, **kwargs):
+            raise KeyboardInterrupt()
+        self.metardb.addObservations = interrupted
+        self.assertRaises(KeyboardInterrupt, self.harvest)
+        self.metardb.addObservations = addObservations
+        self.assertEqual(self.rows(), 0)
+        stats, responses = self.harvest()
+        self.assertTrue(stats['resumed'])
+        self.assertEqual(responses[200], STATIONS)
+        self.assertEqual(stats['added'], STATIONS)
+        stats, responses = self.harvest()
+        self.assertEqual(stats['unchanged'], STATIONS)
+        self.assertEqual(self.rows(), STATIONS)
+
+if __name__ == '__main__':
+    unittest.main()
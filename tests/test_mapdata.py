@@ -0,0 +1,64 @@
+'''
+Tests of the map's data payload (mapdata): that it is written inline, or to
+a sidecar, without any value ending its <script> element.
+'''
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import mapdata
+import symbology
+
+LABEL = u'</script><script>alert("<b>")</script>'
+
+def columns(labels):
+    '''Returns the columns of the latest observations (as from
+    metarsqlite3db.returnMostRecent(returnColumns=True)) of a station with
+    each of labels'''
+    n = len(labels)
+    return {'X': np.arange(n, dtype=float), 'Y': np.arange(n, dtype=float),
+            'station': np.array(['S%03d' % i for i in range(n)], dtype=object),
+            'label': np.array(labels, dtype=object),
+            'utc': np.array(['2014-10-01 00:00:00']*n, dtype=object),
+            'windspeed_mph': np.arange(n, dtype=float), 'winddirection': np.zeros(n),
+            'temperature_c': np.zeros(n)}
+
+class scriptTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        data = columns([LABEL, u'Wellington Airport'])
+        self.payload = mapdata.payload(data, symbology.style(data))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def assertPayload(self, text):
+        '''Asserts that text (var metarData = ...;) holds the payload, with
+        no < in it'''
+        self.assertNotIn('<', text)
+        self.assertEqual(json.loads(text.strip()[len('var metarData = '):-1]), self.payload)
+
+    def testInline(self):
+        html = mapdata.script(self.payload, point=False)
+        # The payload's script, and the one that builds the markers
+        self.assertEqual(html.count('</script>'), 2)
+        inline = html[len('<script>'):html.index('</script>')]
+        self.assertPayload(inline)
+        self.assertEqual(self.payload['rows'][0][mapdata.COLUMNS.index('label')], LABEL)
+
+    def testSidecar(self):
+        path = mapdata.sidecarPath(os.path.join(self.tmpdir, 'map.html'))
+        mapdata.writeSidecar(self.payload, path)
+        with open(path) as f:
+            self.assertPayload(f.read())
+        html = mapdata.script(self.payload, sidecar=os.path.basename(path))
+        self.assertEqual(html.count('</script>'), 2)
+        self.assertNotIn('alert', html)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+'''
+Tests of the raw METAR decoder (metarcode), against the fixture cycle file
+and the decoded .TXT files NOAA published for the same reports
+(data/fixtures), and of single reports.
+'''
+
+import os
+import datetime as dt
+import unittest
+
+import tests
+import metarcode
+import metarparse
+
+FIXTURES = os.path.join(os.path.dirname(tests.SOURCE), 'data', 'fixtures')
+UTC = dt.datetime(2014, 9, 30, 1, 0)
+
+def readFixture(*path):
+    with open(os.path.join(FIXTURES, *path)) as f:
+        return f.read()
+
+class fixtureTest(unittest.TestCase):
+    def setUp(self):
+        self.cycle = readFixture('cycles', '01Z.TXT')
+        self.reports = dict((code.split()[0], (when, code)) for when, code in metarcode.readCycle(self.cycle))
+        self.stations = sorted(name[:-4] for name in os.listdir(os.path.join(FIXTURES, 'decoded')))
+
+    def testDecodedFilesAgree(self):
+        '''Each report decodes to the values parsed from its decoded file'''
+        self.assertTrue(self.stations)
+        for station in self.stations:
+            lines = readFixture('decoded', station + '.TXT').splitlines(True)
+            parsed = metarparse.parse(station, lines)
+            when, code = self.reports[station]
+            report = metarcode.decode(code)
+            for field in ('windspeed_kts', 'temperature_c'):
+                self.assertEqual(getattr(report, field), getattr(parsed, field), '{station} {field}'.format(station=station, field=field))
+            values = metarcode.observationValues(report, when)
+            self.assertEqual(values[:-1], (station, str(parsed.utc), parsed.epoch, parsed.windspeed_mph,
+                parsed.windspeed_kts, parsed.winddirection, parsed.temperature_c, parsed.temperature_f), station)
+            # NOAA computes the relative humidity by its own formula
+            self.assertTrue(abs(values[-1] - parsed.relativehumidity_pct) <= 1, station)
+
+    def testCycleObservations(self):
+        observations, failed = metarcode.cycleObservations(self.cycle)
+        self.assertEqual(sorted(failed), ['SBGR', 'ZZZZ'])
+        stations = [values[0] for values in observations]
+        self.assertEqual(len(stations), 11)
+        self.assertIn('FAOR', stations) # METAR prefix
+        self.assertIn('CYVR', stations) # Wrapped over two lines
+        observations, failed = metarcode.cycleObservations(self.cycle, stations=set(['NZWN', 'SBGR']))
+        self.assertEqual([values[0] for values in observations], ['NZWN'])
+        self.assertEqual(sorted(failed), ['SBGR'])
+
+class decodeTest(unittest.TestCase):
+    def testNegativeTemperatures(self):
+        report = metarcode.decode('NZCH 300100Z 00000KT CAVOK M01/M05 Q1020')
+        self.assertEqual((report.temperature_c, report.dewpoint_c), (-1, -5))
+        self.assertEqual(metarcode.observationValues(report, UTC)[6:], (-1, 30, 74))
+
+    def testPreciseTemperature(self):
+        report = metarcode.decode('KDEN 300053Z VRB03KT 1 1/2SM BR OVC004 M05/M07 A2983 RMK AO2 T10501072')
+        self.assertEqual(report.temperature_c, -5)
+        self.assertEqual((report.temperature_precise, report.dewpoint_precise), (-5.0, -7.2))
+        report = metarcode.decode('KJFK 300051Z 04012KT 10SM FEW250 17/09 A3012 RMK AO2 SLP200 T01670094')
+        self.assertEqual((report.temperature_precise, report.dewpoint_precise), (16.7, 9.4))
+        self.assertEqual(metarcode.observationValues(report, UTC)[6:], (17, 62, 62))
+
+    def testCalmWind(self):
+        report = metarcode.decode('NZCH 300100Z 00000KT CAVOK M01/M03 Q1020')
+        self.assertEqual((report.windspeed_kts, report.winddirection), (0, 0))
+        values = metarcode.observationValues(report, UTC)
+        self.assertEqual(values[3:6], (0, 0, 0))
+
+    def testVariableWind(self):
+        report = metarcode.decode('KDEN 300053Z VRB03KT 1 1/2SM BR OVC004 M05/M07 A2983')
+        self.assertEqual((report.windspeed_kts, report.winddirection), (3, None))
+        self.assertEqual(report.visibility_m, 2414)
+        self.assertEqual(metarcode.observationValues(report, UTC)[3:6], (3, 3, None))
+
+    def testGustsAndUnits(self):
+        report = metarcode.decode('NZAA 300100Z 24015G25KT 210V270 9999 SCT030 BKN045 16/11 Q1012 NOSIG')
+        self.assertEqual((report.windspeed_kts, report.windgust_kts, report.winddirection), (15, 25, 240))
+        report = metarcode.decode('UUEE 300100Z 05004MPS 0800 R06C/0550N FG VV002 07/07 Q1008 NOSIG')
+        self.assertEqual((report.windspeed_kts, report.visibility_m, report.sky), (8, 800, [('VV', 200)]))
+
+    def testCavok(self):
+        report = metarcode.decode('YSSY 300100Z 17012KT CAVOK 19/ Q1016')
+        self.assertEqual(report.visibility_m, 10000)
+        self.assertEqual(report.sky, [])
+        self.assertEqual((report.temperature_c, report.dewpoint_c), (19, None))
+
+    def testMissingGroups(self):
+        report = metarcode.decode('XXXX 300100Z')
+        self.assertEqual(report.station, 'XXXX')
+        self.assertEqual((report.day, report.hour, report.minute), (30, 1, 0))
+        for field in ('windspeed_kts', 'winddirection', 'visibility_m', 'temperature_c', 'dewpoint_c', 'altimeter_hpa'):
+            self.assertIsNone(getattr(report, field), field)
+        self.assertEqual(report.sky, [])
+        self.assertEqual(metarcode.observationValues(report, UTC)[3:], (None, None, None, None, None, None))
+
+    def testRelativeHumidity(self):
+        self.assertEqual(metarcode.relativeHumidity(14, 8), 67)
+        self.assertEqual(metarcode.relativeHumidity(7, 7), 100)
+        self.assertEqual(metarcode.relativeHumidity(-1, -5), 74)
+        self.assertIsNone(metarcode.relativeHumidity(19, None))
+
+    def testAltimeter(self):
+        self.assertEqual(metarcode.decode('KJFK 300051Z 04012KT 10SM FEW250 17/09 A3012').altimeter_hpa, 1020.0)
+        self.assertEqual(metarcode.decode('NZWN 300100Z 19007KT 9999 FEW025 14/08 Q1015').altimeter_hpa, 1015.0)
+
+    def testUndecodable(self):
+        self.assertRaises(ValueError, metarcode.decode, 'SBGR 300100Z NIL')
+        self.assertRaises(ValueError, metarcode.decode, 'ZZZZ garbled report')
+        self.assertRaises(ValueError, metarcode.decode, '')
+
+class decodedFileTest(unittest.TestCase):
+    '''The temperature of decoded files, whose sign and tenths were lost'''
+    def testNegativeTenths(self):
+        lines = readFixture('decoded', 'KDEN.TXT').splitlines(True)
+        parsed = metarparse.parse('KDEN', lines)
+        self.assertEqual((parsed.temperature_c, parsed.temperature_f), (-5, 23))
+        self.assertEqual(parsed.relativehumidity_pct, 84)
+
+if __name__ == '__main__':
+    unittest.main()
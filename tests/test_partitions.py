@@ -0,0 +1,178 @@
+'''
+Tests of the partitions of the archive (main.metarsqlite3db.rollPartitions,
+dropPartitions and compactPartitions): that the history reads the same
+across them, that late observations are written to theirs, and that the
+latest table stays right.
+'''
+
+import os
+import re
+import shutil
+import sqlite3
+import tempfile
+import calendar
+import datetime as dt
+import unittest
+
+import main as m
+
+STATIONS = 6
+START = dt.datetime(2014, 10, 1)
+END = dt.datetime(2015, 3, 1)
+
+def epoch(when):
+    return calendar.timegm(when.utctimetuple())
+
+def observation(station, when, i=0):
+    '''Returns the values of a synthetic observation, as from
+    METARTxtFile.observationValues()'''
+    return (station, str(when), epoch(when), i % 40, i % 35, (i*10) % 360, i % 30 - 5, 32 + (i % 30 - 5)*9/5, 20 + (i*7) % 81)
+
+def observations(start=START, end=END, hours=6):
+    '''Returns synthetic observations of every station every hours from
+    start until end. The last station stops reporting in December.'''
+    values, when, i = [], start, 0
+    while when < end:
+        for s in range(STATIONS):
+            if s < STATIONS - 1 or when < dt.datetime(2014, 12, 15):
+                values.append(observation('S%03d' % s, when, i))
+            i += 1
+        when += dt.timedelta(hours=hours)
+    return values
+
+def dropHumidity(path, table):
+    '''Rebuilds table, in the database at path, without its relativehumidity
+    column, as it was before relative humidity was stored'''
+    conn = sqlite3.connect(path)
+    sql = conn.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name=?;", (table,)).fetchone()[0]
+    columns = ', '.join(row[1] for row in conn.execute('PRAGMA table_info(%s);' % table) if row[1] != 'relativehumidity')
+    conn.execute('ALTER TABLE %s RENAME TO old;' % table)
+    conn.execute(re.sub(r',\s*relativehumidity INTEGER', '', sql))
+    conn.execute('INSERT INTO %s SELECT %s FROM old;' % (table, columns))
+    conn.execute('DROP TABLE old;')
+    conn.commit()
+    conn.close()
+
+class partitionTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'metar.db')
+        self.observations = observations()
+        self.plain = m.metarsqlite3db(os.path.join(self.tmpdir, 'plain.db'), cacheSize=0)
+        self.plain.addObservations(self.observations)
+        metardb = m.metarsqlite3db(self.path, cacheSize=0)
+        metardb.addObservations(self.observations)
+        metardb.conn.close()
+        self.metardb = m.metarsqlite3db(self.path, cacheSize=0, partition='month', maxAttached=2)
+        # October to January are rolled; February stays in the main database
+        self.moved = self.metardb.rollPartitions(epoch(dt.datetime(2015, 2, 10)))
+
+    def tearDown(self):
+        self.plain.conn.close()
+        self.metardb.conn.close()
+        shutil.rmtree(self.tmpdir)
+
+    def count(self, metardb, schema, where='1'):
+        return metardb.cur.execute('SELECT COUNT(*) FROM %s.metarvals WHERE %s;' % (schema, where)).fetchone()[0]
+
+    def partitionRows(self, key):
+        return self.count(self.metardb, self.metardb.attachPartition(key))
+
+    def latest(self, metardb):
+        return sorted(metardb.cur.execute('SELECT station, utc, obs_epoch, temperature_c FROM latest;').fetchall())
+
+    def assertHistoryEqual(self, first, second):
+        self.assertEqual(len(first), len(second))
+        for a, b in zip(first, second):
+            self.assertEqual(a[:3], b[:3])
+            for x, y in zip(a[3:], b[3:]):
+                self.assertAlmostEqual(x, y)
+
+    def testRolled(self):
+        february = epoch(dt.datetime(2015, 2, 1))
+        self.assertEqual(self.moved, self.count(self.plain, 'main', 'obs_epoch < %d' % february))
+        self.assertEqual(self.count(self.metardb, 'main'), self.count(self.plain, 'main', 'obs_epoch >= %d' % february))
+        keys = self.metardb.partitionsBetween(epoch(START), epoch(END))
+        self.assertEqual(keys, ['201410', '201411', '201412', '201501'])
+        self.assertEqual(sum(self.partitionRows(key) for key in keys), self.moved)
+        self.assertTrue(len(self.metardb.attached) <= 2)
+        self.assertEqual(self.metardb.hotStart(), february)
+
+    def testHistoryAcrossPartitions(self):
+        '''More partitions than can be attached at once are read a batch at
+        a time, and give the history of the unpartitioned database'''
+        for bucket in ('hour', 'day', 7*86400):
+            for stations in (None, ['S001', 'S005']):
+                expected = self.plain.returnHistory(stations, START, END, bucket)
+                self.assertTrue(expected)
+                self.assertHistoryEqual(self.metardb.returnHistory(stations, START, END, bucket), expected)
+        # Within one partition, and within the main database
+        for start, end in [(dt.datetime(2014, 11, 3), dt.datetime(2014, 11, 20)),
+                           (dt.datetime(2015, 2, 3), dt.datetime(2015, 2, 20))]:
+            self.assertHistoryEqual(self.metardb.returnHistory(None, start, end, 'day'),
+                                    self.plain.returnHistory(None, start, end, 'day'))
+        self.assertTrue(len(self.metardb.attached) <= 2)
+
+    def testLateObservations(self):
+        '''Observations from before the main database's are written to their
+        partition, and still update latest when they are the newest'''
+        november = self.partitionRows('201411')
+        late = observation('S000', dt.datetime(2014, 11, 5, 1, 30), 7)
+        self.assertEqual(self.metardb.addObservations([late]), 1)
+        self.assertEqual(self.partitionRows('201411'), november + 1)
+        self.assertEqual(self.count(self.metardb, 'main', 'obs_epoch = %d' % late[2]), 0)
+        self.assertEqual(self.latest(self.metardb), self.latest(self.plain))
+        # The last station's latest observation is from December: a later one
+        # in January is its newest, though it goes to January's partition
+        january = self.partitionRows('201501')
+        newest = observation('S005', dt.datetime(2015, 1, 5, 12), 11)
+        self.metardb.detachPartition('201501')
+        self.assertEqual(self.metardb.addObservations([newest]), 1)
+        self.assertEqual(self.partitionRows('201501'), january + 1)
+        station = self.metardb.cur.execute('SELECT utc, obs_epoch FROM latest WHERE station = ?;', ('S005',)).fetchone()
+        self.assertEqual(tuple(station), (newest[1], newest[2]))
+        self.assertEqual(self.metardb.knownIndex().times['S005'], newest[2])
+        # The same observation again is not written twice
+        self.assertEqual(self.metardb.addObservations([newest]), 0)
+        self.assertEqual(self.partitionRows('201501'), january + 1)
+
+    def testDropAndCompact(self):
+        before = self.latest(self.metardb)
+        self.assertEqual(before, self.latest(self.plain))
+        self.assertEqual(self.metardb.dropPartitions(epoch(dt.datetime(2014, 12, 1))), ['201410', '201411'])
+        self.assertFalse(os.path.exists(self.metardb.partitionPath('201410')))
+        self.assertEqual(self.metardb.partitionsBetween(epoch(START), epoch(END)), ['201412', '201501'])
+        self.assertEqual(sorted(self.metardb.compactPartitions()), ['201412', '201501'])
+        self.assertEqual(self.metardb.compactPartitions(), [])
+        self.assertEqual(self.latest(self.metardb), before)
+        self.assertEqual(self.metardb.latestTimes(), dict((station, obs_epoch) for station, utc, obs_epoch, temperature in before))
+        # What is left reads as before
+        start = dt.datetime(2014, 12, 1)
+        self.assertHistoryEqual(self.metardb.returnHistory(None, start, END, 'day'),
+                                self.plain.returnHistory(None, start, END, 'day'))
+        # A compacted partition is written to (and compacted) again
+        newest = observation('S005', dt.datetime(2015, 1, 20), 3)
+        self.assertEqual(self.metardb.addObservations([newest]), 1)
+        self.assertEqual(self.metardb.cur.execute('SELECT obs_epoch FROM latest WHERE station = ?;', ('S005',)).fetchone()[0], newest[2])
+        self.assertEqual(self.metardb.compactPartitions(), ['201501'])
+
+    def testBeforeHumidity(self):
+        '''Tables and partitions from before relative humidity was stored get
+        its column, and the latest table is kept up to date with it'''
+        self.metardb.conn.close()
+        for table in ('metarvals', 'latest'):
+            dropHumidity(self.path, table)
+        dropHumidity(self.metardb.partitionPath('201411'), 'metarvals')
+        self.metardb = m.metarsqlite3db(self.path, cacheSize=0, partition='month', maxAttached=2)
+        self.assertIn('relativehumidity', self.metardb.columnNames('latest'))
+        self.assertEqual(self.latest(self.metardb), self.latest(self.plain))
+        schema = self.metardb.attachPartition('201411')
+        self.assertIn('relativehumidity', self.metardb.columnNames('metarvals', schema))
+        for values in (observation('S000', dt.datetime(2015, 3, 1, 6), 3), observation('S001', dt.datetime(2014, 11, 5, 1, 30), 4)):
+            self.assertEqual(self.metardb.addObservations([values]), 1)
+        self.assertEqual(self.metardb.cur.execute('SELECT relativehumidity FROM latest WHERE station = ?;', ('S000',)).fetchone()[0], 41)
+        self.assertEqual(self.metardb.cur.execute('SELECT relativehumidity FROM %s.metarvals WHERE station = ? AND obs_epoch = ?;' % schema,
+                                                  ('S001', epoch(dt.datetime(2014, 11, 5, 1, 30)))).fetchone()[0], 48)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,274 @@
+'''
+Tests of the stages of the harvest (main.metarHarvester.harvest and
+pipeline): the rows written, ignored and known, the errors of the stages,
+and the bounds of the queues between them, against the local stand-in for
+NOAA.
+'''
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import main as m
+import standin
+import pipeline
+
+STATIONS = 20
+
+def synthetic(station, hour, stations=STATIONS):
+    '''Returns the values of an observation of a synthetic station (see
+    standin.syntheticTxt()) from hour hours after the first'''
+    i = int(station[1:]) + hour*stations
+    name, text = standin.syntheticTxt(i, stations)
+    return m.METARTxtFile(name, dataList=text.splitlines(True)).observationValues()
+
+class pipelineTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        files, forbidden = standin.syntheticNetwork(STATIONS, forbidden=0)
+        self.stations = sorted(files)
+        self.server = standin.standinServer(files)
+        self.server.start()
+        self.path = os.path.join(self.tmpdir, 'metar.db')
+        self.metardb = m.metarsqlite3db(self.path)
+        pipeline.METRICS.reset()
+
+    def tearDown(self):
+        self.server.stop()
+        self.metardb.conn.close()
+        shutil.rmtree(self.tmpdir)
+
+    def harvest(self, stations=None, patch=None, **kwargs):
+        '''Returns the statistics of a harvest of stations (every station by
+        default) by a metarHarvester made with kwargs, or raises its error,
+        failing if the harvest does not finish. The harvest has a connection
+        of its own, in a thread of its own; patch, if given, is called with
+        the harvester before it starts.'''
+        result = {}
+        def run():
+            metardb = m.metarsqlite3db(self.path)
+            try:
+                options = dict({'concurrency': 4, 'source': self.server.source}, **kwargs)
+                harvester = m.metarHarvester(metardb, **options)
+                if patch is not None:
+                    patch(harvester)
+                result['stats'] = harvester.harvest(stations or self.stations)
+            except BaseException, e:
+                result['error'] = e
+            finally:
+                metardb.conn.close()
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        thread.join(30)
+        self.assertFalse(thread.is_alive(), 'The harvest did not finish')
+        if 'error' in result:
+            raise result['error']
+        return result['stats']
+
+    def rows(self):
+        return self.metardb.cur.execute('SELECT COUNT(*) FROM metarvals;').fetchone()[0]
+
+    def status(self, run):
+        return self.metardb.cur.execute('SELECT status FROM harvest_runs WHERE run_id = ?;', (run,)).fetchone()[0]
+
+    def lastRun(self):
+        return self.metardb.cur.execute('SELECT MAX(run_id) FROM harvest_runs;').fetchone()[0]
+
+    def assertStagesStopped(self):
+        '''Asserts that no fetch or parse thread is left running'''
+        self.assertEqual([t.name for t in threading.enumerate() if t.name.startswith(('fetch-', 'parse'))], [])
+
+    def network(self, stations):
+        '''Returns the sorted codes of a network of a number of stations,
+        served by the stand-in'''
+        files, forbidden = standin.syntheticNetwork(stations, forbidden=0)
+        for station, text in files.items():
+            self.server.update(station, text)
+        return sorted(files)
+
+    def testRowsWritten(self):
+        stats = self.harvest()
+        self.assertEqual((stats['parsed'], stats['added'], stats['known'], stats['duplicates']), (STATIONS, STATIONS, 0, 0))
+        self.assertEqual(stats['stages']['write']['items'], STATIONS)
+        self.assertEqual(pipeline.METRICS.summary()['counts']['db.rows_written'], STATIONS)
+        self.assertEqual(self.rows(), STATIONS)
+        self.assertEqual(self.status(stats['run']), 'complete')
+
+    def testRowsKnown(self):
+        '''Files holding the latest stored observation are not parsed, or
+        are dropped before the writer when they are'''
+        self.harvest()
+        stats = self.harvest()
+        self.assertEqual((stats['parsed'], stats['known'], stats['duplicates'], stats['added']), (0, STATIONS, 0, 0))
+        self.assertEqual(stats['stages']['parse']['items'], STATIONS)
+        stats = self.harvest(skipKnown=False)
+        self.assertEqual((stats['parsed'], stats['known'], stats['duplicates'], stats['added']), (STATIONS, 0, STATIONS, 0))
+        self.assertEqual(stats['stages']['dedupe']['items'], STATIONS)
+        self.assertEqual(stats['stages']['write']['items'], 0)
+        self.assertEqual(self.rows(), STATIONS)
+
+    def testRowsIgnored(self):
+        '''Observations already stored, but older than the latest, reach the
+        database and are ignored there; the latest are dropped before it'''
+        station = self.stations[0]
+        observations = [synthetic(station, hour) for hour in range(3)]
+        self.assertEqual(self.metardb.addObservations(observations), 3)
+        pipeline.METRICS.reset()
+        self.assertEqual(self.metardb.addObservations(observations + [synthetic(station, 3)]), 1)
+        counts = pipeline.METRICS.summary()['counts']
+        self.assertEqual(counts['db.rows_written'], 1)
+        self.assertEqual(counts['db.rows_ignored'], 2)
+        self.assertEqual(counts['db.rows_known'], 1)
+
+    def testStationsFail(self):
+        '''Stations that cannot be retrieved or parsed fail on their own'''
+        self.server.forbidden.add(self.stations[0])
+        self.server.update(self.stations[1], 'Not a decoded METAR file\n')
+        stats = self.harvest(backoff=False)
+        self.assertEqual(sorted(stats['failed']), self.stations[:2])
+        self.assertIn('403', stats['failed'][self.stations[0]])
+        self.assertEqual(stats['added'], STATIONS - 2)
+        self.assertEqual(self.status(stats['run']), 'complete')
+
+    def testWriteFails(self):
+        '''A batch that cannot be written is written a row at a time, failing
+        only the stations whose rows cannot be'''
+        bad = self.stations[3]
+        def patch(harvester):
+            addObservations = harvester.metardb.addObservations
+            def failing(observations, *args, **kwargs):
+                if any(values[0] == bad for values in observations):
+                    raise ValueError('Cannot write {station}'.format(station=bad))
+                return addObservations(observations, *args, **kwargs)
+            harvester.metardb.addObservations = failing
+        stats = self.harvest(patch=patch, backoff=False)
+        self.assertEqual(stats['failed'], {bad: 'Cannot write {station}'.format(station=bad)})
+        self.assertEqual(stats['added'], STATIONS - 1)
+        self.assertEqual(self.rows(), STATIONS - 1)
+
+    def testFetchStageFails(self):
+        '''An error that stops a fetch thread is raised by the harvest'''
+        def fetch(station):
+            raise KeyboardInterrupt()
+        def patch(harvester):
+            harvester.fetch = fetch
+        self.assertRaises(KeyboardInterrupt, self.harvest, patch=patch)
+        self.assertStagesStopped()
+        self.assertEqual(self.status(self.lastRun()), 'interrupted')
+        self.assertEqual(self.rows(), 0)
+
+    def testParseStageFails(self):
+        '''An error that stops the parse thread is raised by the harvest'''
+        class brokenIndex(m.latestIndex):
+            def isKnownFile(self, station, lines):
+                raise RuntimeError('Broken index')
+        def patch(harvester):
+            times = harvester.metardb.knownIndex().times
+            harvester.metardb.knownIndex = lambda: brokenIndex(times)
+        self.assertRaises(RuntimeError, self.harvest, patch=patch)
+        self.assertStagesStopped()
+        self.assertEqual(self.status(self.lastRun()), 'interrupted')
+        # The stations are still pending, to be resumed
+        stats = self.harvest()
+        self.assertTrue(stats['resumed'])
+        self.assertEqual(stats['added'], STATIONS)
+
+    def testWriteStageFails(self):
+        '''An error that stops the writer stops the fetch and parse threads
+        too, though they are waiting for room on full queues'''
+        stations = self.network(60)
+        def patch(harvester):
+            def writeBatch(*args):
+                time.sleep(0.3)
+                raise KeyboardInterrupt()
+            harvester.writeBatch = writeBatch
+        self.assertRaises(KeyboardInterrupt, self.harvest, stations, patch, concurrency=2, batchsize=1)
+        self.assertStagesStopped()
+        self.assertEqual(self.status(self.lastRun()), 'interrupted')
+
+    def testQueuesBounded(self):
+        '''A slow writer holds the fetch and parse stages back, rather than
+        letting files pile up in the queues'''
+        stations = 60
+        codes = self.network(stations)
+        def patch(harvester):
+            addObservations = harvester.metardb.addObservations
+            def slow(observations, *args, **kwargs):
+                time.sleep(0.01*len(observations))
+                return addObservations(observations, *args, **kwargs)
+            harvester.metardb.addObservations = slow
+        stats = self.harvest(codes, patch, concurrency=2, batchsize=1)
+        self.assertEqual(stats['added'], stations)
+        for name in ('fetched', 'parsed'):
+            queue = stats['queues'][name]
+            self.assertEqual(queue['maxsize'], 8)
+            self.assertTrue(queue['max'] <= queue['maxsize'], name)
+        self.assertEqual(stats['queues']['parsed']['max'], 8)
+        self.assertTrue(stats['queues']['fetched']['blocked'] > 0)
+
+class boundedQueueTest(unittest.TestCase):
+    def testPutBlocksWhenFull(self):
+        queue = pipeline.boundedQueue(maxsize=3)
+        def take():
+            time.sleep(0.1)
+            queue.get()
+        for i in range(3):
+            queue.put(i)
+        taker = threading.Thread(target=take)
+        taker.start()
+        queue.put(3)
+        taker.join()
+        summary = queue.summary()
+        self.assertEqual((summary['maxsize'], summary['max']), (3, 3))
+        self.assertEqual(summary['mean'], 2.25)
+        self.assertTrue(summary['blocked'] >= 0.05)
+        self.assertEqual(queue.qsize(), 3)
+
+    def testStop(self):
+        '''Stopping a pipeline wakes the threads waiting on its queues, and
+        empties them'''
+        stopping = threading.Event()
+        full, empty = pipeline.boundedQueue(1, stopping), pipeline.boundedQueue(1, stopping)
+        full.put(0)
+        errors = []
+        def wait(method):
+            try:
+                method()
+            except pipeline.stopped, e:
+                errors.append(e)
+        threads = [threading.Thread(target=wait, args=(lambda: full.put(1),)),
+                   threading.Thread(target=wait, args=(empty.get,))]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.1)
+        # The putter may see stopping, or (if room was made first) finish its
+        # put, which is emptied too
+        self.assertTrue(pipeline.stop(stopping, [full, empty], threads) in (1, 2))
+        self.assertFalse(any(thread.is_alive() for thread in threads))
+        self.assertTrue(len(errors) in (1, 2))
+        self.assertEqual((full.qsize(), empty.qsize()), (0, 0))
+        self.assertRaises(pipeline.stopped, full.put, 2)
+
+class reportTest(unittest.TestCase):
+    def testPrometheusText(self):
+        metrics = pipeline.metrics()
+        metrics.count('db.rows_written', 3)
+        report = pipeline.runReport('harvest', 1412038800.5, 2.5, {'run': 7, 'added': 3, 'rate': float('nan'),
+                                    'saved': float('inf'), 'lost': float('-inf')}, metrics)
+        self.assertEqual(report['started'], '2014-09-30T01:00:00.500000Z')
+        lines = pipeline.prometheusText(report).splitlines()
+        self.assertIn('metarvis_last_run_timestamp_seconds{run="harvest"} 1412038800.5', lines)
+        self.assertIn('metarvis_last_run_elapsed_seconds{run="harvest"} 2.5', lines)
+        self.assertIn('metarvis_last_run_stat{run="harvest",stat="added"} 3.0', lines)
+        self.assertIn('metarvis_last_run_stat{run="harvest",stat="rate"} NaN', lines)
+        self.assertIn('metarvis_last_run_stat{run="harvest",stat="saved"} +Inf', lines)
+        self.assertIn('metarvis_last_run_stat{run="harvest",stat="lost"} -Inf', lines)
+        self.assertIn('metarvis_last_run_count{count="db.rows_written",run="harvest"} 3.0', lines)
+        self.assertFalse([line for line in lines if 'stat="run"' in line])
+
+if __name__ == '__main__':
+    unittest.main()
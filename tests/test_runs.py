@@ -0,0 +1,93 @@
+'''
+Tests of resuming interrupted harvests (main.metarsqlite3db.resumeRun and
+main.metarHarvester.harvest).
+'''
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import main as m
+import standin
+
+STATIONS = 40
+
+class resumeTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        files, forbidden = standin.syntheticNetwork(STATIONS, forbidden=0)
+        self.stations = sorted(files)
+        self.server = standin.standinServer(files)
+        self.server.start()
+        self.metardb = m.metarsqlite3db(os.path.join(self.tmpdir, 'metar.db'))
+
+    def tearDown(self):
+        self.server.stop()
+        self.metardb.conn.close()
+        shutil.rmtree(self.tmpdir)
+
+    def interruptedRun(self, stations, done=()):
+        '''Records a run of stations, interrupted after the done stations'''
+        run = self.metardb.startRun(stations)
+        self.metardb.checkpointRun(run, [('done', station) for station in done])
+        self.metardb.finishRun(run, 'interrupted')
+        return run
+
+    def harvest(self, stations):
+        '''Returns the harvest's statistics, and the full responses served'''
+        before = self.server.counts[200]
+        stats = m.metarHarvester(self.metardb, concurrency=4, source=self.server.source).harvest(stations)
+        return stats, self.server.counts[200] - before
+
+    def stored(self, station):
+        return self.metardb.cur.execute('SELECT COUNT(*) FROM metarvals WHERE station = ?;', (station,)).fetchone()[0]
+
+    def testOtherStationsNotReplaced(self):
+        run = self.interruptedRun(['S000', 'S001'])
+        stats, served = self.harvest(['S039'])
+        self.assertFalse(stats['resumed'])
+        self.assertNotEqual(stats['run'], run)
+        self.assertEqual(served, 1)
+        self.assertEqual(self.stored('S039'), 1)
+        self.assertEqual(self.stored('S000'), 0)
+        # The interrupted run is left alone, to be resumed by its own stations
+        self.assertEqual(self.metardb.resumeRun(['S001', 'S000'])[0], run)
+
+    def testSubsetNotWidened(self):
+        self.interruptedRun(self.stations)
+        stats, served = self.harvest(['S001', 'S002'])
+        self.assertFalse(stats['resumed'])
+        self.assertEqual(served, 2)
+        self.assertEqual(stats['stations'], 2)
+
+    def testSameStationsResumed(self):
+        run = self.interruptedRun(self.stations, done=self.stations[:30])
+        stats, served = self.harvest(list(reversed(self.stations)))
+        self.assertTrue(stats['resumed'])
+        self.assertEqual(stats['run'], run)
+        self.assertEqual(served, 10)
+        self.assertEqual(stats['added'], 10)
+
+    def testSkippedStationsRecorded(self):
+        '''A run that skipped failing stations still matches a request for
+        every station'''
+        self.metardb.recordFailures({'S000': 'Forbidden'})
+        stats, served = self.harvest(self.stations)
+        self.assertEqual(stats['skipped'], 1)
+        self.assertEqual(self.metardb.runStations(stats['run']), set(self.stations))
+
+    def testCycleLocationsNotResumed(self):
+        '''harvestCycles fetches the locations of new stations in a run of
+        its own, rather than resuming an interrupted one'''
+        run = self.interruptedRun(['S001', 'S002'])
+        self.server.cycles['01Z'] = '2014/09/30 01:00\nS001 300100Z 19007KT 9999 FEW025 14/08 Q1015\n'
+        harvester = m.metarHarvester(self.metardb, concurrency=4, source=self.server.source)
+        harvester.harvestCycles(['S001', 'S002'], hours=[1], source=self.server.cyclesSource)
+        stations = set(str(station) for station, in self.metardb.cur.execute('SELECT station FROM stations;'))
+        self.assertTrue(set(['S001', 'S002']) <= stations)
+        status = self.metardb.cur.execute('SELECT status FROM harvest_runs WHERE run_id = ?;', (run,)).fetchone()[0]
+        self.assertEqual(status, 'interrupted')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+'''
+Tests of the styling of the map's markers (symbology, and
+main.foliumMap.makeMap(colourBy=...)).
+'''
+
+import os
+import json
+import shutil
+import tempfile
+import datetime as dt
+import unittest
+
+import main as m
+import standin
+import cluster
+import mapdata
+import symbology
+
+class colourByTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.metardb = m.metarsqlite3db(os.path.join(self.tmpdir, 'metar.db'))
+        start = dt.datetime.utcnow().replace(minute=0, second=0, microsecond=0)
+        values = []
+        for i in range(30):
+            station, text = standin.syntheticTxt(i, 30, start)
+            metar = m.METARTxtFile(station, dataList=text.splitlines(True))
+            values.append((metar.stationValues(), metar.observationValues()))
+        self.metardb.addStations([stationValues for stationValues, observation in values if stationValues is not None])
+        self.metardb.addObservations([observation for stationValues, observation in values])
+        self.mapName = os.path.join(self.tmpdir, 'map.html')
+
+    def tearDown(self):
+        self.metardb.conn.close()
+        shutil.rmtree(self.tmpdir)
+
+    def testClassifiedColumns(self):
+        columns = self.metardb.returnMostRecent(returnColumns=True)
+        for column in symbology.CLASSIFICATIONS:
+            styles = symbology.style(columns, column)
+            self.assertEqual(len(styles['colour']), len(columns['station']))
+            self.assertTrue((styles['colour'] < len(styles['palette'])).all())
+
+    def testHumidityColours(self):
+        '''The relative humidity is stored, and colours the markers'''
+        columns = self.metardb.returnMostRecent(returnColumns=True)
+        self.assertTrue(len(columns['station']))
+        for station, humidity in zip(columns['station'], columns['relativehumidity']):
+            self.assertEqual(humidity, 20 + (int(station[1:])*7) % 81)
+        styles = symbology.style(columns, 'relativehumidity')
+        expected = [symbology.HUMIDITY.colour(humidity) for humidity in columns['relativehumidity']]
+        self.assertEqual([styles['palette'][colour] for colour in styles['colour']], expected)
+
+    def testMarkers(self):
+        '''The triangles are turned by the wind direction and sized by the
+        speed; calm stations have no radius, and are drawn as circles'''
+        columns = self.metardb.returnMostRecent(returnColumns=True)
+        styles = symbology.style(columns)
+        known = styles['known']
+        self.assertTrue(known.all())
+        self.assertEqual(styles['rotation'].tolist(), (columns['winddirection'] + symbology.TRIANGLE_ROTATION).astype(int).tolist())
+        self.assertEqual(styles['radius'].tolist(), columns['windspeed_mph'].astype(int).tolist())
+        calm = [int(station[1:]) % 10 == 0 for station in columns['station']]
+        self.assertTrue(any(calm))
+        self.assertEqual((styles['radius'] == 0).tolist(), calm)
+        payload = mapdata.payload(columns, styles)
+        rotation, radius = mapdata.COLUMNS.index('rotation'), mapdata.COLUMNS.index('radius')
+        self.assertEqual([(row[rotation], row[radius]) for row in payload['rows']],
+                         zip(styles['rotation'].tolist(), styles['radius'].tolist()))
+
+    def testUnknownColumn(self):
+        columns = self.metardb.returnMostRecent(returnColumns=True)
+        self.assertRaises(ValueError, symbology.style, columns, 'winddirection')
+        self.assertRaises(ValueError, symbology.style, columns, 'dewpoint')
+
+    def testMakeMapColourBy(self):
+        fmap = m.foliumMap(self.metardb, self.mapName, 'Mapbox Bright')
+        for colourBy in ('windspeed_mph', 'relativehumidity'):
+            fmap.makeMap(point=False, data=True, colourBy=colourBy)
+            self.assertTrue(os.path.exists(self.mapName))
+        self.assertRaises(ValueError, fmap.makeMap, point=False, data=True, colourBy='winddirection')
+
+    def testClusterColourBy(self):
+        '''The clusters are coloured by the column the map is coloured by'''
+        fmap = m.foliumMap(self.metardb, self.mapName, 'Mapbox Bright')
+        fmap.makeMap(point=False, levels=range(0, 2), colourBy='windspeed_mph')
+        columns = self.metardb.returnMostRecent(returnColumns=True)
+        prefix = cluster.levelPrefix(self.mapName)
+        for zoom in range(0, 2):
+            with open('%s%d.js' % (prefix, zoom)) as f:
+                text = f.read()
+            level = json.loads(text[text.index(',') + 1:text.rindex(')')])
+            self.assertEqual(level['colours'], symbology.WINDSPEED.palette)
+            expected = cluster.levels(cluster.columns(columns, 'windspeed_mph'), symbology.WINDSPEED, [zoom])[zoom]
+            self.assertEqual(level['rows'], expected['rows'])
+            self.assertNotEqual(level['rows'], cluster.levels(cluster.columns(columns), symbology.TEMPERATURE, [zoom])[zoom]['rows'])
+
+if __name__ == '__main__':
+    unittest.main()